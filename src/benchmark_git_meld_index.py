@@ -0,0 +1,276 @@
+"""Benchmarks for git-meld-index, using synthetic repositories.
+
+Repositories are built quickly using git fast-import, with a configurable
+number of tracked, modified, staged and untracked files (including symlinks,
+executables and large binary files).  Each stage of a session is timed
+separately, and the processes it starts are counted.
+
+For example:
+
+    python src/benchmark_git_meld_index.py --tracked 20000 --modified 2000
+
+test_git_meld_index.py checks that the number of processes started stays
+within PROCESS_BUDGETS however large the repository is, that importing
+git_meld_index doesn't import any of LAZY_MODULES, and that the import takes
+no more than several times IMPORT_TIME_BUDGET_US.  The benchmark itself
+exits with status 1 if the import takes longer than IMPORT_TIME_BUDGET_US.
+"""
+
+from dataclasses import dataclass
+import argparse
+import dataclasses
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import git_meld_index
+
+
+# Most processes each stage may start, regardless of repository size
+PROCESS_BUDGETS = {
+    "snapshot": 1,
+    # ls-files, for the files in the untracked directories git status lists
+    "write_left": 1,
+    # checkout-index and cat-file --batch
+    "write_right": 2,
+    # hash-object --stdin-paths and update-index, plus rev-parse and
+    # pack-objects when at least PACK_OBJECTS_THRESHOLD files were edited
+    "apply": 4,
+}
+
+# Most time importing git_meld_index should take, in microseconds, as
+# reported by python -X importtime.  Timings vary between machines, so the
+# tests allow IMPORT_TIME_TEST_FACTOR times as long: enough to catch a large
+# regression (such as a heavy module being imported eagerly) without
+# failing on a slow or busy machine.
+IMPORT_TIME_BUDGET_US = 150000
+IMPORT_TIME_TEST_FACTOR = 5
+
+# Modules only some runs need, which importing git_meld_index must not import
+LAZY_MODULES = [
+    "argparse", "asyncio", "concurrent.futures", "cProfile", "hashlib", "json",
+    "logging", "resource", "shlex", "shutil", "socket", "ssl", "tempfile"]
+
+FILES_PER_DIR = 100
+
+
+@dataclass
+class RepoShape:
+    tracked: int = 1000
+    modified: int = 100
+    staged: int = 50
+    untracked: int = 50
+    symlinks: int = 10
+    executables: int = 10
+    large_files: int = 2
+    large_file_size: int = 1024 * 1024
+    # files edited in the index view before it is applied
+    edited: int = 10
+
+
+def _tracked_files(shape):
+    """Return a list of (path, mode, content) for tracked files."""
+    rng = random.Random(0)
+    kinds = (["120000"] * shape.symlinks + ["100755"] * shape.executables +
+             ["large"] * shape.large_files)
+    kinds += ["100644"] * max(0, shape.tracked - len(kinds))
+    # spread each kind of file through the tree, so that all kinds get
+    # modified and staged
+    rng.shuffle(kinds)
+    files = []
+    for index, kind in enumerate(kinds):
+        path = "dir{:04d}/file{:06d}".format(index // FILES_PER_DIR, index)
+        if kind == "120000":
+            content = "target{:06d}".format(index).encode()
+        elif kind == "large":
+            kind = "100644"
+            content = rng.randbytes(shape.large_file_size)
+        else:
+            content = "file {}\n".format(index).encode() * 10
+        files.append((path, kind, content))
+    return files
+
+
+def _fast_import_stream(files):
+    chunks = []
+    for mark, (path, mode, content) in enumerate(files, 1):
+        chunks.append(b"blob\nmark :%d\ndata %d\n" % (mark, len(content)))
+        chunks.append(content + b"\n")
+    chunks.append(b"commit refs/heads/bench\n"
+                  b"committer Bench <bench@example.com> 0 +0000\n"
+                  b"data 6\nbench\n")
+    for mark, (path, mode, content) in enumerate(files, 1):
+        chunks.append(b"M %s :%d %s\n" % (mode.encode(), mark, path.encode()))
+    return b"".join(chunks)
+
+
+def _modify(repo_path, path, mode):
+    full_path = os.path.join(repo_path, path)
+    if mode == "120000":
+        target = os.readlink(full_path)
+        os.unlink(full_path)
+        os.symlink(target + "_modified", full_path)
+    else:
+        with open(full_path, "ab") as fh:
+            fh.write(b"modified\n")
+
+
+def build_repo(repo_path, shape):
+    """Create a repository at repo_path with the given RepoShape."""
+    def git(*args, input=None):
+        subprocess.run(["git"] + list(args), cwd=repo_path, input=input,
+                       check=True, stdout=subprocess.DEVNULL)
+
+    os.makedirs(repo_path, exist_ok=True)
+    git("init", "-q")
+    files = _tracked_files(shape)
+    git("fast-import", "--quiet", input=_fast_import_stream(files))
+    git("symbolic-ref", "HEAD", "refs/heads/bench")
+    git("reset", "-q", "--hard")
+    # every stride'th file is changed: first the staged ones, then the
+    # (unstaged) modified ones
+    changed = shape.staged + shape.modified
+    stride = max(1, len(files) // max(1, changed))
+    to_change = files[::stride][:changed]
+    for path, mode, content in to_change:
+        _modify(repo_path, path, mode)
+    staged = to_change[:shape.staged]
+    if staged:
+        git("update-index", "-z", "--stdin",
+            input=b"".join(path.encode() + b"\0" for path, _, _ in staged))
+    for index in range(shape.untracked):
+        path = os.path.join(
+            repo_path, "untracked", "file{:06d}".format(index))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as fh:
+            fh.write("untracked {}\n".format(index))
+
+
+def _edit_files(dir_, count):
+    edited = 0
+    for path in sorted(git_meld_index.iter_files(dir_)):
+        if edited == count:
+            break
+        full_path = os.path.join(dir_, path)
+        os.chmod(full_path, os.stat(full_path).st_mode | 0o200)
+        with open(full_path, "ab") as fh:
+            fh.write(b"edited\n")
+        edited += 1
+
+
+def run_stages(repo_path, work_dir, shape, jobs=None):
+    """Run each stage of a session, without a diff tool.
+
+    Returns a dict mapping stage name to (seconds, processes started).
+    """
+    profile = git_meld_index.Profile()
+    env = git_meld_index.TimingWrapper.make_readable(
+        git_meld_index.BasicEnv.make_readable(), profile)
+    env = git_meld_index.PrefixCmdEnv.make_readable(
+        git_meld_index.in_dir(repo_path), env)
+    snapshots = git_meld_index.RepoSnapshots()
+    left = git_meld_index.StageableWorkingTreeSubsetView(
+        repo_path, snapshots, jobs)
+    right = git_meld_index.IndexOrHeadView(
+        repo_path, snapshots, jobs,
+        index_path=os.path.join(repo_path, ".git", "index"))
+    left_dir = os.path.join(work_dir, left.label)
+    right_dir = os.path.join(work_dir, right.label)
+    os.makedirs(left_dir)
+    os.makedirs(right_dir)
+
+    results = {}
+
+    def stage(name, func):
+        before = len(profile.records)
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+        processes = sum(
+            record.processes for record in profile.records[before:])
+        results[name] = (seconds, processes)
+
+    stage("snapshot", lambda: snapshots.get(env, repo_path))
+    stage("write_left", lambda: left.write(env, left_dir))
+    stage("write_right", lambda: right.write(env, right_dir))
+    _edit_files(right_dir, shape.edited)
+    stage("apply", lambda: right.apply(env, right_dir))
+    return results
+
+
+def import_time(runs=3):
+    """Time importing git_meld_index in a new Python process.
+
+    Returns (the least time in microseconds over runs, the names of the
+    modules imported).
+    """
+    times = []
+    for _ in range(runs):
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c",
+             "import sys, git_meld_index; print(' '.join(sys.modules))"],
+            cwd=os.path.dirname(os.path.abspath(git_meld_index.__file__)),
+            capture_output=True, text=True, check=True)
+        [line] = [line for line in process.stderr.splitlines()
+                  if line.endswith("| git_meld_index")]
+        times.append(int(line.split("|")[1]))
+    return min(times), process.stdout.split()
+
+
+def run_session(repo_path):
+    """Run a whole git meld-index session with a no-op diff tool.
+
+    Returns the --profile report.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        report_path = os.path.join(temp_dir, "profile.json")
+        subprocess.run(
+            [sys.executable, git_meld_index.__file__,
+             "--extcmd", "true", "--profile", report_path],
+            cwd=repo_path, check=True)
+        with open(report_path) as fh:
+            return json.load(fh)
+
+
+def main(prog, args):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(prog), description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    for field in dataclasses.fields(RepoShape):
+        parser.add_argument(
+            "--" + field.name.replace("_", "-"), type=int,
+            default=field.default)
+    parser.add_argument("--jobs", "-j", type=int, default=None)
+    arguments = parser.parse_args(args)
+    shape = RepoShape(**{field.name: getattr(arguments, field.name)
+                         for field in dataclasses.fields(RepoShape)})
+    microseconds, _ = import_time()
+    over_budget = microseconds > IMPORT_TIME_BUDGET_US
+    print("{:12} {:8.3f}s (budget {:.3f}s){}".format(
+        "import", microseconds / 10**6, IMPORT_TIME_BUDGET_US / 10**6,
+        " OVER BUDGET" if over_budget else ""))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        repo_path = os.path.join(temp_dir, "repo")
+        start = time.perf_counter()
+        build_repo(repo_path, shape)
+        print("built repository in {:.2f}s: {}".format(
+            time.perf_counter() - start, shape))
+        work_dir = os.path.join(temp_dir, "work")
+        results = run_stages(repo_path, work_dir, shape, arguments.jobs)
+        for name, (seconds, processes) in results.items():
+            print("{:12} {:8.3f}s {:6d} processes (budget {})".format(
+                name, seconds, processes, PROCESS_BUDGETS[name]))
+        # the views made files read-only
+        subprocess.run(["chmod", "-R", "u+w", work_dir], check=True)
+        report = run_session(repo_path)
+        print("{:12} {:8.3f}s {:6d} processes".format(
+            "session", report["wall_seconds"], report["processes"]))
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[0], sys.argv[1:]))
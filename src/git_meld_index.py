@@ -5,26 +5,40 @@ area) using any git difftool (such as meld).
 # release.py updates this version, and pyproject.toml says to read it at build time
 __version__ = "0.0.0"
 
+# Only modules needed to define this module's classes, or cheap to import,
+# are imported here.  Others (argparse, asyncio, concurrent.futures,
+# cProfile, hashlib, json, logging, resource, shlex, shutil, socket and
+# tempfile) are imported where they are used, so that a run only pays for
+# what it needs: see TestStartupTime.
 from dataclasses import dataclass
-import argparse
+import dataclasses
+import array
 import atexit
+import bisect
+import contextlib
+import contextvars
+import errno
+import fnmatch
 import functools
 import itertools
-import logging
+import mmap
 import os
-import pprint
-import shlex
-import shutil
+import select
+import stat as stat_module
+import struct
 import subprocess
 import sys
-import tempfile
+import threading
+import time
 
 
 # This module exports no public API
 __all__ = []
 
 
-log = logging.getLogger()
+def _log():
+    import logging
+    return logging.getLogger()
 
 
 class UnknownURISchemeError(ValueError):
@@ -32,6 +46,11 @@ class UnknownURISchemeError(ValueError):
     pass
 
 
+class PathspecError(ValueError):
+
+    pass
+
+
 class CalledProcessError(subprocess.CalledProcessError):
     def __init__(self, returncode, cmd, output=None, stderr_output=None):
         subprocess.CalledProcessError.__init__(self, returncode, cmd, output)
@@ -47,8 +66,91 @@ stderr:
 """ % (self.cmd, self.returncode, self.output, self.stderr_output)
 
 
+@dataclass
+class Command:
+
+    """A program to run, and how to run it.
+
+    Envs accept either one of these or a plain argv list.  A Command may also
+    be used as a prefix for PrefixCmdEnv, in which case its fields apply to
+    every command run through that env.
+
+    Attributes:
+        argv (list): program and arguments
+        cwd (str): directory to run in.  A relative path is relative to any
+          cwd applied by an enclosing prefix (or else to our own cwd).
+        env (dict): environment variables to set, overriding those inherited
+        stdin (str): path of a file to read stdin from, if no input is given
+        stdout (str): path of a file to write stdout to, rather than reading
+          it (.stdout_output is then None)
+    """
+
+    argv: list
+    cwd: str = None
+    env: dict = dataclasses.field(default_factory=dict)
+    stdin: str = None
+    stdout: str = None
+
+    def prefixed(self, prefix):
+        """Return this command as run in the context of prefix (a Command)."""
+        cwd = prefix.cwd
+        if self.cwd is not None:
+            cwd = self.cwd if cwd is None else os.path.join(cwd, self.cwd)
+        return Command(
+            prefix.argv + self.argv, cwd, {**prefix.env, **self.env},
+            self.stdin if self.stdin is not None else prefix.stdin,
+            self.stdout if self.stdout is not None else prefix.stdout)
+
+    def __str__(self):
+        import shlex
+        parts = []
+        if self.cwd is not None:
+            parts += ["cd", shlex.quote(self.cwd), "&&"]
+        parts += [shlex.quote("{}={}".format(name, value))
+                  for name, value in self.env.items()]
+        parts.append(shell_escape(self.argv))
+        if self.stdin is not None:
+            parts += ["<", shlex.quote(self.stdin)]
+        if self.stdout is not None:
+            parts += [">", shlex.quote(self.stdout)]
+        return " ".join(parts)
+
+
+def as_command(args):
+    if isinstance(args, Command):
+        return args
+    return Command(list(args))
+
+
 def in_dir(dir_path):
-    return ["sh", "-c", 'cd "$1" && shift && exec "$@"', "inline_cd", dir_path]
+    return Command([], cwd=dir_path)
+
+
+def with_env(**variables):
+    return Command([], env=variables)
+
+
+@contextlib.contextmanager
+def _redirections(command):
+    """Yield (stdin, stdout) files for command's redirections (or None)."""
+    with contextlib.ExitStack() as stack:
+        stdin = stdout = None
+        # like a shell's redirections, relative to the command's cwd
+        cwd = command.cwd or ""
+        if command.stdin is not None:
+            stdin = stack.enter_context(
+                open(os.path.join(cwd, command.stdin), "rb"))
+        if command.stdout is not None:
+            stdout = stack.enter_context(
+                open(os.path.join(cwd, command.stdout), "wb"))
+        yield stdin, stdout
+
+
+def _popen_kwargs(command):
+    kwargs = dict(cwd=command.cwd)
+    if command.env:
+        kwargs["env"] = {**os.environ, **command.env}
+    return kwargs
 
 
 def try_cmd(env, args):
@@ -69,35 +171,198 @@ class BasicEnv:
         """Run a program, read its output and wait for it to exit.
 
         Args:
+            args (list or Command): program to run
             input (bytes): data to send to program's stdin
             tty (bool): program requires a tty to run correctly (e.g. vimdiff).
               In this case, input is ignored and output is not read.
         """
-        if tty:
-            process = subprocess.Popen(args)
-            process.wait()
-        else:
-            if input is not None:
-                stdin = subprocess.PIPE
+        command = as_command(args)
+        kwargs = _popen_kwargs(command)
+        with _redirections(command) as (stdin_file, stdout_file):
+            if tty:
+                process = subprocess.Popen(
+                    command.argv, stdin=stdin_file, stdout=stdout_file,
+                    **kwargs)
+                process.wait()
             else:
-                stdin = None
-            process = subprocess.Popen(
-                args,
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=stdin)
-            output, stderr_output = process.communicate(input)
-            retcode = process.poll()
-            if retcode:
-                raise CalledProcessError(retcode, args, output, stderr_output)
-            process.stdout_output = output
-            process.stderr_output = stderr_output
+                if input is not None:
+                    stdin = subprocess.PIPE
+                else:
+                    stdin = stdin_file
+                process = subprocess.Popen(
+                    command.argv,
+                    stdout=stdout_file or subprocess.PIPE,
+                    stderr=subprocess.PIPE, stdin=stdin, **kwargs)
+                output, stderr_output = process.communicate(input)
+                retcode = process.poll()
+                if retcode:
+                    raise CalledProcessError(
+                        retcode, command, output, stderr_output)
+                process.stdout_output = output
+                process.stderr_output = stderr_output
         return process
 
+    def popen(self, args):
+        """Start a long-running program, without waiting for it to exit.
+
+        The caller talks to the program through the returned process's stdin
+        and stdout pipes, and is responsible for closing stdin and waiting for
+        it.  This is intended for git's --batch style commands, so that one
+        process can serve many requests.  Redirections are not supported.
+        """
+        command = as_command(args)
+        return subprocess.Popen(
+            command.argv,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            stdin=subprocess.PIPE, **_popen_kwargs(command))
+
+    def call(self, args, func, *func_args):
+        """Do some work in-process, rather than by running a program.
+
+        Args:
+            args (list): a command line equivalent to calling func, used only
+              to describe the work (e.g. by --verbose).  Paths in func_args
+              should be absolute, since no prefix command is applied.
+            func (callable): called with func_args to do the work
+        """
+        return func(*func_args)
+
     @classmethod
     def make_readable(cls):
         env = cls()
         return ReadableEnv(env, env)
 
 
+class AsyncBasicEnv:
+
+    """An environment in which to run programs concurrently, using asyncio.
+
+    This is like BasicEnv, except that its methods return awaitables, and at
+    most max_processes programs run via .cmd() at once (others wait their
+    turn).  The env wrappers (ReadableEnv, PrefixCmdEnv, VerboseWrapper,
+    NullWrapper, TimingWrapper) pass through whatever the env they wrap
+    returns, so they compose with this in the same way as with BasicEnv.
+    SyncEnv runs its commands for synchronous callers.
+    """
+
+    def __init__(self, max_processes=None):
+        if max_processes is None:
+            max_processes = default_jobs()
+        self._max_processes = max_processes
+        self._semaphores = None
+
+    def _semaphore(self):
+        import asyncio
+        import weakref
+        # a semaphore may only be used with one event loop, and must not
+        # keep loops that are finished with alive
+        if self._semaphores is None:
+            self._semaphores = weakref.WeakKeyDictionary()
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self._max_processes)
+        return self._semaphores[loop]
+
+    async def cmd(self, args, input=None, tty=False):
+        """Run a program, as for BasicEnv.cmd()."""
+        import asyncio
+        command = as_command(args)
+        kwargs = _popen_kwargs(command)
+        async with self._semaphore():
+            with _redirections(command) as (stdin_file, stdout_file):
+                if tty:
+                    process = await asyncio.create_subprocess_exec(
+                        *command.argv, stdin=stdin_file, stdout=stdout_file,
+                        **kwargs)
+                    await process.wait()
+                else:
+                    if input is not None:
+                        stdin = subprocess.PIPE
+                    else:
+                        stdin = stdin_file
+                    process = await asyncio.create_subprocess_exec(
+                        *command.argv,
+                        stdout=stdout_file or subprocess.PIPE,
+                        stderr=subprocess.PIPE, stdin=stdin, **kwargs)
+                    output, stderr_output = await process.communicate(input)
+                    retcode = process.returncode
+                    if retcode:
+                        raise CalledProcessError(
+                            retcode, command, output, stderr_output)
+                    process.stdout_output = output
+                    process.stderr_output = stderr_output
+        return process
+
+    async def popen(self, args):
+        """Start a long-running program, as for BasicEnv.popen().
+
+        These programs do not count towards max_processes.
+        """
+        import asyncio
+        command = as_command(args)
+        return await asyncio.create_subprocess_exec(
+            *command.argv,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            stdin=subprocess.PIPE, **_popen_kwargs(command))
+
+    async def call(self, args, func, *func_args):
+        """Do some work in-process, as for BasicEnv.call(), in a thread."""
+        import asyncio
+        return await asyncio.to_thread(func, *func_args)
+
+    @classmethod
+    def make_readable(cls, max_processes=None):
+        env = cls(max_processes)
+        return ReadableEnv(env, env)
+
+
+class SyncEnv(BasicEnv):
+
+    """A synchronous facade over an AsyncBasicEnv, for existing callers.
+
+    .cmd() runs the async env's .cmd() on an event loop in a background
+    thread, and waits for it.  It may be called from any thread, and the
+    async env's limit on concurrent processes applies across all of them.
+    .popen() and .call() are as for BasicEnv, since their callers use the
+    process's pipes, or do the work, in the calling thread.
+    """
+
+    def __init__(self, async_env):
+        self._async_env = async_env
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                import asyncio
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def cmd(self, args, input=None, tty=False):
+        import asyncio
+        return asyncio.run_coroutine_threadsafe(
+            self._async_env.cmd(args, input, tty), self._get_loop()).result()
+
+    def close(self):
+        """Stop the event loop, once no commands are running."""
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            self._thread.join()
+            loop.close()
+
+    @classmethod
+    def make_readable(cls, async_env):
+        env = cls(async_env)
+        return ReadableEnv(env, env)
+
+
 class ReadableEnv:
 
     """An env that supports .read_cmd
@@ -119,6 +384,16 @@ class ReadableEnv:
         """Run a program as for .cmd(), but for use by side effect-free commands."""
         return self._read_env.cmd(args, input, tty)
 
+    def popen(self, args):
+        return self._env.popen(args)
+
+    def read_popen(self, args):
+        """Start a program as for .popen(), for side effect-free programs."""
+        return self._read_env.popen(args)
+
+    def call(self, args, func, *func_args):
+        return self._env.call(args, func, *func_args)
+
     def wrap(self, wrapper):
         """Return a ReadableEnv wrapped with given wrapper.
 
@@ -132,189 +407,2608 @@ class ReadableEnv:
 
 class PrefixCmdEnv:
 
-    def __init__(self, prefix_cmd, env):
-        self._prefix_cmd = prefix_cmd
-        self._env = env
+    """Runs commands in the context of a prefix.
+
+    The prefix is a Command (e.g. from in_dir() or with_env()) whose cwd, env
+    and argv apply to every command, or an argv list to put in front of each
+    command's argv.
+    """
+
+    def __init__(self, prefix_cmd, env):
+        self._prefix_cmd = as_command(prefix_cmd)
+        self._env = env
+
+    def cmd(self, args, input=None, tty=False):
+        return self._env.cmd(
+            as_command(args).prefixed(self._prefix_cmd), input, tty)
+
+    def popen(self, args):
+        return self._env.popen(as_command(args).prefixed(self._prefix_cmd))
+
+    def call(self, args, func, *func_args):
+        return self._env.call(args, func, *func_args)
+
+    @classmethod
+    def make_readable(cls, prefix_cmd, readable_env):
+        return readable_env.wrap(functools.partial(cls, prefix_cmd))
+
+
+class VerboseWrapper:
+
+    def __init__(self, env):
+        self._env = env
+
+    def cmd(self, args, input=None, tty=False):
+        if input is not None:
+            print("input:")
+            print(input)
+        print(as_command(args))
+        return self._env.cmd(args, input, tty)
+
+    def popen(self, args):
+        print(as_command(args))
+        return self._env.popen(args)
+
+    def call(self, args, func, *func_args):
+        print(as_command(args))
+        return self._env.call(args, func, *func_args)
+
+    @classmethod
+    def make_readable(cls, readable_env):
+        return readable_env.wrap(cls)
+
+
+def _do_nothing():
+    pass
+
+
+class NullWrapper:
+
+    def __init__(self, env):
+        self._env = env
+
+    def cmd(self, args, input=None, tty=False):
+        return self._env.cmd(["true"])
+
+    def popen(self, args):
+        return self._env.popen(["true"])
+
+    def call(self, args, func, *func_args):
+        # through the env, so that an async env returns an awaitable; the
+        # result is None, as callers expect under --pretend
+        return self._env.call(["true"], _do_nothing)
+
+    @classmethod
+    def make_readable(cls, readable_env):
+        return ReadableEnv(env=NullWrapper(readable_env), read_env=readable_env)
+
+
+_current_phase = contextvars.ContextVar("phase", default=None)
+_phase_timer = contextvars.ContextVar("phase_timer", default=None)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Tag work done in this context as being part of the named phase.
+
+    This is for --profile.  Phases may nest: commands are tagged with the
+    innermost phase.  parallel_map() passes the phase on to its threads.
+    """
+    token = _current_phase.set(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _current_phase.reset(token)
+        timer = _phase_timer.get()
+        if timer is not None:
+            timer(name, time.perf_counter() - start)
+
+
+@dataclass
+class CommandRecord:
+    kind: str
+    args: list
+    phase: str
+    seconds: float
+    exit_status: int
+    processes: int
+    stdin_bytes: int
+    stdout_bytes: int
+    stderr_bytes: int
+
+
+def _len_or_none(data):
+    return None if data is None else len(data)
+
+
+class Profile:
+
+    """Collects the timings reported by --profile.
+
+    Commands are recorded by TimingWrapper, and phase timings by phase()
+    (once .start() has been called in the context in question).
+    """
+
+    # number of slowest commands to report
+    top_n = 20
+
+    def __init__(self, cprofile_path=None):
+        self.records = []
+        self.notes = {}
+        self._phase_seconds = {}
+        # commands and phases may finish in several threads at once
+        self._lock = threading.Lock()
+        self._cprofile_path = cprofile_path
+        self._cprofile = None
+
+    def start(self):
+        self._start = time.perf_counter()
+        self._start_cpu = time.process_time()
+        _phase_timer.set(self._add_phase_time)
+        if self._cprofile_path is not None:
+            # note this only profiles the main thread
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def _add_phase_time(self, name, seconds):
+        with self._lock:
+            self._phase_seconds[name] = (
+                self._phase_seconds.get(name, 0) + seconds)
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def note(self, name, value):
+        """Record a fact about the session (e.g. whether a cache was used)."""
+        with self._lock:
+            self.notes[name] = value
+
+    def report(self):
+        with self._lock:
+            phase_seconds = dict(self._phase_seconds)
+            records = list(self.records)
+            notes = dict(self.notes)
+        phases = {}
+        for name, seconds in phase_seconds.items():
+            phases[name] = dict(
+                wall_seconds=seconds, commands=0, processes=0,
+                command_seconds=0, stdin_bytes=0, stdout_bytes=0,
+                stderr_bytes=0)
+        for record in records:
+            totals = phases.setdefault(record.phase, dict(
+                wall_seconds=None, commands=0, processes=0,
+                command_seconds=0, stdin_bytes=0, stdout_bytes=0,
+                stderr_bytes=0))
+            totals["commands"] += 1
+            totals["processes"] += record.processes
+            totals["command_seconds"] += record.seconds
+            for name in ["stdin_bytes", "stdout_bytes", "stderr_bytes"]:
+                totals[name] += getattr(record, name) or 0
+        slowest = sorted(
+            records, key=lambda record: record.seconds, reverse=True)
+        import resource
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        # ru_maxrss is in kilobytes on Linux, but bytes on macOS
+        rss_scale = 1 if sys.platform == "darwin" else 1024
+        return dict(
+            wall_seconds=time.perf_counter() - self._start,
+            python_cpu_seconds=time.process_time() - self._start_cpu,
+            children_cpu_seconds=(
+                children_usage.ru_utime + children_usage.ru_stime),
+            peak_rss_bytes=self_usage.ru_maxrss * rss_scale,
+            processes=sum(record.processes for record in records),
+            phases={name or "other": totals
+                    for name, totals in phases.items()},
+            slowest_commands=[
+                dataclasses.asdict(record)
+                for record in slowest[:self.top_n]],
+            notes=notes,
+        )
+
+    def write(self, path):
+        import json
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self._cprofile_path)
+        with open(path, "w") as fh:
+            json.dump(self.report(), fh, indent=2)
+            fh.write("\n")
+
+
+class _CountingStream:
+
+    """Wraps a process's pipe, counting the bytes that pass through it."""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.count = 0
+
+    def _counted(self, data):
+        self.count += len(data)
+        return data
+
+    def read(self, *args):
+        return self._counted(self._stream.read(*args))
+
+    def read1(self, *args):
+        return self._counted(self._stream.read1(*args))
+
+    def readline(self, *args):
+        return self._counted(self._stream.readline(*args))
+
+    def write(self, data):
+        self.count += len(data)
+        return self._stream.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class _TimedProcess:
+
+    """A process started by TimingWrapper.popen().
+
+    Its record is completed (with the time until it exited, its exit status
+    and the bytes passed through its pipes) once it is seen to have exited.
+    """
+
+    def __init__(self, process, record, start):
+        self._process = process
+        self._record = record
+        self._start = start
+        self._extra_bytes = [0, 0, 0]
+        self.stdin, self.stdout, self.stderr = [
+            None if stream is None else _CountingStream(stream)
+            for stream in [process.stdin, process.stdout, process.stderr]]
+
+    def _check_finished(self):
+        if self._process.returncode is None or self._record is None:
+            return
+        record, self._record = self._record, None
+        record.seconds = time.perf_counter() - self._start
+        record.exit_status = self._process.returncode
+        record.stdin_bytes, record.stdout_bytes, record.stderr_bytes = [
+            extra + (0 if stream is None else stream.count)
+            for extra, stream in zip(
+                self._extra_bytes, [self.stdin, self.stdout, self.stderr])]
+
+    @property
+    def returncode(self):
+        return self._process.returncode
+
+    def poll(self):
+        returncode = self._process.poll()
+        self._check_finished()
+        return returncode
+
+    def wait(self, timeout=None):
+        returncode = self._process.wait(timeout)
+        self._check_finished()
+        return returncode
+
+    def communicate(self, input=None, timeout=None):
+        output, stderr_output = self._process.communicate(input, timeout)
+        for index, data in enumerate([input, output, stderr_output]):
+            self._extra_bytes[index] += _len_or_none(data) or 0
+        self._check_finished()
+        return output, stderr_output
+
+    def __getattr__(self, name):
+        return getattr(self._process, name)
+
+
+def _is_awaitable(value):
+    # without importing inspect or asyncio, which synchronous runs don't need
+    return hasattr(type(value), "__await__")
+
+
+class TimingWrapper:
+
+    """Records each command run, with how long it took, in a Profile."""
+
+    def __init__(self, env, profile):
+        self._env = env
+        self._profile = profile
+
+    def _record(self, kind, args, start, exit_status=0, processes=1,
+                input=None, process=None):
+        self._profile.add(CommandRecord(
+            kind, list(as_command(args).argv), _current_phase.get(),
+            time.perf_counter() - start, exit_status, processes,
+            _len_or_none(input),
+            _len_or_none(getattr(process, "stdout_output", None)),
+            _len_or_none(getattr(process, "stderr_output", None))))
+
+    def _time(self, kind, args, call, processes=1, input=None):
+        start = time.perf_counter()
+        try:
+            result = call()
+        except CalledProcessError as exc:
+            self._record(kind, args, start, exc.returncode, processes, input)
+            raise
+        if _is_awaitable(result):
+            return self._time_awaitable(
+                kind, args, start, result, processes, input)
+        self._record(kind, args, start, 0, processes, input, result)
+        return result
+
+    async def _time_awaitable(self, kind, args, start, awaitable, processes,
+                              input):
+        try:
+            result = await awaitable
+        except CalledProcessError as exc:
+            self._record(kind, args, start, exc.returncode, processes, input)
+            raise
+        self._record(kind, args, start, 0, processes, input, result)
+        return result
+
+    def cmd(self, args, input=None, tty=False):
+        return self._time(
+            "cmd", args, lambda: self._env.cmd(args, input, tty), input=input)
+
+    def popen(self, args):
+        # recorded now, then completed by the process once it has exited
+        start = time.perf_counter()
+        process = self._env.popen(args)
+        if _is_awaitable(process):
+            # an async env's process: only the time to start it is recorded
+            return self._time_awaitable("popen", args, start, process, 1, None)
+        record = CommandRecord(
+            "popen", list(as_command(args).argv), _current_phase.get(),
+            time.perf_counter() - start, None, 1, None, None, None)
+        self._profile.add(record)
+        return _TimedProcess(process, record, start)
+
+    def call(self, args, func, *func_args):
+        return self._time(
+            "call", args, lambda: self._env.call(args, func, *func_args),
+            processes=0)
+
+    @classmethod
+    def make_readable(cls, readable_env, profile):
+        return readable_env.wrap(functools.partial(cls, profile=profile))
+
+
+def shell_escape(args):
+    import shlex
+    return " ".join(shlex.quote(arg) for arg in args)
+
+
+def default_jobs():
+    return os.cpu_count() or 1
+
+
+def parallel_map(func, items, jobs):
+    """Return list(map(func, items)), calling func in up to jobs threads.
+
+    If more than one call raises, the exception raised is the one for the
+    earliest item, regardless of which happened first.  All calls have
+    finished by the time this returns or raises.
+    """
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        return list(map(func, items))
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(jobs, len(items))) as executor:
+        # run each call in a copy of our context, so e.g. phase() applies
+        futures = [executor.submit(contextvars.copy_context().run, func, item)
+                   for item in items]
+        concurrent.futures.wait(futures)
+    return [future.result() for future in futures]
+
+
+def call_all(funcs, jobs):
+    """Call each of funcs (with no arguments), in parallel as for parallel_map.
+    """
+    return parallel_map(lambda func: func(), funcs, jobs)
+
+
+# from linux/inotify.h
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def _inotify_libc():
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+        raise OSError(errno.ENOSYS, "inotify is not available")
+    libc.inotify_add_watch.argtypes = [
+        ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+def _ctypes_errno():
+    import ctypes
+    return ctypes.get_errno()
+
+
+class InotifyWatcher:
+
+    """Records which files under a directory are written, using inotify.
+
+    This is Linux-only: elsewhere, constructing one raises OSError.
+    Directories created (or moved in) later are watched too.  Events are read
+    only by .poll(), so between calls they wait in the kernel's queue.  If
+    that overflows, events are lost and .take() returns None.
+    """
+
+    mask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    # events that are recorded as writing a path
+    path_events = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO
+    # names of directories that are not watched
+    skip_dirs = frozenset()
+
+    def __init__(self, dir_):
+        self._libc = _inotify_libc()
+        self._dir = os.path.abspath(dir_)
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            error = _ctypes_errno()
+            raise OSError(error, os.strerror(error))
+        self._fd = fd
+        # watch descriptor: directory path, relative to dir_
+        self._watches = {}
+        self._paths = set()
+        self._lost = False
+        self.last_event_time = None
+        try:
+            self._add_tree(self._dir)
+        except OSError:
+            self.close()
+            raise
+
+    def _add_tree(self, dir_path):
+        for dir_path, dir_names, file_names in os.walk(dir_path):
+            dir_names[:] = [name for name in dir_names
+                            if name not in self.skip_dirs]
+            self._add_watch(dir_path)
+
+    def _add_watch(self, dir_path):
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(dir_path), self.mask)
+        if wd < 0:
+            # e.g. ENOSPC: out of watches (fs.inotify.max_user_watches)
+            error = _ctypes_errno()
+            raise OSError(error, os.strerror(error), dir_path)
+        self._watches[wd] = os.path.relpath(dir_path, self._dir)
+
+    def _add_dir(self, path):
+        # files may have been created in a new directory before we watched it
+        if os.path.basename(path) in self.skip_dirs:
+            return
+        dir_path = os.path.join(self._dir, path)
+        self._add_tree(dir_path)
+        for file_path in iter_files(dir_path):
+            self._paths.add(os.path.normpath(os.path.join(path, file_path)))
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self._lost = True
+            return
+        if mask & IN_IGNORED:
+            # the directory was removed
+            self._watches.pop(wd, None)
+            return
+        dir_path = self._watches.get(wd)
+        if dir_path is None:
+            return
+        path = os.path.normpath(os.path.join(dir_path, os.fsdecode(name)))
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    self._add_dir(path)
+                except FileNotFoundError:
+                    # already removed again
+                    pass
+                except OSError:
+                    self._lost = True
+            elif mask & (IN_DELETE | IN_MOVED_FROM) & self.path_events:
+                self._paths.add(path)
+        elif mask & self.path_events:
+            self._paths.add(path)
+
+    def poll(self, timeout=0):
+        """Read events, waiting up to timeout seconds for the first.
+
+        Returns True if there were any.
+        """
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return False
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _INOTIFY_EVENT.unpack_from(
+                    data, offset)
+                offset += _INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                self._handle(wd, mask, name)
+        self.last_event_time = time.monotonic()
+        return True
+
+    def take(self):
+        """Return the paths written since the last call, and forget them.
+
+        Paths are relative to the directory.  Returns None if events were
+        lost, in which case any file may have been written.
+        """
+        if self._lost:
+            self._lost = False
+            self._paths = set()
+            return None
+        paths, self._paths = self._paths, set()
+        return paths
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class TreeWatcher(InotifyWatcher):
+
+    """Records changes of any kind under a working tree, outside .git."""
+
+    mask = InotifyWatcher.mask | IN_MODIFY | IN_DELETE | IN_MOVED_FROM
+    path_events = (InotifyWatcher.path_events | IN_MODIFY | IN_DELETE |
+                   IN_MOVED_FROM)
+    skip_dirs = frozenset([".git"])
+
+
+# seconds without any files being written before they are staged, with
+# --live
+LIVE_STAGING_DELAY = 0.5
+
+
+class _EventsLost(Exception):
+    pass
+
+
+class LiveStager:
+
+    """Applies a view's edits while the diff tool is still running.
+
+    Files written in dir_ (as recorded by an InotifyWatcher) are applied once
+    no more have been written for LIVE_STAGING_DELAY seconds.  Failures (e.g.
+    because another git command has the index locked, or a file was removed
+    while being read) are reported on stderr, and the files are tried again
+    later.
+    """
+
+    def __init__(self, env, view, dir_, watcher):
+        self._env = env
+        self._view = view
+        self._dir = dir_
+        self._watcher = watcher
+        self._pending = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _stage(self):
+        paths = self._watcher.take()
+        if paths is None:
+            # events were lost: only a full apply at the end will do
+            raise _EventsLost()
+        self._pending |= paths
+        if not self._pending:
+            return
+        try:
+            self._view.apply(self._env, self._dir, self._pending)
+        except (CalledProcessError, OSError) as exc:
+            print("git-meld-index: staging failed, will retry: {}".format(
+                exc), file=sys.stderr)
+        else:
+            self._pending = set()
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                if not self._watcher.poll(LIVE_STAGING_DELAY):
+                    self._stage()
+        except _EventsLost:
+            self._pending = None
+
+    def start(self):
+        context = contextvars.copy_context()
+        self._thread = threading.Thread(
+            target=context.run, args=(self._run,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop, returning the paths still to be applied (None for all)."""
+        self._stop.set()
+        self._thread.join()
+        if self._pending is None:
+            return None
+        self._watcher.poll(0)
+        paths = self._watcher.take()
+        if paths is None:
+            return None
+        return self._pending | paths
+
+
+class WorkArea:
+
+    def __init__(self, env, work_dir, jobs=None, persistent=False,
+                 watch=False, live=False):
+        """
+        Args:
+            persistent (bool): reuse files written to work_dir by an earlier
+              session, updating only what has changed since
+            watch (bool): record which files are written while the tool
+              runs (if the platform supports it), so that only those are
+              applied
+            live (bool): with watch, also apply files as they are written,
+              rather than only once the tool exits
+        """
+        self._env = env
+        self._work_dir = work_dir
+        if jobs is None:
+            jobs = default_jobs()
+        self._jobs = jobs
+        self._persistent = persistent
+        self._watch = watch or live
+        self._live = live
+
+    def _write(self, view):
+        suggested_dir = os.path.join(self._work_dir, view.label)
+        self._env.cmd(["mkdir", "-p", suggested_dir])
+        if self._persistent:
+            state_path = os.path.join(
+                self._work_dir, view.label + ".state.json")
+            dir_ = view.write(self._env, suggested_dir, state_path=state_path)
+        else:
+            dir_ = view.write(self._env, suggested_dir)
+        if dir_ is None:
+            dir_ = suggested_dir
+        return dir_
+
+    def _meld(self, left_dir, right_dir, tool, extcmd):
+        # usually working tree on left, index on right
+        env = PrefixCmdEnv.make_readable(in_dir(self._work_dir), self._env)
+        if tool:
+            env = PrefixCmdEnv.make_readable(
+                with_env(GIT_DIFF_TOOL=tool), env)
+        cmd = extcmd if extcmd is not None else "git-meld-index-run-merge-tool"
+        env.cmd([cmd, left_dir, right_dir], tty=True)
+
+    def _apply(self, view, dir_, paths=None):
+        view.apply(self._env, dir_, paths)
+
+    def _make_watcher(self, dir_):
+        if not self._watch:
+            return None
+        try:
+            return InotifyWatcher(dir_)
+        except OSError as exc:
+            print("git-meld-index: not watching for edits: {}".format(exc),
+                  file=sys.stderr)
+            return None
+
+    def _write_in_phase(self, name, view):
+        with phase(name):
+            return self._write(view)
+
+    def write(self, left_view, right_view):
+        """Write both views, returning their directories."""
+        # the views are written to separate directories, so can be written
+        # at the same time
+        left_dir, right_dir = call_all(
+            [functools.partial(self._write_in_phase, "write-left", left_view),
+             functools.partial(self._write_in_phase, "write-right", right_view)],
+            min(self._jobs, 2))
+        return left_dir, right_dir
+
+    def run_tool(self, left_dir, right_dir, tool=None, extcmd=None,
+                 right_view=None):
+        """Run the diff tool on the written views.
+
+        Returns the paths in right_dir written meanwhile that are still to be
+        applied, or None if they are not known (i.e. all must be checked).
+        right_view is required for live staging.
+        """
+        watcher = self._make_watcher(right_dir)
+        stager = None
+        if watcher is not None and self._live:
+            stager = LiveStager(self._env, right_view, right_dir, watcher)
+            stager.start()
+        try:
+            with phase("tool"):
+                self._meld(left_dir, right_dir, tool, extcmd)
+        finally:
+            if stager is not None:
+                paths = stager.stop()
+            elif watcher is not None:
+                watcher.poll(0)
+                paths = watcher.take()
+            else:
+                paths = None
+            if watcher is not None:
+                watcher.close()
+        return paths
+
+    def apply(self, left_view, right_view, left_dir, right_dir, paths=None):
+        """Apply both views, as written by .write() (paths as for
+        .run_tool()).
+        """
+        with phase("apply"):
+            self._apply(left_view, left_dir)
+            self._apply(right_view, right_dir, paths)
+
+    def meld(self, left_view, right_view, tool=None, extcmd=None):
+        left_dir, right_dir = self.write(left_view, right_view)
+        paths = self.run_tool(left_dir, right_dir, tool, extcmd, right_view)
+        self.apply(left_view, right_view, left_dir, right_dir, paths)
+
+
+@dataclass
+class DiffRecord:
+    mode_after: str
+    mode_before: str
+    hash_after: str
+    hash_before: str
+    status: str
+    path: str
+
+
+def pairwise(iterable):
+    iter_ = iter(iterable)
+    return zip(iter_, iter_)
+
+
+def parse_raw_diff(diff, path):
+    mode_after, mode_before, hash_after, hash_before, status = diff.split(" ")
+    mode_after = mode_after.removeprefix(":")
+    return DiffRecord(
+        mode_after, mode_before, hash_after, hash_before, status, path)
+
+
+def iter_nul_fields(stream, chunk_size=64 * 1024):
+    """Generate the NUL-terminated fields (bytes) read from binary stream.
+
+    Each field is generated as soon as it has been read in full, so only one
+    chunk (or one field, if longer) need be held in memory at once.
+    """
+    pending = b""
+    while True:
+        chunk = stream.read1(chunk_size)
+        if not chunk:
+            break
+        fields = (pending + chunk).split(b"\0")
+        pending = fields.pop()
+        yield from fields
+    if pending:
+        raise ValueError("output ended with an unterminated field")
+
+
+def _read_into(stream, chunks):
+    try:
+        chunks.append(stream.read())
+    finally:
+        stream.close()
+
+
+def iter_cmd_fields(repo_env, cmd):
+    """Run side effect-free cmd, generating its NUL-terminated output fields.
+
+    Fields are generated while cmd is still running.  Raises
+    CalledProcessError once the output is exhausted if cmd failed.
+    """
+    process = repo_env.read_popen(cmd)
+    # cmd gets no input: close its stdin now, so that a cmd which reads it
+    # sees end of file rather than waiting for us
+    process.stdin.close()
+    # read stderr as it comes, since cmd would block (and so never finish
+    # its output) if it filled the pipe while we only read stdout
+    stderr_chunks = []
+    stderr_reader = threading.Thread(
+        target=_read_into, args=(process.stderr, stderr_chunks), daemon=True)
+    stderr_reader.start()
+    finished = False
+    try:
+        yield from iter_nul_fields(process.stdout)
+        finished = True
+    finally:
+        if not finished:
+            # we stopped reading early (or failed): don't wait for the rest
+            process.kill()
+        process.stdout.close()
+        process.wait()
+    stderr_reader.join()
+    if process.returncode:
+        raise CalledProcessError(
+            process.returncode, cmd, b"", b"".join(stderr_chunks))
+
+
+def iter_diff_records(repo_env, cmd):
+    """Generate a DiffRecord per path output by cmd (e.g. git diff-index -z).
+
+    Records are generated as git outputs them.  Paths are decoded with
+    os.fsdecode(), so that any file name round-trips through os.fsencode().
+    """
+    for diff, path in pairwise(iter_cmd_fields(repo_env, cmd)):
+        yield parse_raw_diff(diff.decode("ascii"), os.fsdecode(path))
+
+
+def iter_diff_records_undeleted(repo_env, cmd):
+    for diff in iter_diff_records(repo_env, cmd):
+        if diff.status != "D":
+            yield diff
+
+
+@dataclass
+class Pathspec:
+    # relative to the top level of the repository
+    pattern: str
+    exclude: bool = False
+
+    def git_arg(self):
+        magic = "top,exclude" if self.exclude else "top"
+        return ":({}){}".format(magic, self.pattern)
+
+    def matches(self, path):
+        """Match path as git does by default (without :(glob) magic): as a
+        leading directory, or as a wildcard pattern where * matches /.
+        """
+        pattern = self.pattern.rstrip("/")
+        if pattern == "" or path == pattern or path.startswith(pattern + "/"):
+            return True
+        return (any(char in pattern for char in "*?[") and
+                (fnmatch.fnmatchcase(path, pattern) or
+                 fnmatch.fnmatchcase(path, pattern + "/*")))
+
+
+def parse_pathspec(spec, prefix=""):
+    """Parse a command line pathspec given relative to prefix.
+
+    prefix is the current directory, relative to the top level of the
+    repository (as from git rev-parse --show-prefix).  Of git's pathspec
+    magic, only top and exclude (:/, :!, :^ and the long forms) are supported.
+    """
+    magic = set()
+    if spec.startswith(":("):
+        words, close, pattern = spec[2:].partition(")")
+        if not close:
+            raise PathspecError("unterminated pathspec magic: {}".format(spec))
+        magic.update(word.strip() for word in words.split(","))
+    elif spec.startswith(":"):
+        pattern = spec[1:]
+        short_magic = {"/": "top", "!": "exclude", "^": "exclude"}
+        while pattern[:1] in short_magic:
+            magic.add(short_magic[pattern[0]])
+            pattern = pattern[1:]
+        pattern = pattern.removeprefix(":")
+    else:
+        pattern = spec
+    unsupported = magic - {"top", "exclude"}
+    if unsupported:
+        raise PathspecError("unsupported pathspec magic: {}".format(
+            ", ".join(sorted(unsupported))))
+    if "top" not in magic:
+        pattern = os.path.normpath(os.path.join(prefix, pattern))
+        if pattern == ".":
+            pattern = ""
+        elif pattern.startswith("../"):
+            raise PathspecError("pathspec is outside repository: {}".format(
+                spec))
+    return Pathspec(pattern, exclude="exclude" in magic)
+
+
+class Pathspecs:
+
+    """A set of pathspecs limiting which paths a session operates on.
+
+    With no pathspecs, all paths match.
+    """
+
+    def __init__(self, pathspecs=()):
+        self._pathspecs = list(pathspecs)
+
+    @classmethod
+    def parse(cls, specs, prefix=""):
+        return cls(parse_pathspec(spec, prefix) for spec in specs)
+
+    def git_args(self):
+        return [pathspec.git_arg() for pathspec in self._pathspecs]
+
+    def matches(self, path):
+        includes = [spec for spec in self._pathspecs if not spec.exclude]
+        excludes = [spec for spec in self._pathspecs if spec.exclude]
+        if includes and not any(spec.matches(path) for spec in includes):
+            return False
+        return not any(spec.matches(path) for spec in excludes)
+
+
+@dataclass(slots=True)
+class StatusRecord:
+    index_status: str
+    worktree_status: str
+    mode_head: str
+    mode_index: str
+    mode_worktree: str
+    hash_head: str
+    hash_index: str
+    path: str
+
+
+class PathColumn:
+
+    """A compact sequence of paths, for sessions with very many changes.
+
+    Rather than holding a str per path, each path is stored as an index into
+    a table of interned directory names, plus its encoded base name.  Paths
+    are decoded (with os.fsdecode()) only when accessed.  Membership tests use
+    a sorted array of path hashes, built when first needed.
+    """
+
+    def __init__(self, paths=()):
+        self._dirs = []
+        self._dir_ids = {}
+        self._dir_column = array.array("I")
+        self._names = bytearray()
+        self._name_ends = array.array("Q")
+        self._lookup = None
+        for path in paths:
+            self.append(path)
+
+    def append(self, path):
+        """Append path (str, or bytes as output by git)."""
+        dir_, slash, name = os.fsencode(path).rpartition(b"/")
+        dir_id = self._dir_ids.get(dir_)
+        if dir_id is None:
+            dir_id = self._dir_ids[dir_] = len(self._dirs)
+            self._dirs.append(os.fsdecode(dir_ + slash))
+        self._dir_column.append(dir_id)
+        self._names += name
+        self._name_ends.append(len(self._names))
+        self._lookup = None
+
+    def __len__(self):
+        return len(self._name_ends)
+
+    def __getitem__(self, row):
+        if not 0 <= row < len(self):
+            raise IndexError(row)
+        start = self._name_ends[row - 1] if row else 0
+        name = os.fsdecode(bytes(self._names[start:self._name_ends[row]]))
+        return self._dirs[self._dir_column[row]] + name
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def find(self, path):
+        """Return the row at which path is stored, or None."""
+        if self._lookup is None:
+            hashes = array.array("q", map(hash, self))
+            rows = sorted(range(len(self)), key=hashes.__getitem__)
+            self._lookup = (array.array("q", (hashes[row] for row in rows)),
+                            array.array("I", rows))
+        keys, rows = self._lookup
+        key = hash(path)
+        index = bisect.bisect_left(keys, key)
+        while index < len(keys) and keys[index] == key:
+            if self[rows[index]] == path:
+                return rows[index]
+            index += 1
+        return None
+
+    def __contains__(self, path):
+        return self.find(path) is not None
+
+
+class ChangeSet:
+
+    """A compact sequence of StatusRecords.
+
+    Fields are stored in columns: paths in a PathColumn, statuses as one byte
+    each, modes as indices into a table of the (few) distinct modes, and
+    hashes as binary object names.  StatusRecords are made only when rows are
+    accessed, and statuses can be examined without making them at all.
+    """
+
+    def __init__(self):
+        self.paths = PathColumn()
+        self._statuses = bytearray()
+        self._modes = array.array("B")
+        self._mode_table = []
+        self._mode_ids = {}
+        self._hashes = bytearray()
+        self._hash_size = None
+
+    def _mode_id(self, mode):
+        mode_id = self._mode_ids.get(mode)
+        if mode_id is None:
+            mode_id = self._mode_ids[mode] = len(self._mode_table)
+            self._mode_table.append(mode)
+        return mode_id
+
+    def append(self, index_status, worktree_status, mode_head, mode_index,
+               mode_worktree, hash_head, hash_index, path):
+        """Append a row, given the fields of a StatusRecord.
+
+        hash_index may be None only if mode_index is None too.
+        """
+        if self._hash_size is None:
+            self._hash_size = len(hash_head) // 2
+        self.paths.append(path)
+        self._statuses += (index_status + worktree_status).encode("ascii")
+        self._modes.extend(
+            self._mode_id(mode)
+            for mode in (mode_head, mode_index, mode_worktree))
+        self._hashes += bytes.fromhex(hash_head)
+        if hash_index is None:
+            self._hashes += bytes(self._hash_size)
+        else:
+            self._hashes += bytes.fromhex(hash_index)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def statuses(self, row):
+        """Return (index_status, worktree_status) for row."""
+        return (chr(self._statuses[row * 2]),
+                chr(self._statuses[row * 2 + 1]))
+
+    def __getitem__(self, row):
+        path = self.paths[row]
+        mode_head, mode_index, mode_worktree = (
+            self._mode_table[mode_id]
+            for mode_id in self._modes[row * 3:row * 3 + 3])
+        start = row * 2 * self._hash_size
+        hash_head = self._hashes[start:start + self._hash_size].hex()
+        hash_index = None
+        if mode_index is not None:
+            hash_index = self._hashes[
+                start + self._hash_size:start + 2 * self._hash_size].hex()
+        return StatusRecord(
+            *self.statuses(row), mode_head, mode_index, mode_worktree,
+            hash_head, hash_index, path)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def iter_where(self, predicate):
+        """Generate the StatusRecords for which predicate(index_status,
+        worktree_status) is true."""
+        for row in range(len(self)):
+            if predicate(*self.statuses(row)):
+                yield self[row]
+
+
+def _split_status(field, maxsplit):
+    """Split a porcelain v2 status line, leaving the final (path) part as
+    bytes."""
+    parts = field.split(b" ", maxsplit)
+    return [part.decode("ascii") for part in parts[:-1]] + parts[-1:]
+
+
+def parse_porcelain_v2(fields):
+    """Parse git status --porcelain=v2 -z output, given as an iterable of its
+    NUL-separated fields (bytes).
+
+    Returns (records, untracked): a ChangeSet for tracked paths with changes,
+    and a PathColumn of untracked paths.  For unmerged paths both statuses
+    are "U", HEAD's mode and hash are taken from stage 2 ("ours"), and the
+    index mode and hash are None.  Paths are decoded with os.fsdecode().
+    """
+    records = ChangeSet()
+    untracked = PathColumn()
+    fields = iter(fields)
+    for field in fields:
+        if field == b"":
+            continue
+        # only paths may contain spaces (or bytes that are not ASCII)
+        kind = field[:2].decode("ascii")
+        if kind == "1 ":
+            (_, xy, sub, mode_head, mode_index, mode_worktree,
+             hash_head, hash_index, path) = _split_status(field, 8)
+            records.append(
+                xy[0], xy[1], mode_head, mode_index, mode_worktree,
+                hash_head, hash_index, path)
+        elif kind == "2 ":
+            # only seen without --no-renames; the original path follows
+            (_, xy, sub, mode_head, mode_index, mode_worktree,
+             hash_head, hash_index, score, path) = _split_status(field, 9)
+            next(fields)
+            records.append(
+                xy[0], xy[1], mode_head, mode_index, mode_worktree,
+                hash_head, hash_index, path)
+        elif kind == "u ":
+            (_, xy, sub, mode_1, mode_2, mode_3, mode_worktree,
+             hash_1, hash_2, hash_3, path) = _split_status(field, 10)
+            records.append(
+                "U", "U", mode_2, None, mode_worktree, hash_2, None, path)
+        elif kind == "? ":
+            untracked.append(field[2:])
+    return records, untracked
+
+
+class RepoSnapshot:
+
+    """The state of a repository's index and working tree relative to HEAD.
+
+    This is read once from a single git status command, which is much cheaper
+    on large trees than running one command (each of which examines every
+    tracked or untracked file) per question asked of the repository.
+    """
+
+    def __init__(self, records, untracked, cache_use=None):
+        self.records = records
+        # untracked files, and directories (ending in "/") holding only
+        # untracked files, as git status --untracked-files=normal shows them:
+        # see expand_untracked()
+        self.untracked = untracked
+        self.cache_use = cache_use
+
+    @classmethod
+    def from_repo(cls, repo_env, pathspecs=None,
+                  git_options=("--no-optional-locks",), trace_caches=False):
+        """Read the state of the repository, limited to paths matching
+        pathspecs (a Pathspecs) if given.
+
+        git_options are passed to git before the status command (see
+        status_git_options()).  If trace_caches is true, .cache_use is set to
+        say whether git used the untracked cache and fsmonitor (see
+        read_cache_use()).
+        """
+        if pathspecs is None:
+            pathspecs = Pathspecs()
+        # Untracked directories aren't listed file by file: the untracked
+        # cache serves only this mode (and only without pathspecs)
+        args = (["git"] + list(git_options) +
+                ["status", "--porcelain=v2", "-z", "--untracked-files=normal",
+                 "--no-renames", "--"] +
+                pathspecs.git_args())
+        if not trace_caches:
+            return cls(*parse_porcelain_v2(iter_cmd_fields(repo_env, args)))
+        import tempfile
+        fd, trace_path = tempfile.mkstemp(prefix="git-meld-index-trace2-")
+        os.close(fd)
+        try:
+            trace_env = PrefixCmdEnv.make_readable(
+                with_env(GIT_TRACE2_EVENT=trace_path,
+                         GIT_TRACE2_EVENT_NESTING="10"),
+                repo_env)
+            snapshot = cls(*parse_porcelain_v2(
+                iter_cmd_fields(trace_env, args)))
+            snapshot.cache_use = read_cache_use(trace_path)
+        finally:
+            os.remove(trace_path)
+        return snapshot
+
+    def index_changes(self):
+        """Records for paths whose index entry differs from HEAD.
+
+        Paths deleted from the index are omitted, as for
+        iter_diff_records_undeleted() with git diff-index --cached HEAD.
+        """
+        return self.records.iter_where(
+            lambda index_status, worktree_status:
+                index_status not in (".", "D"))
+
+    def worktree_changes(self):
+        """Records for paths whose working tree file differs from HEAD.
+
+        Paths deleted from the index or working tree are omitted, as for
+        iter_diff_records_undeleted() with git diff-index HEAD.
+        """
+        return self.records.iter_where(
+            lambda index_status, worktree_status:
+                "D" not in (index_status, worktree_status))
+
+    def worktree_only_changes(self):
+        """Records from .worktree_changes() whose index entry matches HEAD.
+
+        This is the difference between the worktree and index change sets,
+        found from each row's statuses rather than by comparing paths.
+        """
+        return self.records.iter_where(
+            lambda index_status, worktree_status:
+                index_status == "." and worktree_status != "D")
+
+
+def read_cache_use(trace_path):
+    """Return a dict saying whether a git status used the untracked cache
+    and fsmonitor, from the trace2 events it wrote to trace_path.
+
+    git gives untracked cache statistics (as "read_directory" data) only
+    when the cache served the scan for untracked files, and queries
+    fsmonitor in an "fsm_hook" or "fsm_client" region.
+    """
+    import json
+    cache_use = dict(untracked_cache=False, fsmonitor=False)
+    with open(trace_path, "rb") as fh:
+        for line in fh:
+            if b'"read_directory"' not in line and b'"fsm_' not in line:
+                continue
+            event = json.loads(line)
+            category = event.get("category")
+            if category == "read_directory" and event.get("key") == "opendir":
+                cache_use["untracked_cache"] = True
+            elif category in ("fsm_hook", "fsm_client"):
+                cache_use["fsmonitor"] = True
+    return cache_use
+
+
+class RepoSnapshots:
+
+    """Shares one RepoSnapshot per repository between views.
+
+    The snapshots, and so the views, are limited to paths matching pathspecs
+    (a Pathspecs), if given.  git_options are as for RepoSnapshot.from_repo().
+    If note is given, it is called as note(name, value) with whether git used
+    the untracked cache and fsmonitor for a snapshot (as for Profile.note()).
+    """
+
+    def __init__(self, pathspecs=None, git_options=("--no-optional-locks",),
+                 note=None):
+        if pathspecs is None:
+            pathspecs = Pathspecs()
+        self.pathspecs = pathspecs
+        self._git_options = git_options
+        self._note = note
+        self._snapshots = {}
+        # views may be written concurrently
+        self._lock = threading.Lock()
+
+    def get(self, env, repo_path):
+        key = os.path.abspath(repo_path)
+        with self._lock:
+            if key not in self._snapshots:
+                repo_env = PrefixCmdEnv.make_readable(in_dir(key), env)
+                with phase("snapshot"):
+                    snapshot = RepoSnapshot.from_repo(
+                        repo_env, self.pathspecs, self._git_options,
+                        trace_caches=self._note is not None)
+                if self._note is not None:
+                    for name, value in snapshot.cache_use.items():
+                        self._note(name, value)
+                self._snapshots[key] = snapshot
+            return self._snapshots[key]
+
+
+class IndexFormatError(ValueError):
+
+    pass
+
+
+@dataclass(slots=True)
+class IndexEntry:
+    path: str
+    mode: str
+    hash: str
+    stage: int
+    skip_worktree: bool
+    # None if not known
+    intent_to_add: bool
+    # (ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, uid, gid, size), or
+    # None if read using git
+    stat: tuple
+
+
+def _read_varint(data, offset):
+    """Read one of git's variable-length offsets, returning (value, offset)."""
+    byte = data[offset]
+    offset += 1
+    value = byte & 0x7f
+    while byte & 0x80:
+        byte = data[offset]
+        offset += 1
+        value = ((value + 1) << 7) | (byte & 0x7f)
+    return value, offset
+
+
+class GitIndex:
+
+    """The entries of a git index file, stored compactly as for ChangeSet.
+
+    Read an index using .read(), or load_index() to fall back to git when
+    that fails.
+    """
+
+    supported_versions = (2, 3, 4)
+
+    _entry_header = struct.Struct(">10I")
+    _stat_fields = 9
+
+    def __init__(self, version=None, extensions=()):
+        self.version = version
+        self.extensions = list(extensions)
+        self.paths = PathColumn()
+        self._modes = array.array("I")
+        self._flags = array.array("B")
+        self._hashes = bytearray()
+        self._hash_size = None
+        self._stats = array.array("Q")
+
+    # bits of _flags
+    _STAGE_MASK = 0x03
+    _SKIP_WORKTREE = 0x04
+    _INTENT_TO_ADD = 0x08
+    _HAS_STAT = 0x10
+    _INTENT_TO_ADD_UNKNOWN = 0x20
+
+    def append(self, path, mode, hash_, stage=0, skip_worktree=False,
+               intent_to_add=False, stat=None):
+        if self._hash_size is None:
+            self._hash_size = len(hash_)
+        self.paths.append(path)
+        self._modes.append(mode)
+        flags = stage
+        if skip_worktree:
+            flags |= self._SKIP_WORKTREE
+        if intent_to_add is None:
+            flags |= self._INTENT_TO_ADD_UNKNOWN
+        elif intent_to_add:
+            flags |= self._INTENT_TO_ADD
+        if stat is not None:
+            flags |= self._HAS_STAT
+            self._stats.extend(stat)
+        else:
+            self._stats.extend(itertools.repeat(0, self._stat_fields))
+        self._flags.append(flags)
+        self._hashes += hash_
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, row):
+        flags = self._flags[row]
+        start = row * self._hash_size
+        stat = None
+        if flags & self._HAS_STAT:
+            stat = tuple(self._stats[row * self._stat_fields:
+                                     (row + 1) * self._stat_fields])
+        intent_to_add = None
+        if not flags & self._INTENT_TO_ADD_UNKNOWN:
+            intent_to_add = bool(flags & self._INTENT_TO_ADD)
+        return IndexEntry(
+            self.paths[row], "%06o" % self._modes[row],
+            self._hashes[start:start + self._hash_size].hex(),
+            flags & self._STAGE_MASK, bool(flags & self._SKIP_WORKTREE),
+            intent_to_add, stat)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def get(self, path, stage=0):
+        """Return the IndexEntry for path at stage, or None."""
+        row = self.paths.find(path)
+        if row is None:
+            return None
+        # entries are sorted by path then stage, so all of path's stages are
+        # adjacent
+        while row > 0 and self.paths[row - 1] == path:
+            row -= 1
+        while row < len(self) and self.paths[row] == path:
+            if self._flags[row] & self._STAGE_MASK == stage:
+                return self[row]
+            row += 1
+        return None
+
+    @classmethod
+    def read(cls, index_path, hash_size=20):
+        """Read an index file (versions 2 to 4) in-process.
+
+        The file is memory-mapped rather than read into memory.  Raises
+        IndexFormatError if the file is in a format we don't understand.
+        """
+        with open(index_path, "rb") as fh:
+            try:
+                data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise IndexFormatError("empty index file")
+        with data:
+            try:
+                return cls._parse(data, hash_size)
+            except (IndexError, struct.error):
+                raise IndexFormatError("truncated index file")
+
+    @classmethod
+    def _parse(cls, data, hash_size):
+        signature, version, count = struct.unpack_from(">4sII", data)
+        if signature != b"DIRC":
+            raise IndexFormatError("not an index file")
+        if version not in cls.supported_versions:
+            raise IndexFormatError(
+                "unsupported index version {}".format(version))
+        index = cls(version)
+        offset = 12
+        path = b""
+        for _ in range(count):
+            entry_start = offset
+            (ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, mode, uid, gid,
+             size) = cls._entry_header.unpack_from(data, offset)
+            offset += cls._entry_header.size
+            hash_ = data[offset:offset + hash_size]
+            offset += hash_size
+            (flags,) = struct.unpack_from(">H", data, offset)
+            offset += 2
+            extended_flags = 0
+            if flags & 0x4000:
+                if version < 3:
+                    raise IndexFormatError("extended flags in version 2")
+                (extended_flags,) = struct.unpack_from(">H", data, offset)
+                offset += 2
+            if version == 4:
+                # the path is given as the number of bytes to remove from the
+                # end of the previous path, and the bytes to add
+                strip, offset = _read_varint(data, offset)
+                end = data.find(b"\0", offset)
+                if end == -1 or strip > len(path):
+                    raise IndexFormatError("bad path in index entry")
+                path = path[:len(path) - strip] + data[offset:end]
+                offset = end + 1
+            else:
+                end = data.find(b"\0", offset)
+                if end == -1:
+                    raise IndexFormatError("bad path in index entry")
+                path = data[offset:end]
+                # entries are padded with NULs to a multiple of 8 bytes
+                offset = entry_start + ((end - entry_start + 8) & ~7)
+            index.append(
+                path, mode, hash_, (flags >> 12) & 0x3,
+                skip_worktree=bool(extended_flags & 0x4000),
+                intent_to_add=bool(extended_flags & 0x2000),
+                stat=(ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, uid,
+                      gid, size))
+        end = len(data) - hash_size
+        while offset < end:
+            name, size = struct.unpack_from(">4sI", data, offset)
+            # Extensions whose names start with an upper-case letter are
+            # optional.  Others (e.g. "link" for a split index, or "sdir" for
+            # sparse directory entries) change what the entries mean.
+            if not name[:1].isupper():
+                raise IndexFormatError(
+                    "unsupported index extension {!r}".format(name))
+            index.extensions.append(name.decode("ascii"))
+            offset += 8 + size
+        if offset != end:
+            raise IndexFormatError("truncated index file")
+        return index
+
+
+    @classmethod
+    def from_git(cls, repo_env):
+        """Read the index by running git ls-files.
+
+        Entries have no stat data, and intent_to_add is None, since git
+        ls-files doesn't say.
+        """
+        index = cls()
+        for field in iter_cmd_fields(
+                repo_env, ["git", "ls-files", "--stage", "-t", "-z"]):
+            info, path = field.split(b"\t", 1)
+            tag, mode, hash_, stage = info.decode("ascii").split(" ")
+            index.append(path, int(mode, 8), bytes.fromhex(hash_), int(stage),
+                         skip_worktree=(tag == "S"), intent_to_add=None)
+        return index
+
+
+def load_index(repo_env, index_path, hash_size=20):
+    """Return a GitIndex for index_path, running git only if we can't read it
+    in-process."""
+    try:
+        return GitIndex.read(index_path, hash_size)
+    except FileNotFoundError:
+        return GitIndex()
+    except IndexFormatError as exc:
+        _log().debug("reading index using git: %s", exc)
+        return GitIndex.from_git(repo_env)
+
+
+
+def read_index_extensions(index_path):
+    """Return the names of an index file's extensions, or None if they can't
+    be found without reading its entries.
+
+    The extensions follow the entries, so finding them otherwise means
+    parsing every entry, which takes longer on a large index than the git
+    status this is used to speed up.  Instead, this reads the "end of index
+    entries" (EOIE) extension, which git writes last when
+    index.recordEndOfIndexEntries is set, for where they start.
+    """
+    with open(index_path, "rb") as fh:
+        try:
+            return _read_index_extensions(fh)
+        except struct.error:
+            raise IndexFormatError("truncated index file")
+
+
+def _read_index_extensions(fh):
+    signature, version, count = struct.unpack(">4sII", fh.read(12))
+    if signature != b"DIRC":
+        raise IndexFormatError("not an index file")
+    size = fh.seek(0, os.SEEK_END)
+    # the index doesn't say which hash function it uses, so try each
+    for hex_size, hash_name in HASH_NAMES.items():
+        hash_size = hex_size // 2
+        eoie_start = size - hash_size - (12 + hash_size)
+        if eoie_start < 12:
+            continue
+        fh.seek(eoie_start)
+        eoie = fh.read(12 + hash_size)
+        name, eoie_size, offset = struct.unpack_from(">4sII", eoie)
+        if (name != b"EOIE" or eoie_size != 4 + hash_size or
+                not 12 <= offset <= eoie_start):
+            continue
+        names = []
+        headers = []
+        while offset < eoie_start:
+            fh.seek(offset)
+            header = fh.read(8)
+            name, extension_size = struct.unpack(">4sI", header)
+            names.append(name.decode("ascii", "replace"))
+            headers.append(header)
+            offset += 8 + extension_size
+        # EOIE ends with a hash of the other extensions' headers, which tells
+        # us offset really was where they start
+        import hashlib
+        if (offset == eoie_start and hashlib.new(
+                hash_name, b"".join(headers)).digest() == eoie[12:]):
+            return names + ["EOIE"]
+    return None
+
+
+def _config_bool(value):
+    # None is a variable given without a value, which git takes as true
+    return value is None or value.lower() in ("true", "yes", "on", "1")
+
+
+# git config variables read at startup, in a single git config process
+CONFIG_REGEXP = (
+    r"^(core\.(untrackedcache|fsmonitor|excludesfile)|meldindex\..*)$")
+
+
+def read_config(env, regexp=CONFIG_REGEXP):
+    """Return a dict of the git config variables matching regexp.
+
+    Names are as git config --get-regexp reports them (lower case, except
+    for the subsection).  Where a variable is set more than once, the last
+    value wins, as for git config --get.  The value of a variable given
+    without one (e.g. "[core] untrackedCache") is None.
+    """
+    try:
+        config = env.read_cmd(
+            ["git", "config", "-z", "--get-regexp", regexp]).stdout_output
+    except CalledProcessError:
+        # none set
+        config = b""
+    settings = {}
+    for entry in config.split(b"\0")[:-1]:
+        name, newline, value = entry.decode().partition("\n")
+        settings[name] = value if newline else None
+    return settings
+
+
+def status_git_options(env, index_path, enable_caches=False, config=None):
+    """Return git options for git status.
+
+    On large trees, git status finds untracked files much faster using the
+    untracked cache and a file system monitor (fsmonitor).  git uses these
+    whenever they are configured, but they are only kept up to date if git
+    status is allowed to update the index.  We don't normally allow that
+    (--no-optional-locks), so as not to compete for the index lock with other
+    git commands, but we do if either is configured or already in use.  If
+    enable_caches is true, the untracked cache (and fsmonitor, if git has a
+    built-in fsmonitor daemon) is enabled for the session.
+
+    Whether either is in use (present in the index) can only be told quickly
+    if the index records where its extensions start (see
+    read_index_extensions()), so when git may update the index, we ask it
+    to record that.  Whether git status went on to use them is another
+    matter: see RepoSnapshot.from_repo().
+
+    config is a dict from read_config(), which is called if it is not given.
+    """
+    try:
+        extensions = read_index_extensions(index_path)
+    except (OSError, IndexFormatError):
+        extensions = []
+    settings = read_config(env) if config is None else config
+    fsmonitor = settings.get("core.fsmonitor", "false")
+    configured = (
+        _config_bool(settings.get("core.untrackedcache", "false")) or
+        fsmonitor is None or
+        fsmonitor.lower() not in ("false", "no", "off", "0", ""))
+    in_use = extensions is not None and bool(
+        {"UNTR", "FSMN"}.intersection(extensions))
+    options = []
+    if enable_caches:
+        options += ["-c", "core.untrackedCache=true"]
+        build_options = env.read_cmd(
+            ["git", "version", "--build-options"]).stdout_output
+        if b"feature: fsmonitor--daemon" in build_options:
+            options += ["-c", "core.fsmonitor=true"]
+    elif not (configured or in_use):
+        options.append("--no-optional-locks")
+        return options
+    options += ["-c", "index.recordEndOfIndexEntries=true"]
+    return options
+
+
+class AbstractViewInterface:
+
+    def write(self, env, dest_dir, state_path=None):
+        """Write view to dest_dir.
+
+        The work should be done by running commands in env.
+
+        If state_path is given, dest_dir may contain files from an earlier
+        session.  The view should update it to match the new state, using
+        (and then replacing) whatever it saved at state_path last time.
+
+        Usually:
+
+        * This will copy files to dest_dir from a repository.
+
+        * env will be such that commands run in it will have their working
+          directory set to the top level of that repo.
+        """
+
+    def apply(self, env, dir_, paths=None):
+        """Read view from dir_ and apply it to something.
+
+        The work should be done by running commands in env.
+
+        If paths is given, only those paths (relative to dir_) can have
+        changed since .write(), so only they need be read.
+
+        Usually:
+
+        * This will apply changes to a repository (e.g. to the index), from a
+          set of files in dir_ that were copied from that repo by .write().
+
+        * env will be such that commands run in it will have their working
+          directory set to the top level of that repo.
+        """
+
+
+_SIZE_SUFFIXES = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+
+
+def parse_size(value):
+    """Parse a non-negative integer with an optional k, m or g suffix.
+
+    The suffixes are as for git config --type=int.
+    """
+    if value is None:
+        # from a git config variable given without a value
+        raise ValueError("missing size")
+    text = value.strip().lower()
+    factor = _SIZE_SUFFIXES.get(text[-1:])
+    if factor is None:
+        factor = 1
+    else:
+        text = text[:-1]
+    if not text.isdigit():
+        raise ValueError("invalid size: {!r}".format(value))
+    return int(text) * factor
+
+
+def parse_count(value):
+    """Parse a non-negative integer, without suffixes."""
+    if value is None:
+        raise ValueError("missing count")
+    text = value.strip()
+    if not text.isdigit():
+        raise ValueError("invalid count: {!r}".format(value))
+    return int(text)
+
+
+@dataclass
+class UntrackedLimits:
+
+    """Limits on the untracked files StageableWorkingTreeSubsetView copies.
+
+    A limit of 0 means no limit.  There are none unless configured.
+    """
+
+    max_files: int = 0
+    max_file_size: int = 0
+
+    @classmethod
+    def from_config(cls, config, max_files=None, max_file_size=None):
+        """Limits from git config (a dict from read_config()).
+
+        max_files and max_file_size, if not None, override the configuration
+        (meldIndex.maxUntrackedFiles and meldIndex.maxFileSize).
+        """
+        values = {}
+        for field, name, override, parse in [
+                ("max_files", "meldIndex.maxUntrackedFiles", max_files,
+                 parse_count),
+                ("max_file_size", "meldIndex.maxFileSize", max_file_size,
+                 parse_size)]:
+            if override is not None:
+                values[field] = override
+            elif name.lower() in config:
+                try:
+                    values[field] = parse(config[name.lower()])
+                except ValueError:
+                    raise ValueError("bad value for {}: {!r}".format(
+                        name, config[name.lower()]))
+        return cls(**values)
+
+
+@dataclass
+class SkippedUntracked:
+
+    """Untracked files left out of the working tree view.
+
+    path is a file, or a directory (ending in "/") holding only untracked
+    files.  reason is "size" (size is then the file's size in bytes) or
+    "count".  If truncated is true, the directory holds at least files
+    files: there was no need to count them all.
+    """
+
+    path: str
+    files: int
+    reason: str
+    size: int = None
+    truncated: bool = False
+
+
+def _containing_entry(path, entries):
+    """Return the directory in entries that holds path, or path itself."""
+    slash = path.find("/")
+    while slash != -1:
+        if path[:slash + 1] in entries:
+            return path[:slash + 1]
+        slash = path.find("/", slash + 1)
+    return path
+
+
+def expand_untracked(repo_env, entries, pathspecs=None):
+    """Return {entry: [untracked files]} for RepoSnapshot.untracked entries.
+
+    A file entry maps to itself.  A directory entry (ending in "/") maps to
+    the untracked, non-ignored files in it that match pathspecs, found with
+    a single git ls-files for all the directories (so git is run only if
+    there are any).  A nested repository stays as it is.
+    """
+    return _expand_untracked(repo_env, entries, pathspecs)[0]
+
+
+def _expand_untracked(repo_env, entries, pathspecs=None, max_files=0):
+    """As expand_untracked(), but returns (expanded, truncated).
+
+    If max_files is not 0, git stops looking in a directory once it has
+    found more than max_files files there, since the directory will be
+    skipped whatever else it holds.  truncated is the set of such
+    directories.  The listing then starts again for the directories not
+    yet listed, so that the time taken is bounded by max_files per
+    directory, not by what a huge directory holds.  git lists each
+    directory's files together, so those listed before the one cut off are
+    complete, and are kept.
+    """
+    if pathspecs is None:
+        pathspecs = Pathspecs()
+    expanded = {}
+    dirs = []
+    for entry in entries:
+        if entry.endswith("/"):
+            expanded[entry] = []
+            dirs.append(entry)
+        else:
+            expanded[entry] = [entry]
+    truncated = set()
+    while dirs:
+        listing = {dir_: [] for dir_ in dirs}
+        finished = []
+        dir_ = None
+        fields = iter_cmd_fields(
+            repo_env,
+            ["git", "--literal-pathspecs", "ls-files", "-z", "--others",
+             "--exclude-standard", "--"] + dirs)
+        with contextlib.closing(fields):
+            for field in fields:
+                path = os.fsdecode(field)
+                containing = _containing_entry(path, listing)
+                if containing != dir_:
+                    if dir_ is not None:
+                        finished.append(dir_)
+                    dir_ = containing
+                if not pathspecs.matches(path):
+                    continue
+                listing[dir_].append(path)
+                if max_files and len(listing[dir_]) > max_files:
+                    truncated.add(dir_)
+                    finished.append(dir_)
+                    break
+            else:
+                expanded.update(listing)
+                break
+        for dir_ in finished:
+            expanded[dir_] = listing[dir_]
+        finished = set(finished)
+        dirs = [dir_ for dir_ in dirs if dir_ not in finished]
+    return expanded, truncated
+
+
+def limit_untracked(repo_env, repo_path, entries, limits, pathspecs=None):
+    """Apply limits (an UntrackedLimits) to the untracked files in repo_path.
+
+    entries are from RepoSnapshot.untracked, and are expanded to files as
+    for expand_untracked().  Returns (the paths of the files to keep, a list
+    of SkippedUntracked).
+
+    Files larger than limits.max_file_size are skipped.  If more than
+    limits.max_files remain, whole directories of untracked files (as git
+    status collapses them) are skipped, largest first, until few enough are
+    left.  Untracked files outside such directories count as directories of
+    one file.  Files deleted since git status listed them are left out.
+    """
+    expanded, truncated = _expand_untracked(
+        repo_env, entries, pathspecs, limits.max_files)
+    skipped = []
+    units = {}
+    for entry, paths in expanded.items():
+        if entry in truncated:
+            skipped.append(SkippedUntracked(
+                entry, len(paths), "count", truncated=True))
+            continue
+        kept = []
+        for path in paths:
+            if limits.max_file_size:
+                try:
+                    size = os.lstat(os.path.join(repo_path, path)).st_size
+                except FileNotFoundError:
+                    continue
+                if size > limits.max_file_size:
+                    skipped.append(SkippedUntracked(path, 1, "size", size))
+                    continue
+            kept.append(path)
+        if kept:
+            units[entry] = kept
+    count = sum(len(unit_paths) for unit_paths in units.values())
+    if not limits.max_files or count <= limits.max_files:
+        return [path for unit_paths in units.values()
+                for path in unit_paths], skipped
+    dropped = set()
+    for unit, unit_paths in sorted(
+            units.items(), key=lambda item: (-len(item[1]), item[0])):
+        if count <= limits.max_files:
+            break
+        dropped.add(unit)
+        count -= len(unit_paths)
+        skipped.append(SkippedUntracked(unit, len(unit_paths), "count"))
+    kept = [path for unit, unit_paths in units.items() if unit not in dropped
+            for path in unit_paths]
+    return kept, skipped
+
+
+def format_skipped(skipped, max_lines=10):
+    """Return a summary of untracked files skipped by limit_untracked()."""
+    at_least = "at least " if any(item.truncated for item in skipped) else ""
+    lines = ["git-meld-index: not showing {}{} untracked files:".format(
+        at_least, sum(item.files for item in skipped))]
+    for item in skipped[:max_lines]:
+        if item.reason == "size":
+            detail = "{} bytes, over --max-file-size".format(item.size)
+        else:
+            detail = "{}{} files, over --max-untracked-files".format(
+                "at least " if item.truncated else "", item.files)
+        lines.append("  {} ({})".format(item.path, detail))
+    if len(skipped) > max_lines:
+        lines.append("  ... and {} more".format(len(skipped) - max_lines))
+    return "\n".join(lines)
+
+
+DEFAULT_PLACEHOLDER_SIZE = 10 * 1024 * 1024
+
+# first line of every placeholder file
+PLACEHOLDER_HEADER = b"[git-meld-index placeholder]\n"
+# larger files are not checked for being placeholders
+PLACEHOLDER_MAX_SIZE = 4096
+# Manifest mode of a placeholder, so that it is never taken for (or kept
+# from an earlier session in place of) the file it stands for
+PLACEHOLDER_MODE = "placeholder"
+# Git LFS pointer files are smaller than this
+LFS_POINTER_MAX_SIZE = 1024
+
+_PLACEHOLDER_REASONS = {
+    "lfs": "it is stored using Git LFS",
+    "binary": "its diff attribute is unset (e.g. it is marked binary)",
+    "size": "it is larger than --placeholder-size",
+}
+
+
+@dataclass
+class Placeholder:
+
+    """A small file written by a view in place of one it does not copy.
+
+    size is the size in bytes of the file it stands for, and oid that file's
+    blob hash, if known.  For files stored using Git LFS, lfs_oid and lfs_size
+    are read from the LFS pointer, if available.
+    """
+
+    path: str
+    reason: str
+    size: int
+    oid: str = None
+    lfs_oid: str = None
+    lfs_size: int = None
+
+    def read_lfs_pointer(self, data):
+        """Fill in .lfs_oid and .lfs_size from LFS pointer file contents."""
+        for line in data.decode("utf-8", "replace").splitlines():
+            key, _, value = line.partition(" ")
+            if key == "oid":
+                self.lfs_oid = value
+            elif key == "size" and value.isdigit():
+                self.lfs_size = int(value)
+
+    def render(self):
+        lines = [
+            PLACEHOLDER_HEADER.decode().rstrip("\n"),
+            "This file was not copied, because {}.".format(
+                _PLACEHOLDER_REASONS[self.reason]),
+            "git meld-index never stages it, even if edited.",
+            "",
+            "path: {}".format(self.path),
+            "size: {}".format(self.size),
+        ]
+        for name in ["oid", "lfs_oid", "lfs_size"]:
+            value = getattr(self, name)
+            if value is not None:
+                lines.append("{}: {}".format(name.replace("_", "-"), value))
+        return os.fsencode("\n".join(lines) + "\n")
+
+
+def _write_bytes(path, data):
+    with open(path, "wb") as fh:
+        fh.write(data)
+
+
+def is_placeholder(path):
+    """Return True if path is a placeholder file (or a copy of one)."""
+    try:
+        stat = os.lstat(path)
+        if (not stat_module.S_ISREG(stat.st_mode) or
+                stat.st_size > PLACEHOLDER_MAX_SIZE):
+            return False
+        with open(path, "rb") as fh:
+            return fh.read(len(PLACEHOLDER_HEADER)) == PLACEHOLDER_HEADER
+    except FileNotFoundError:
+        return False
+
+
+@dataclass
+class PlaceholderPolicy:
+
+    """Which files views write placeholders for, instead of copying them.
+
+    These are Git LFS files (those with the filter=lfs attribute), files
+    whose diff attribute is unset (including those with the binary
+    attribute), and files larger than max_size bytes (0 for no limit).
+    """
+
+    max_size: int = DEFAULT_PLACEHOLDER_SIZE
+
+    # git attributes .reason() uses
+    attributes = ("diff", "filter")
+
+    @classmethod
+    def from_config(cls, config, enabled=None, max_size=None):
+        """Policy from git config (a dict from read_config()).
+
+        Returns None if placeholders are disabled.  enabled and max_size, if
+        not None, override the configuration (meldIndex.placeholders and
+        meldIndex.placeholderSize).
+        """
+        if enabled is None:
+            enabled = _config_bool(
+                config.get("meldindex.placeholders", "false"))
+        if not enabled:
+            return None
+        if max_size is None:
+            if "meldindex.placeholdersize" not in config:
+                return cls()
+            value = config["meldindex.placeholdersize"]
+            try:
+                max_size = parse_size(value)
+            except ValueError:
+                raise ValueError("bad value for meldIndex.placeholderSize: "
+                                 "{!r}".format(value))
+        return cls(max_size)
+
+    def reason(self, size, attributes):
+        """Return why a file needs a placeholder, or None if it doesn't.
+
+        attributes is the file's entry from check_attributes().
+        """
+        if attributes.get("filter") == "lfs":
+            return "lfs"
+        if attributes.get("diff") == "unset":
+            return "binary"
+        if self.max_size and size > self.max_size:
+            return "size"
+        return None
+
+    def find(self, repo_env, sizes, cached=False):
+        """Return {path: Placeholder} for the paths that need one.
+
+        sizes maps each (regular file) path to its size.  Attributes are
+        read as for check_attributes().
+        """
+        attributes = check_attributes(
+            repo_env, list(sizes), self.attributes, cached)
+        placeholders = {}
+        for path, size in sizes.items():
+            reason = self.reason(size, attributes.get(path, {}))
+            if reason is not None:
+                placeholders[path] = Placeholder(path, reason, size)
+        return placeholders
+
+
+def check_attributes(repo_env, paths, names, cached=False):
+    """Return {path: {name: value}} giving git attributes names of paths.
+
+    Values are as git check-attr reports them ("set", "unset", "unspecified"
+    or the value).  A single git check-attr is run for all paths.  If cached
+    is true, only .gitattributes files in the index are used.
+    """
+    if not paths:
+        return {}
+    args = ["git", "check-attr", "-z", "--stdin"]
+    if cached:
+        args.append("--cached")
+    output = repo_env.read_cmd(
+        args + list(names),
+        input=b"".join(os.fsencode(path) + b"\0" for path in paths))
+    fields = output.stdout_output.split(b"\0")[:-1]
+    attributes = {}
+    for path, name, value in zip(fields[0::3], fields[1::3], fields[2::3]):
+        attributes.setdefault(os.fsdecode(path), {})[name.decode()] = (
+            value.decode())
+    return attributes
+
+
+def blob_sizes(repo_env, hashes):
+    """Return {hash: size} for blobs, using a single git cat-file."""
+    hashes = list(hashes)
+    if not hashes:
+        return {}
+    output = repo_env.read_cmd(
+        ["git", "cat-file", "--batch-check"],
+        input="".join(hash_ + "\n" for hash_ in hashes).encode())
+    sizes = {}
+    for line in output.stdout_output.decode().split("\n")[:-1]:
+        fields = line.split()
+        if len(fields) == 3:
+            sizes[fields[0]] = int(fields[2])
+    return sizes
+
+
+class StageableWorkingTreeSubsetView:
+
+    """Modified and untracked files in the working tree.
+
+    Untracked files are subject to limits (an UntrackedLimits), so that a
+    forgotten build or data directory can't make the view huge.  A summary
+    of anything skipped is printed to stderr, and kept in .skipped.  If
+    placeholders (a PlaceholderPolicy) is given, files it selects are
+    replaced by placeholders.
+    """
 
-    def cmd(self, args, input=None, tty=False):
-        return self._env.cmd(self._prefix_cmd + args, input, tty)
+    label = "working_tree"
 
-    @classmethod
-    def make_readable(cls, prefix_cmd, readable_env):
-        return readable_env.wrap(functools.partial(cls, prefix_cmd))
+    def __init__(self, repo_path, snapshots=None, jobs=None, limits=None,
+                 placeholders=None):
+        self._repo_path = repo_path
+        if snapshots is None:
+            snapshots = RepoSnapshots()
+        self._snapshots = snapshots
+        if jobs is None:
+            jobs = default_jobs()
+        self._jobs = jobs
+        if limits is None:
+            limits = UntrackedLimits()
+        self._limits = limits
+        self._placeholder_policy = placeholders
+        self.skipped = []
+
+    def _untracked(self, env, snapshot):
+        abs_repo_path = os.path.abspath(self._repo_path)
+        repo_env = PrefixCmdEnv.make_readable(in_dir(abs_repo_path), env)
+        paths, self.skipped = limit_untracked(
+            repo_env, abs_repo_path, snapshot.untracked, self._limits,
+            self._snapshots.pathspecs)
+        if self.skipped:
+            print(format_skipped(self.skipped), file=sys.stderr)
+        return paths
+
+    def _modified(self, snapshot):
+        for record in snapshot.worktree_changes():
+            yield record.path
+
+    def _placeholders(self, env, paths):
+        if self._placeholder_policy is None:
+            return {}
+        abs_repo_path = os.path.abspath(self._repo_path)
+        repo_env = PrefixCmdEnv.make_readable(in_dir(abs_repo_path), env)
+        sizes = {}
+        for path in paths:
+            stat = os.lstat(os.path.join(abs_repo_path, path))
+            if stat_module.S_ISREG(stat.st_mode):
+                sizes[path] = stat.st_size
+        placeholders = self._placeholder_policy.find(repo_env, sizes)
+        for placeholder in placeholders.values():
+            # without git-lfs installed, the file is still the LFS pointer
+            if (placeholder.reason == "lfs" and
+                    placeholder.size < LFS_POINTER_MAX_SIZE):
+                with open(os.path.join(abs_repo_path, placeholder.path),
+                          "rb") as fh:
+                    placeholder.read_lfs_pointer(fh.read())
+        return placeholders
+
+    def write(self, env, dest_dir, state_path=None):
+        abs_repo_path = os.path.abspath(self._repo_path)
+        abs_dest_dir = os.path.abspath(dest_dir)
+        snapshot = self._snapshots.get(env, self._repo_path)
+        paths = list(itertools.chain(
+            self._untracked(env, snapshot),
+            self._modified(snapshot)))
+        placeholders = self._placeholders(env, paths)
+        existing_dirs = ()
+        if state_path is not None:
+            # Keep copies from an earlier session whose source files have not
+            # changed since (according to their stat), and remove everything
+            # else
+            previous = Manifest.load(state_path, self._repo_path)
+            manifest = Manifest()
+            current = set()
+            for path in paths:
+                src = os.path.join(abs_repo_path, path)
+                if path in placeholders:
+                    mode = PLACEHOLDER_MODE
+                else:
+                    mode = "%o" % os.lstat(src).st_mode
+                manifest.add(abs_repo_path, path, mode, None)
+                entry = previous.get(path)
+                if (entry is not None and not previous.is_racy(entry) and
+                        entry == manifest.get(path) and
+                        os.path.lexists(os.path.join(abs_dest_dir, path))):
+                    current.add(path)
+            existing_dirs = prune_tree(env, abs_dest_dir, current)
+            paths = [path for path in paths if path not in current]
+        # make it obvious that git-meld-index working does not apply this
+        # (left side) view back to the working copy changes (meld refuses
+        # to let you edit non-writeable files)
+        copier = TreeCopier(env, dest_dir, read_only=True, jobs=self._jobs,
+                            existing_dirs=existing_dirs)
+        copier.copy_many(
+            (os.path.join(abs_repo_path, path), path) for path in paths
+            if path not in placeholders)
+        for path in paths:
+            if path in placeholders:
+                copier.write(path, placeholders[path].render())
+        copier.finish()
+        if state_path is not None:
+            manifest.finish()
+            manifest.save(env, state_path, self._repo_path)
+
+    def apply(self, env, dir_, paths=None):
+        pass
 
 
-class VerboseWrapper:
+# from linux/fs.h
+FICLONE = 0x40049409
 
-    def __init__(self, env):
-        self._env = env
 
-    def cmd(self, args, input=None, tty=False):
-        if input is not None:
-            print("input:")
-            print(input)
-        pprint.pprint(args)
-        return self._env.cmd(args, input, tty)
+def _reflink(src_fd, dest_fd):
+    """Make dest share src's data blocks (btrfs, xfs, ...), if supported."""
+    if not sys.platform.startswith("linux"):
+        return False
+    import fcntl
+    try:
+        fcntl.ioctl(dest_fd, FICLONE, src_fd)
+    except OSError:
+        return False
+    return True
 
-    @classmethod
-    def make_readable(cls, readable_env):
-        return readable_env.wrap(cls)
 
+def _copy_file_range(src_fd, dest_fd):
+    """Copy in the kernel, without passing data through userspace."""
+    if not hasattr(os, "copy_file_range"):
+        return False
+    try:
+        while os.copy_file_range(src_fd, dest_fd, 1024 * 1024 * 1024):
+            pass
+    except OSError:
+        # the fallback copies from the start again
+        os.lseek(src_fd, 0, os.SEEK_SET)
+        os.lseek(dest_fd, 0, os.SEEK_SET)
+        os.ftruncate(dest_fd, 0)
+        return False
+    return True
 
-class NullWrapper:
 
-    def __init__(self, env):
-        self._env = env
+def copy_file(src, dest):
+    """Copy a file or symlink like cp -Pp, as cheaply as the filesystem allows."""
+    import shutil
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), dest)
+    else:
+        with open(src, "rb") as src_fh, open(dest, "wb") as dest_fh:
+            src_fd, dest_fd = src_fh.fileno(), dest_fh.fileno()
+            if not (_reflink(src_fd, dest_fd) or
+                    _copy_file_range(src_fd, dest_fd)):
+                shutil.copyfileobj(src_fh, dest_fh)
+    shutil.copystat(src, dest, follow_symlinks=False)
 
-    def cmd(self, args, input=None, tty=False):
-        return self._env.cmd(["true"])
 
-    @classmethod
-    def make_readable(cls, readable_env):
-        return ReadableEnv(env=NullWrapper(readable_env), read_env=readable_env)
+def _remove_write_permission(path):
+    os.chmod(path, os.stat(path).st_mode & ~0o222)
 
 
-def shell_escape(args):
-    return " ".join(shlex.quote(arg) for arg in args)
+class TreeCopier:
 
+    """Copy files into a directory tree in-process.
 
-class WorkArea:
+    Each directory is created only once, and (optionally) each file is made
+    read-only as soon as it is copied, with directories following at
+    .finish().  All work is done through env.call(), so --pretend and
+    --verbose work as for commands.
+    """
 
-    def __init__(self, env, work_dir):
+    def __init__(self, env, dest_dir, read_only=False, jobs=1,
+                 existing_dirs=()):
         self._env = env
-        self._work_dir = work_dir
+        self._dest_dir = os.path.abspath(dest_dir)
+        self._read_only = read_only
+        self._jobs = jobs
+        self._made_dirs = {self._dest_dir}
+        self._made_dirs.update(existing_dirs)
+
+    def _make_dir(self, dir_path):
+        if dir_path in self._made_dirs:
+            return
+        self._env.call(["mkdir", "-p", dir_path],
+                       functools.partial(os.makedirs, exist_ok=True), dir_path)
+        while dir_path not in self._made_dirs:
+            self._made_dirs.add(dir_path)
+            dir_path = os.path.dirname(dir_path)
+
+    def _copy(self, src, dest):
+        self._env.call(["cp", "-Pp", src, dest], copy_file, src, dest)
+        if self._read_only and not os.path.islink(src):
+            self._env.call(
+                ["chmod", "a-w", dest], _remove_write_permission, dest)
+
+    def copy(self, src, path):
+        """Copy src to path (relative to the destination directory).
+
+        Directories (e.g. submodules) are skipped: git meld-index doesn't
+        operate on submodules.
+        """
+        self.copy_many([(src, path)])
+
+    def write(self, path, data):
+        """Write data (bytes) to path, as for .copy()."""
+        dest = os.path.join(self._dest_dir, path)
+        self._make_dir(os.path.dirname(dest))
+        self._env.call(["write", dest], _write_bytes, dest, data)
+        if self._read_only:
+            self._env.call(
+                ["chmod", "a-w", dest], _remove_write_permission, dest)
+
+    def copy_many(self, items):
+        """Copy each (src, path) in items, as for .copy().
+
+        Directories are made first, then files are copied using up to jobs
+        threads.
+        """
+        copies = []
+        for src, path in items:
+            if os.path.isdir(src) and not os.path.islink(src):
+                continue
+            dest = os.path.join(self._dest_dir, path)
+            self._make_dir(os.path.dirname(dest))
+            copies.append((src, dest))
+        parallel_map(lambda copy: self._copy(*copy), copies, self._jobs)
 
-    def _write(self, view):
-        suggested_dir = os.path.join(self._work_dir, view.label)
-        self._env.cmd(["mkdir", "-p", suggested_dir])
-        dir_ = view.write(self._env, suggested_dir)
-        if dir_ is None:
-            dir_ = suggested_dir
-        return dir_
+    def finish(self):
+        if self._read_only:
+            for dir_path in sorted(self._made_dirs):
+                self._env.call(["chmod", "a-w", dir_path],
+                               _remove_write_permission, dir_path)
 
-    def _meld(self, left_dir, right_dir, tool, extcmd):
-        # usually working tree on left, index on right
-        env = PrefixCmdEnv.make_readable(in_dir(self._work_dir), self._env)
-        if tool:
-            env = PrefixCmdEnv.make_readable(
-                ["env", "GIT_DIFF_TOOL=" + tool], env)
-        cmd = extcmd if extcmd is not None else "git-meld-index-run-merge-tool"
-        env.cmd([cmd, left_dir, right_dir], tty=True)
 
-    def _apply(self, view, dir_):
-        view.apply(self._env, dir_)
+def _add_user_write_permission(path):
+    os.chmod(path, os.stat(path).st_mode | 0o200)
 
-    def meld(self, left_view, right_view, tool=None, extcmd=None):
-        left_dir = self._write(left_view)
-        right_dir = self._write(right_view)
-        self._meld(left_dir, right_dir, tool, extcmd)
-        self._apply(left_view, left_dir)
-        self._apply(right_view, right_dir)
 
+def prune_tree(env, dir_, keep):
+    """Remove everything under dir_ except directories and paths in keep.
 
-@dataclass
-class DiffRecord:
-    mode_after: str
-    mode_before: str
-    hash_after: str
-    hash_before: str
-    status: str
-    path: str
+    Directories left empty are then removed too (but not dir_ itself).  All
+    directories are made writable first.  Returns the absolute paths of the
+    directories that remain.
+    """
+    dir_ = os.path.abspath(dir_)
+    dirs = [dir_path for dir_path, dir_names, file_names in os.walk(dir_)]
+    for dir_path in dirs:
+        env.call(["chmod", "u+w", dir_path],
+                 _add_user_write_permission, dir_path)
+    for path in iter_files(dir_, include_symlinks=True):
+        if path not in keep:
+            full_path = os.path.join(dir_, path)
+            env.call(["rm", full_path], os.unlink, full_path)
+    remaining = set()
+    # deepest first, so that directories containing only empty directories
+    # are removed too
+    for dir_path in sorted(dirs, reverse=True):
+        if dir_path != dir_ and not os.listdir(dir_path):
+            env.call(["rmdir", dir_path], os.rmdir, dir_path)
+        else:
+            remaining.add(dir_path)
+    return remaining
 
 
-def pairwise(iterable):
-    iter_ = iter(iterable)
-    return zip(iter_, iter_)
+def make_parent_dirs(env, path):
+    dir_path = os.path.dirname(path)
+    if dir_path != "":
+        env.call(["mkdir", "-p", dir_path],
+                 functools.partial(os.makedirs, exist_ok=True), dir_path)
 
 
-def parse_raw_diff(diff, path):
-    mode_after, mode_before, hash_after, hash_before, status = diff.split(" ")
-    mode_after = mode_after.removeprefix(":")
-    return DiffRecord(
-        mode_after, mode_before, hash_after, hash_before, status, path)
+def _write_file_from_chunks(path, chunks, executable):
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    fd = os.open(path, flags, 0o777 if executable else 0o666)
+    with open(fd, "wb") as fh:
+        for chunk in chunks:
+            fh.write(chunk)
 
 
-def iter_diff_records(repo_env, cmd):
-    process = repo_env.read_cmd(cmd)
-    parts = [part.decode() for part in process.stdout_output.split(b"\0")]
-    assert parts[-1] == ""
-    for diff, path in pairwise(parts[:-1]):
-        yield parse_raw_diff(diff, path)
+class CatFileBatch:
 
+    """A long-lived git cat-file --batch process, for reading many blobs.
 
-def iter_diff_records_undeleted(repo_env, cmd):
-    for diff in iter_diff_records(repo_env, cmd):
-        if diff.status != "D":
-            yield diff
+    Blob contents are read in chunks of chunk_size bytes, so that large blobs
+    can be written out without ever being held in memory in full.
+    """
 
+    chunk_size = 64 * 1024
+
+    def __init__(self, repo_env):
+        self._args = ["git", "cat-file", "--batch"]
+        self._process = repo_env.read_popen(self._args)
+
+    def _request(self, hash_):
+        self._process.stdin.write(hash_.encode() + b"\n")
+        self._process.stdin.flush()
+        header = self._process.stdout.readline()
+        if not header.endswith(b"\n"):
+            self.close()
+            raise EOFError("git cat-file --batch exited unexpectedly")
+        fields = header.split()
+        if len(fields) != 3:
+            raise KeyError("object not found: {}".format(hash_))
+        return int(fields[2])
+
+    def _iter_chunks(self, size):
+        remaining = size
+        while remaining:
+            chunk = self._process.stdout.read(min(remaining, self.chunk_size))
+            if not chunk:
+                raise EOFError("git cat-file --batch exited unexpectedly")
+            remaining -= len(chunk)
+            yield chunk
+        # contents are followed by a newline
+        self._process.stdout.read(1)
+
+    def read_blob(self, hash_):
+        return b"".join(self._iter_chunks(self._request(hash_)))
+
+    def write_blob(self, env, hash_, dest_path, executable=False):
+        """Write blob contents to dest_path, creating the file in env."""
+        chunks = self._iter_chunks(self._request(hash_))
+        args = Command(["git", "cat-file", "blob", hash_], stdout=dest_path)
+        env.call(args, _write_file_from_chunks, dest_path, chunks, executable)
+        # consume anything env did not (e.g. with --pretend), to keep the
+        # process's output in step with our requests
+        for chunk in chunks:
+            pass
 
-class AbstractViewInterface:
+    def close(self):
+        if self._process is None:
+            return
+        process, self._process = self._process, None
+        output, stderr_output = process.communicate()
+        if process.returncode:
+            raise CalledProcessError(
+                process.returncode, self._args, output, stderr_output)
 
-    def write(self, env, dest_dir):
-        """Write view to dest_dir.
+    def __enter__(self):
+        return self
 
-        The work should be done by running commands in env.
+    def __exit__(self, type_, value, tb):
+        self.close()
 
-        Usually:
 
-        * This will copy files to dest_dir from a repository.
+_C_QUOTE_ESCAPES = {
+    ord("\a"): b"\\a", ord("\b"): b"\\b", ord("\t"): b"\\t",
+    ord("\n"): b"\\n", ord("\v"): b"\\v", ord("\f"): b"\\f",
+    ord("\r"): b"\\r", ord('"'): b'\\"', ord("\\"): b"\\\\",
+}
 
-        * env will be such that commands run in it will have their working
-          directory set to the top level of that repo.
-        """
 
-    def apply(self, env, dir_):
-        """Read view from dir_ and apply it to something.
+def c_quote(path):
+    """Quote path (bytes) the way git's line-oriented --stdin-paths inputs expect.
 
-        The work should be done by running commands in env.
+    Paths that need no quoting are returned unchanged.
+    """
+    if not any(byte < 0x20 or byte == 0x7f or byte in _C_QUOTE_ESCAPES
+               for byte in path):
+        return path
+    quoted = []
+    for byte in path:
+        if byte in _C_QUOTE_ESCAPES:
+            quoted.append(_C_QUOTE_ESCAPES[byte])
+        elif byte < 0x20 or byte == 0x7f:
+            quoted.append(b"\\%03o" % byte)
+        else:
+            quoted.append(bytes([byte]))
+    return b'"' + b"".join(quoted) + b'"'
 
-        Usually:
 
-        * This will apply changes to a repository (e.g. to the index), from a
-          set of files in dir_ that were copied from that repo by .write().
+# Below this many objects, hash_objects() writes loose objects, as git does
+# for fetches (see transfer.unpackLimit)
+PACK_OBJECTS_THRESHOLD = 100
 
-        * env will be such that commands run in it will have their working
-          directory set to the top level of that repo.
-        """
 
+def _hash_objects(repo_env, paths, config=()):
+    input_ = b"".join(c_quote(os.fsencode(path)) + b"\n" for path in paths)
+    hash_object = repo_env.cmd(
+        ["git"] + list(config) + ["hash-object", "-w", "--stdin-paths"],
+        input=input_)
+    return hash_object.stdout_output.decode().split("\n")[:-1]
 
-class StageableWorkingTreeSubsetView:
 
-    label = "working_tree"
+def _has_files(dir_):
+    return any(files for _, _, files in os.walk(dir_))
 
-    def __init__(self, repo_path):
-        self._repo_path = repo_path
 
-    def _untracked(self, env):
-        process = env.read_cmd(
-            ["git", "ls-files", "-z", "--others", "--exclude-standard"])
-        return [f.decode() for f in process.stdout_output.split(b"\0")[:-1]]
+def hash_objects(repo_env, paths, pack_threshold=PACK_OBJECTS_THRESHOLD):
+    """Write files at paths to the object database, returning their hashes.
 
-    def _modified(self, env):
-        for diff in iter_diff_records_undeleted(
-                env, ["git", "diff-index", "-z", "HEAD"]):
-            yield diff.path
+    A single git hash-object process is fed every path on stdin and reads back
+    one hash per path, rather than paying git's startup cost once per file.
 
-    def write(self, env, dest_dir):
-        repo_env = PrefixCmdEnv.make_readable(in_dir(self._repo_path), env)
-        abs_repo_path = os.path.abspath(self._repo_path)
-        dest_env = PrefixCmdEnv.make_readable(in_dir(dest_dir), env)
-        paths = itertools.chain(
-            self._untracked(repo_env),
-            self._modified(repo_env))
-        for path in paths:
-            dir_path = os.path.dirname(path)
-            if dir_path != "":
-                dest_env.cmd(["mkdir", "-p", dir_path])
-            dest_env.cmd([
-                "cp", "-Pp", os.path.join(abs_repo_path, path), path])
-        # make it obvious that git-meld-index working does not apply this
-        # (left side) view back to the working copy changes (meld refuses
-        # to let you edit non-writeable files)
-        dest_env.cmd(["chmod", "-R", "a-w", dest_dir])
+    If there are at least pack_threshold paths, the new objects are written to
+    a single pack, rather than to one loose object (and one fsync) per file.
+    To do that, hash-object writes them without fsync to a temporary object
+    directory (as git does to quarantine incoming objects), and then
+    pack-objects packs those that were not already in the repository.
+    Content filters are applied as usual, since hash-object still reads the
+    files.  This needs git 2.31 or later: with older versions, objects are
+    always written loose.
+    """
+    if not paths:
+        return []
+    if len(paths) < pack_threshold:
+        return _hash_objects(repo_env, paths)
+    objects_dir = repo_env.read_cmd(
+        ["git", "rev-parse", "--path-format=absolute", "--git-path",
+         "objects"]).stdout_output.decode().splitlines()[-1]
+    if not os.path.isabs(objects_dir):
+        # git before 2.31 echoes the --path-format it doesn't know, then
+        # gives a relative path: write loose objects as for few paths
+        return _hash_objects(repo_env, paths)
+    # in the object directory, so the pack can be renamed into place
+    import shutil
+    import tempfile
+    prefix = "tmp_objdir-git-meld-index-"
+    temp_dir = repo_env.call(
+        ["mktemp", "-d", "-p", objects_dir, prefix + "XXXXXX"],
+        tempfile.mkdtemp, "", prefix, objects_dir)
+    if temp_dir is None:
+        # --pretend: there is nothing to quarantine
+        return _hash_objects(repo_env, paths)
+    try:
+        quarantine_env = PrefixCmdEnv.make_readable(
+            with_env(GIT_OBJECT_DIRECTORY=temp_dir,
+                     GIT_ALTERNATE_OBJECT_DIRECTORIES=objects_dir),
+            repo_env)
+        hashes = _hash_objects(
+            quarantine_env, paths, ["-c", "core.fsync=none"])
+        if _has_files(temp_dir):
+            # --local: only the objects in temp_dir
+            quarantine_env.cmd(
+                ["git", "pack-objects", "--local", "--quiet",
+                 os.path.join(objects_dir, "pack", "pack")],
+                input="".join(hash_ + "\n" for hash_ in hashes).encode())
+    finally:
+        repo_env.call(["rm", "-rf", temp_dir], shutil.rmtree, temp_dir)
+    return hashes
+
+
+class GitWorkers:
+
+    """Long-lived git processes for one repository, shared between sessions.
+
+    The daemon keeps these warm, so that its sessions need not each start
+    git cat-file and git hash-object.  Each process is started on first use,
+    and again if it has exited.  Sessions using them must not overlap.
+    """
 
-    def apply(self, env, dir_):
-        pass
+    def __init__(self, repo_env):
+        self._repo_env = repo_env
+        self._cat_file = None
+        self._hash_object = None
+
+    def cat_file(self):
+        """Return a CatFileBatch, which should not be closed."""
+        if (self._cat_file is None or self._cat_file._process is None or
+                self._cat_file._process.poll() is not None):
+            self._cat_file = CatFileBatch(self._repo_env)
+        return self._cat_file
+
+    def hash_objects(self, paths):
+        """As hash_objects(), using a warm git hash-object if few paths."""
+        if not paths:
+            return []
+        if len(paths) >= PACK_OBJECTS_THRESHOLD:
+            return hash_objects(self._repo_env, paths)
+        if self._hash_object is None or self._hash_object.poll() is not None:
+            self._hash_object = self._repo_env.popen(
+                ["git", "hash-object", "-w", "--stdin-paths"])
+        process = self._hash_object
+        # few enough that the hashes fit in the pipe, so all paths can be
+        # written before reading
+        process.stdin.write(b"".join(
+            c_quote(os.fsencode(path)) + b"\n" for path in paths))
+        process.stdin.flush()
+        hashes = []
+        for path in paths:
+            line = process.stdout.readline()
+            if not line.endswith(b"\n"):
+                self._hash_object = None
+                output, stderr_output = process.communicate()
+                raise CalledProcessError(
+                    process.returncode,
+                    ["git", "hash-object", "-w", "--stdin-paths"],
+                    output, stderr_output)
+            hashes.append(line.decode().rstrip("\n"))
+        return hashes
+
+    def close(self):
+        if self._cat_file is not None:
+            self._cat_file.close()
+            self._cat_file = None
+        if self._hash_object is not None:
+            process, self._hash_object = self._hash_object, None
+            process.communicate()
 
 
 def ensure_trailing_slash(path):
@@ -330,6 +3024,169 @@ def make_git_permission_string(is_link, is_executable):
         return "100755" if is_executable else "100644"
 
 
+def hash_blob(path, size, hash_name):
+    """Return the hash git would give the contents of file path as a blob."""
+    import hashlib
+    hash_ = hashlib.new(hash_name)
+    hash_.update(b"blob %d\0" % size)
+    if size:
+        with open(path, "rb") as fh, \
+                mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            hash_.update(data)
+    return hash_.hexdigest()
+
+
+# object format (hash function) of a repository, by the length of its hashes
+HASH_NAMES = {40: "sha1", 64: "sha256"}
+
+
+@dataclass
+class ManifestEntry:
+    mode: str
+    hash: str
+    size: int
+    mtime_ns: int
+
+
+class Manifest:
+
+    """Records the files a view wrote, as they were when it wrote them.
+
+    This lets .apply() skip files the user did not change: usually almost
+    all of them.  It can also be saved, so that a later session writing to
+    the same directory need only write what has changed since.
+
+    A saved manifest records no HEAD oid or index checksum.  Each path is
+    checked against the mode and blob wanted for it now, and against the
+    stat of the file left in the directory.  That catches every change
+    that matters to the path, and no others: a new HEAD or index that wants
+    the same blob needn't rewrite it.  A whole-repo checksum couldn't save
+    any of that work, because the status snapshot that says what is wanted
+    is needed anyway, and so is the stat that finds files edited since.
+    """
+
+    # version of the format written by .save()
+    version = 1
+
+    def __init__(self, entries=None, timestamp_ns=None):
+        if entries is None:
+            entries = {}
+        self._entries = entries
+        self._timestamp_ns = timestamp_ns
+
+    @classmethod
+    def load(cls, state_path, repo_path):
+        """Load a manifest saved for repo_path, or return an empty one."""
+        import json
+        try:
+            with open(state_path) as fh:
+                state = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            return cls()
+        if (state.get("version") != cls.version or
+                state.get("repo") != os.path.abspath(repo_path)):
+            return cls()
+        entries = {path: ManifestEntry(*fields)
+                   for path, fields in state["entries"].items()}
+        return cls(entries, state["timestamp_ns"])
+
+    def save(self, env, state_path, repo_path):
+        state = {
+            "version": self.version,
+            "repo": os.path.abspath(repo_path),
+            "timestamp_ns": self._timestamp_ns,
+            "entries": {path: dataclasses.astuple(entry)
+                        for path, entry in self._entries.items()},
+        }
+        env.call(["write", state_path], _write_json, state_path, state)
+
+    def get(self, path):
+        return self._entries.get(path)
+
+    def keep(self, path, entry):
+        """Add an entry carried over from another manifest."""
+        self._entries[path] = entry
+
+    def add(self, dir_, path, mode, hash_):
+        try:
+            stat = os.lstat(os.path.join(dir_, path))
+        except FileNotFoundError:
+            # e.g. with --pretend
+            return
+        self._entries[path] = ManifestEntry(
+            mode, hash_, stat.st_size, stat.st_mtime_ns)
+
+    def finish(self):
+        self._timestamp_ns = time.time_ns()
+
+    def is_racy(self, entry):
+        # As for git's "racily clean" index entries: a file written in the
+        # same second that we finished writing could have been changed again
+        # without its size or mtime changing, so its stat can't be trusted
+        return (self._timestamp_ns is None or
+                entry.mtime_ns >= self._timestamp_ns // 10**9 * 10**9)
+
+    def is_current(self, path, mode, hash_, dest_path):
+        """Return True if dest_path is still as written for path with the
+        given mode and blob hash.
+        """
+        entry = self._entries.get(path)
+        if (entry is None or self.is_racy(entry) or
+                (entry.mode, entry.hash) != (mode, hash_)):
+            return False
+        try:
+            stat = os.lstat(dest_path)
+        except FileNotFoundError:
+            return False
+        return (entry.size, entry.mtime_ns) == (stat.st_size, stat.st_mtime_ns)
+
+    def is_unchanged(self, path, mode, src_path, stat):
+        """Return True if file src_path still has the mode and contents that
+        were written to path.
+
+        stat is os.lstat(src_path).
+        """
+        entry = self._entries.get(path)
+        if entry is None or entry.mode != mode:
+            return False
+        if entry.size != stat.st_size:
+            return False
+        if entry.mtime_ns == stat.st_mtime_ns and not self.is_racy(entry):
+            return True
+        hash_name = HASH_NAMES.get(len(entry.hash))
+        if hash_name is None:
+            return False
+        return hash_blob(src_path, stat.st_size, hash_name) == entry.hash
+
+
+def _write_json(path, data):
+    # write then rename, so that the file is never seen half-written
+    import json
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as fh:
+        json.dump(data, fh)
+    os.replace(temp_path, path)
+
+
+def _is_regular_file(path):
+    try:
+        return stat_module.S_ISREG(os.lstat(path).st_mode)
+    except FileNotFoundError:
+        return False
+
+
+def iter_files(dir_, include_symlinks=False):
+    """Generate paths (relative to dir_) of regular files under dir_."""
+    for dir_path, dir_names, file_names in os.walk(dir_):
+        # symlinks to directories are listed in dir_names (but not followed)
+        for name in file_names + dir_names:
+            path = os.path.join(dir_path, name)
+            mode = os.lstat(path).st_mode
+            if stat_module.S_ISREG(mode) or (
+                    include_symlinks and stat_module.S_ISLNK(mode)):
+                yield os.path.relpath(path, dir_)
+
+
 class IndexOrHeadView:
 
     """View of files:
@@ -342,22 +3199,90 @@ class IndexOrHeadView:
     (partially or fully) stage modified and untracked files.
 
     All files in the view's directory are apply()ied to the index, regardless
-    of whether they were there at .write() time.
+    of whether they were there at .write() time, except for placeholders.
+    If placeholders (a PlaceholderPolicy) is given, files it selects are
+    written as placeholders, which are never staged.  A placeholder that was
+    edited, or copied from the other side, isn't staged either, but a
+    warning names it.  If workers (a
+    GitWorkers) is given, its git processes are used rather than new ones.
+    If index_path (the repository's index file) is given, apply() reads it
+    in-process, and leaves out files already staged as they are: if none
+    differ, git update-index isn't run at all.
     """
 
     label = "index"
 
-    def __init__(self, repo_path):
+    def __init__(self, repo_path, snapshots=None, jobs=None,
+                 placeholders=None, workers=None, index_path=None):
         self._repo_path = repo_path
-
-    def check_out_head(self, repo_env, path, dest_path):
-        # check out HEAD to dest_path
-        ls_tree = repo_env.read_cmd(["git", "ls-tree", "HEAD", path])
-        mode, type_, hash_path = ls_tree.stdout_output.decode().split(" ")
-        hash_, _ = hash_path.split("\t")
-        dest_dir_path = os.path.dirname(dest_path)
-        if dest_dir_path != "":
-            repo_env.cmd(["mkdir", "-p", dest_dir_path])
+        self._index_path = index_path
+        if snapshots is None:
+            snapshots = RepoSnapshots()
+        self._snapshots = snapshots
+        if jobs is None:
+            jobs = default_jobs()
+        self._jobs = jobs
+        self._placeholder_policy = placeholders
+        self._workers = workers
+        self._manifests = {}
+        self._state_paths = {}
+        # {abs dest dir: {path: placeholder contents as written}}
+        self._placeholder_contents = {}
+
+    def _cat_file(self, repo_env):
+        if self._workers is None:
+            return CatFileBatch(repo_env)
+        return contextlib.nullcontext(self._workers.cat_file())
+
+    def _hash_objects(self, repo_env, paths):
+        if self._workers is None:
+            return hash_objects(repo_env, paths)
+        return self._workers.hash_objects(paths)
+
+    def _placeholders(self, repo_env, entries):
+        # entries maps path to (mode, hash)
+        if self._placeholder_policy is None:
+            return {}
+        hashes = {path: hash_ for path, (mode, hash_) in entries.items()
+                  if mode in ("100644", "100755")}
+        sizes = blob_sizes(repo_env, set(hashes.values()))
+        placeholders = self._placeholder_policy.find(
+            repo_env, {path: sizes[hash_] for path, hash_ in hashes.items()},
+            cached=True)
+        pointers = []
+        for placeholder in placeholders.values():
+            placeholder.oid = hashes[placeholder.path]
+            if (placeholder.reason == "lfs" and
+                    placeholder.size < LFS_POINTER_MAX_SIZE):
+                pointers.append(placeholder)
+        if pointers:
+            with self._cat_file(repo_env) as cat_file:
+                for placeholder in pointers:
+                    placeholder.read_lfs_pointer(
+                        cat_file.read_blob(placeholder.oid))
+        return placeholders
+
+    def _staged_entries(self, repo_env, entries, hashes):
+        # the (permission, path, hash) of entries already staged as they are
+        # (e.g. files edited and then changed back), from the index as it is
+        # now, rather than as it was when the view was written
+        if self._index_path is None or not hashes:
+            # not known, or nothing was hashed (e.g. under --pretend)
+            return set()
+        index = load_index(repo_env, self._index_path, len(hashes[0]) // 2)
+        staged = set()
+        for (permission, path), hash_ in zip(entries, hashes):
+            entry = index.get(path)
+            # staging an intent-to-add entry records its content, even if
+            # that is what the entry already says
+            if (entry is not None and entry.intent_to_add is False and
+                    entry.mode == permission and entry.hash == hash_):
+                staged.add((permission, path, hash_))
+        return staged
+
+    def check_out_head(self, repo_env, cat_file, mode, hash_, dest_path):
+        # check out HEAD tree entry (mode, hash_) to dest_path
+        make_parent_dirs(repo_env, dest_path)
         if mode == "160000":
             # submodule
             # git meld-index doesn't operate on submodules. if you want to meld
@@ -366,26 +3291,20 @@ class IndexOrHeadView:
             return
         if mode == "120000":
             # symlink
-            cat_file_cmd = ["git", "cat-file", "blob", hash_]
-            link = dest_path
-            target = repo_env.cmd(cat_file_cmd).stdout_output.decode()
-            repo_env.cmd(["ln", "-sT", target, link])
+            target = os.fsdecode(cat_file.read_blob(hash_))
+            repo_env.call(
+                ["ln", "-sT", target, dest_path], os.symlink, target, dest_path)
         else:
             # regular file
-            cat_file_cmd = ["git", "cat-file", "blob", hash_]
-            shell_cmd = " > ".join([
-                shell_escape(cat_file_cmd), shlex.quote(dest_path)])
-            repo_env.cmd(["sh", "-c", shell_cmd])
-            if mode == "100755":
-                repo_env.cmd(["chmod", "+x", dest_path])
-
-    def write(self, env, dest_dir):
+            cat_file.write_blob(
+                repo_env, hash_, dest_path, executable=(mode == "100755"))
+
+    def write(self, env, dest_dir, state_path=None):
         repo_env = PrefixCmdEnv.make_readable(in_dir(self._repo_path), env)
         dest_prefix = ensure_trailing_slash(dest_dir)
-        index_diffs = iter_diff_records_undeleted(
-            env, ["git", "diff-index", "-z", "--cached", "HEAD"])
-        index_paths = set()
-        for diff in index_diffs:
+        snapshot = self._snapshots.get(env, self._repo_path)
+        checkout_paths = []
+        for record in snapshot.index_changes():
             # Note that in the unmerged state, typically the index contains
             # *three* versions of your file (which you can see using `git
             # ls-files -u`): the common ancestor, HEAD, and MERGE_HEAD.  We
@@ -399,39 +3318,160 @@ class IndexOrHeadView:
             # working copy version with conflict markers using "copy to right"
             # and then resolve the conflict markers on the right hand side, all
             # in meld.
-            if diff.status != "U":
-                repo_env.cmd(["git", "checkout-index", "--prefix={}".format(dest_prefix), diff.path])
-            index_paths.add(diff.path)
-
-        # Use HEAD for modified files not already in index
-        working_diffs = iter_diff_records_undeleted(
-            env, ["git", "diff-index", "-z", "HEAD"])
-        working_tree_paths = [d.path for d in working_diffs]
-        for path in working_tree_paths:
-            if path not in index_paths:
-                dest_path = os.path.join(dest_dir, path)
-                self.check_out_head(repo_env, path, dest_path)
-
-    def apply(self, env, dir_):
+            if record.index_status != "U":
+                checkout_paths.append(record)
+        abs_dest_dir = os.path.abspath(dest_dir)
+        manifest = Manifest()
+        # Use HEAD for modified files not already in index.  The snapshot has
+        # their HEAD modes and hashes, so git need not be asked for them.
+        # Intent-to-add files are not in HEAD.
+        head_entries = {
+            record.path: (record.mode_head, record.hash_head)
+            for record in snapshot.worktree_only_changes()
+            if record.mode_head != "000000"}
+        wanted = {record.path: (record.mode_index, record.hash_index)
+                  for record in checkout_paths}
+        wanted.update(head_entries)
+        placeholders = self._placeholders(repo_env, wanted)
+        for path, placeholder in placeholders.items():
+            wanted[path] = (PLACEHOLDER_MODE, placeholder.oid)
+        checkout_paths = [record for record in checkout_paths
+                          if record.path not in placeholders]
+        head_paths = [path for path in head_entries
+                      if path not in placeholders]
+        placeholder_paths = list(placeholders)
+
+        if state_path is not None:
+            # Keep files from an earlier session that are still as they
+            # should be, and remove everything else
+            previous = Manifest.load(state_path, self._repo_path)
+            current = set()
+            for path, (mode, hash_) in wanted.items():
+                if previous.is_current(
+                        path, mode, hash_, os.path.join(abs_dest_dir, path)):
+                    current.add(path)
+                    manifest.keep(path, previous.get(path))
+            prune_tree(env, abs_dest_dir, current)
+            checkout_paths = [record for record in checkout_paths
+                              if record.path not in current]
+            head_paths = [path for path in head_paths if path not in current]
+            placeholder_paths = [path for path in placeholder_paths
+                                 if path not in current]
+
+        def check_out_index():
+            if not checkout_paths:
+                return
+            # One checkout-index for all paths, so the index is read, and any
+            # clean/smudge filter processes started, only once
+            repo_env.cmd(
+                ["git", "checkout-index", "--stdin", "-z",
+                 "--prefix={}".format(dest_prefix)],
+                input=b"".join(
+                    os.fsencode(record.path) + b"\0"
+                    for record in checkout_paths))
+            for record in checkout_paths:
+                manifest.add(abs_dest_dir, record.path,
+                             record.mode_index, record.hash_index)
+
+        def check_out_head():
+            if not head_paths:
+                return
+            with self._cat_file(repo_env) as cat_file:
+                for path in head_paths:
+                    mode, hash_ = head_entries[path]
+                    dest_path = os.path.join(abs_dest_dir, path)
+                    self.check_out_head(
+                        repo_env, cat_file, mode, hash_, dest_path)
+                    manifest.add(abs_dest_dir, path, mode, hash_)
+
+        def write_placeholders():
+            for path in placeholder_paths:
+                dest_path = os.path.join(abs_dest_dir, path)
+                make_parent_dirs(repo_env, dest_path)
+                repo_env.call(["write", dest_path], _write_bytes, dest_path,
+                              placeholders[path].render())
+                manifest.add(abs_dest_dir, path, *wanted[path])
+
+        write_placeholders()
+        # the two sets of paths are disjoint, so can be written at the same
+        # time
+        call_all([check_out_index, check_out_head], min(self._jobs, 2))
+        manifest.finish()
+        self._manifests[abs_dest_dir] = manifest
+        self._placeholder_contents[abs_dest_dir] = {
+            path: placeholder.render()
+            for path, placeholder in placeholders.items()}
+        if state_path is not None:
+            self._state_paths[abs_dest_dir] = state_path
+            manifest.save(env, state_path, self._repo_path)
+
+    def apply(self, env, dir_, paths=None):
         abs_repo_path = os.path.abspath(self._repo_path)
         repo_env = PrefixCmdEnv.make_readable(in_dir(abs_repo_path), env)
-        src_env = PrefixCmdEnv.make_readable(in_dir(dir_), env)
-        find = src_env.read_cmd(["find", ".", "-type", "f", "-print0"])
-        paths = [p.decode() for p in find.stdout_output.split(b"\0")]
-        assert paths[-1] == "", paths
-        for path in paths[:-1]:
-            if path.startswith("./"):
-                path = path[2:]
-            src_path = os.path.join(dir_, path)
-            is_link = try_cmd(src_env, ["test", "-h", path])
-            is_executable = try_cmd(src_env, ["test", "-x", path])
-            permission = make_git_permission_string(is_link, is_executable)
-            hash_object = repo_env.cmd(["git", "hash-object", "-w", src_path])
-            hash_ = hash_object.stdout_output.decode().removesuffix("\n")
-            index_info = "{} {}\t{}".format(permission, hash_, path)
+        abs_dir = os.path.abspath(dir_)
+        manifest = self._manifests.get(abs_dir, Manifest())
+        placeholder_contents = self._placeholder_contents.get(abs_dir, {})
+        if paths is None:
+            paths = iter_files(abs_dir)
+        else:
+            # e.g. from an InotifyWatcher: some may since have been removed,
+            # or be symlinks or directories
+            paths = [path for path in sorted(paths)
+                     if _is_regular_file(os.path.join(abs_dir, path))]
+        paths = [path for path in paths
+                 if self._snapshots.pathspecs.matches(path)]
+
+        def check(path):
+            src_path = os.path.join(abs_dir, path)
+            is_executable = os.access(src_path, os.X_OK)
+            permission = make_git_permission_string(False, is_executable)
+            unchanged = manifest.is_unchanged(
+                path, permission, src_path, os.lstat(src_path))
+            ignored = False
+            if not unchanged and is_placeholder(src_path):
+                # a placeholder stands for content that isn't in the view,
+                # so is never staged.  Only one left just as it was written
+                # is expected; any other was edited or copied from the other
+                # side.
+                with open(src_path, "rb") as fh:
+                    ignored = fh.read() != placeholder_contents.get(path)
+                unchanged = True
+            return unchanged, ignored, permission, src_path
+
+        entries = []
+        src_paths = []
+        ignored_paths = []
+        # checking may mean hashing file contents, so is done in parallel
+        for path, (skip, ignored, permission, src_path) in zip(
+                paths, parallel_map(check, paths, self._jobs)):
+            if ignored:
+                ignored_paths.append(path)
+            if not skip:
+                entries.append((permission, path))
+                src_paths.append(src_path)
+        if ignored_paths:
+            print("git-meld-index: not staging placeholders that were edited "
+                  "or copied: {}".format(" ".join(sorted(ignored_paths))),
+                  file=sys.stderr)
+        hashes = self._hash_objects(repo_env, src_paths)
+        staged = self._staged_entries(repo_env, entries, hashes)
+        index_info = [
+            "{} {}\t{}\0".format(permission, hash_, path)
+            for (permission, path), hash_ in zip(entries, hashes)
+            if (permission, path, hash_) not in staged]
+        # One update-index for all paths: the index is locked and rewritten
+        # once, and if anything goes wrong the index is left untouched
+        if index_info:
             repo_env.cmd(
-                ["git", "update-index", "--index-info"],
-                input=index_info.encode())
+                ["git", "update-index", "-z", "--index-info"],
+                input=os.fsencode("".join(index_info)))
+        state_path = self._state_paths.get(abs_dir)
+        if state_path is not None:
+            # record what is now staged, for the next session
+            for (permission, path), hash_ in zip(entries, hashes):
+                manifest.add(abs_dir, path, permission, hash_)
+            manifest.finish()
+            manifest.save(env, state_path, self._repo_path)
 
 
 class Cleanups:
@@ -458,7 +3498,7 @@ class Cleanups:
             try:
                 func()
             except:
-                log.exception("Exception cleaning up: {}".format(func))
+                _log().exception("Exception cleaning up: {}".format(func))
                 failed = True
             self._cleanups.pop()
         if failed:
@@ -491,6 +3531,7 @@ class TempMaker:
         self._rmtree = rmtree
 
     def make_temp_dir(self):
+        import tempfile
         prefix = "tmp-git_meld_index{}-".format(self._prefix)
         temp_dir = tempfile.mkdtemp(prefix=prefix)
 
@@ -501,7 +3542,17 @@ class TempMaker:
         return temp_dir
 
 
-def make_view(url_or_refspec):
+def make_view(url_or_refspec, snapshots=None, jobs=None, limits=None,
+              placeholders=None, workers=None, index_path=None):
+    """Make a view from a URL such as working:<repo path>.
+
+    Views made with the same snapshots (a RepoSnapshots) share the work of
+    examining each repository.  jobs limits the number of threads a view
+    uses to write or apply files.  limits (an UntrackedLimits) applies to
+    working: views.  placeholders (a PlaceholderPolicy) selects files to
+    write as placeholders.  index: views use workers (a GitWorkers), and
+    read index_path (the repository's index file), if given.
+    """
     scheme, sep, dir_path = url_or_refspec.partition(":")
     if dir_path == "":
         dir_path = "."
@@ -512,16 +3563,446 @@ def make_view(url_or_refspec):
         # TODO: at the moment there is not much point in having this on the
         # right, because the .apply() method does not copy edited files
         # back to the working copy (so any edits are discarded on exit).
-        return StageableWorkingTreeSubsetView(dir_path)
+        return StageableWorkingTreeSubsetView(
+            dir_path, snapshots, jobs, limits, placeholders)
     elif scheme_colon == "index:":
         # TODO: this may not make much sense on the left at the moment.
-        return IndexOrHeadView(dir_path)
+        return IndexOrHeadView(
+            dir_path, snapshots, jobs, placeholders, workers, index_path)
     else:
         raise UnknownURISchemeError(
             "unknown URI scheme: {} "
             "(try running git-meld-index without arguments)".format(scheme))
 
 
+DAEMON_PROTOCOL_VERSION = 3
+DAEMON_IDLE_TIMEOUT = 600
+# seconds a client waits for a daemon it started to begin listening
+DAEMON_START_TIMEOUT = 10
+
+
+class DaemonError(Exception):
+    pass
+
+
+def daemon_repo_dir(dir_):
+    """Return (top of the working tree containing dir_, dir_'s prefix).
+
+    This is what git rev-parse --show-toplevel --show-prefix would say, with
+    symlinks resolved, but found without starting git, so that a client can
+    reach a running daemon quickly.  If dir_ is not in a working tree, it is
+    its own top.
+    """
+    dir_ = os.path.realpath(dir_)
+    top = dir_
+    while not os.path.exists(os.path.join(top, ".git")):
+        parent = os.path.dirname(top)
+        if parent == top:
+            return dir_, ""
+        top = parent
+    prefix = os.path.relpath(dir_, top)
+    return top, "" if prefix == "." else prefix + "/"
+
+
+def daemon_socket_path(dir_):
+    """Return the socket path of the daemon for the repository holding dir_.
+
+    Sockets are kept in a directory private to the user, under
+    $XDG_RUNTIME_DIR (or the temporary directory), and named by a hash of
+    the top of the working tree (see daemon_repo_dir()), because socket
+    paths are limited in length.
+    """
+    import hashlib
+    import tempfile
+    base = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    top, _ = daemon_repo_dir(dir_)
+    name = hashlib.sha1(os.fsencode(top)).hexdigest()
+    return os.path.join(
+        base, "git-meld-index-{}".format(os.getuid()), name[:20] + ".sock")
+
+
+def _make_private_dir(path):
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    stat = os.lstat(path)
+    if (not stat_module.S_ISDIR(stat.st_mode) or
+            stat.st_uid != os.getuid() or stat.st_mode & 0o077):
+        raise DaemonError(
+            "{} is not a directory private to this user".format(path))
+
+
+def _send_message(fh, message):
+    import json
+    # JSON escapes the surrogates os.fsdecode() uses for undecodable bytes
+    # in paths, so they survive the trip
+    fh.write(json.dumps(message).encode() + b"\n")
+    fh.flush()
+
+
+def _receive_message(fh):
+    import json
+    line = fh.readline()
+    if not line:
+        raise DaemonError("connection closed")
+    return json.loads(line)
+
+
+def _stat_key(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _user_config_paths():
+    home = os.path.expanduser("~")
+    xdg_config = os.environ.get("XDG_CONFIG_HOME") or os.path.join(
+        home, ".config")
+    return [os.path.join(home, ".gitconfig"),
+            os.path.join(xdg_config, "git", "config")]
+
+
+class Daemon:
+
+    """Serves sessions for one repository to clients, over a Unix socket.
+
+    The repository is the one containing the directory the daemon is started
+    in.  Between sessions, the daemon keeps its location, its configuration
+    (re-read if a config file changes), warm git processes (a GitWorkers)
+    and, while nothing has changed, its snapshot.  The snapshot is reused
+    only if the index, HEAD, the configuration and the exclude files outside
+    the working tree are unchanged (by their stat) and, according to a
+    TreeWatcher, so is the working tree; without inotify, each session gets
+    a new snapshot.
+
+    Each connection carries one request and its response: JSON objects, one
+    per line.  Connections are served one at a time.  The daemon exits after
+    idle_timeout seconds without a request, unless a session it prepared
+    has not yet been applied or aborted.  Sessions whose client has exited
+    without doing either are dropped then.
+    """
+
+    def __init__(self, env, socket_path, idle_timeout=DAEMON_IDLE_TIMEOUT):
+        self._env = env
+        self._socket_path = socket_path
+        self._idle_timeout = idle_timeout
+        self._repo_dir, self._prefix = env.read_cmd(
+            ["git", "rev-parse", "--show-toplevel", "--show-prefix"]
+        ).stdout_output.decode().split("\n")[:2]
+        repo_env = PrefixCmdEnv.make_readable(in_dir(self._repo_dir), env)
+        # not --path-format=absolute, which needs git 2.31: the paths are
+        # relative to the top, where this runs
+        (self._index_path, self._head_path, config_path, self._exclude_path,
+         self._common_dir) = [
+            os.path.abspath(os.path.join(self._repo_dir, path))
+            for path in repo_env.read_cmd(
+                ["git", "rev-parse", "--git-path", "index", "--git-path",
+                 "HEAD", "--git-path", "config", "--git-path", "info/exclude",
+                 "--git-common-dir"]
+            ).stdout_output.decode().split("\n")[:5]]
+        self._repo_env = repo_env
+        self._workers = GitWorkers(repo_env)
+        self._config_paths = [config_path] + _user_config_paths()
+        self._config = None
+        self._config_key = None
+        self._snapshots = None
+        self._snapshots_key = None
+        try:
+            self._watcher = TreeWatcher(self._repo_dir)
+        except OSError:
+            self._watcher = None
+        self._sessions = {}
+        self._session_ids = itertools.count(1)
+
+    def _read_config(self):
+        key = [_stat_key(path) for path in self._config_paths]
+        if key != self._config_key:
+            self._config = read_config(self._repo_env)
+            self._config_key = key
+        return self._config
+
+    def _repo_state(self):
+        # changes whenever the index or HEAD does
+        paths = [self._index_path, self._head_path,
+                 os.path.join(self._common_dir, "packed-refs")]
+        try:
+            with open(self._head_path) as fh:
+                head = fh.read()
+        except FileNotFoundError:
+            head = ""
+        if head.startswith("ref: "):
+            paths.append(os.path.join(self._common_dir, head[5:].strip()))
+        return head, [_stat_key(path) for path in paths]
+
+    def _excludes_state(self):
+        # changes whenever an exclude file the TreeWatcher doesn't see does
+        excludes_file = self._config.get("core.excludesfile")
+        if excludes_file is None:
+            xdg_config = os.environ.get("XDG_CONFIG_HOME") or os.path.join(
+                os.path.expanduser("~"), ".config")
+            excludes_file = os.path.join(xdg_config, "git", "ignore")
+        excludes_file = os.path.join(
+            self._repo_dir, os.path.expanduser(excludes_file))
+        return [_stat_key(path)
+                for path in [self._exclude_path, excludes_file]]
+
+    def _get_snapshots(self, pathspecs, git_options):
+        # events since the last session, whether or not we reuse the snapshot
+        changed = None
+        if self._watcher is not None:
+            self._watcher.poll(0)
+            changed = self._watcher.take()
+        # the configuration was read for this session already
+        key = (pathspecs.git_args(), list(git_options), self._repo_state(),
+               self._config_key, self._excludes_state())
+        if changed != set() or key != self._snapshots_key:
+            self._snapshots = RepoSnapshots(pathspecs, git_options)
+            self._snapshots_key = key
+        return self._snapshots
+
+    def prepare(self, work_dir, pathspecs=(), prefix=None, left=None,
+                right=None, persistent=False, untracked_cache=False,
+                max_untracked_files=None, max_file_size=None,
+                placeholders=None, placeholder_size=None, jobs=None,
+                client_pid=None):
+        """Write a session's views to work_dir, as WorkArea.write() does.
+
+        pathspecs are relative to prefix, the client's directory in the
+        working tree (by default, the daemon's).  client_pid is the client's
+        process id, if known.  The other arguments are as for the command
+        line options of the same names.
+        """
+        if prefix is None:
+            prefix = self._prefix
+        config = self._read_config()
+        limits = UntrackedLimits.from_config(
+            config, max_untracked_files, max_file_size)
+        placeholder_policy = PlaceholderPolicy.from_config(
+            config, placeholders, placeholder_size)
+        git_options = status_git_options(
+            self._repo_env, self._index_path, untracked_cache, config)
+        snapshots = self._get_snapshots(
+            Pathspecs.parse(pathspecs, prefix), git_options)
+        views = [
+            make_view(left or "working:" + self._repo_dir, snapshots, jobs,
+                      limits, placeholder_policy, self._workers),
+            # the index is only known to be right's if right is the default
+            make_view(right or "index:" + self._repo_dir, snapshots, jobs,
+                      limits, placeholder_policy, self._workers,
+                      self._index_path if right is None else None)]
+        work_area = WorkArea(self._env, work_dir, jobs, persistent)
+        dirs = work_area.write(*views)
+        session = next(self._session_ids)
+        self._sessions[session] = (work_area, views, dirs, client_pid)
+        warnings = [format_skipped(view.skipped) for view in views
+                    if getattr(view, "skipped", None)]
+        return dict(session=session, left_dir=dirs[0], right_dir=dirs[1],
+                    warnings=warnings)
+
+    def apply(self, session, paths=None):
+        """Apply a session written by .prepare(), as WorkArea.apply() does."""
+        work_area, views, dirs, _ = self._pop_session(session)
+        if paths is not None:
+            paths = set(paths)
+        work_area.apply(*views, *dirs, paths=paths)
+        return {}
+
+    def abort(self, session):
+        """Forget a session written by .prepare(), without applying it."""
+        self._pop_session(session)
+        return {}
+
+    def _pop_session(self, session):
+        try:
+            return self._sessions.pop(session)
+        except KeyError:
+            raise DaemonError("no such session: {}".format(session))
+
+    def _drop_orphaned_sessions(self):
+        # sessions whose client was killed before it could apply or abort
+        for session, (_, _, _, client_pid) in list(self._sessions.items()):
+            if client_pid is not None and not _process_exists(client_pid):
+                del self._sessions[session]
+
+    def _handle(self, request):
+        op = request.pop("op", None)
+        if op == "hello":
+            return dict(version=DAEMON_PROTOCOL_VERSION, pid=os.getpid(),
+                        repo=self._repo_dir)
+        elif op == "prepare":
+            return self.prepare(**request)
+        elif op == "apply":
+            return self.apply(**request)
+        elif op == "abort":
+            return self.abort(**request)
+        elif op == "shutdown":
+            self._running = False
+            return {}
+        raise DaemonError("unknown request: {}".format(op))
+
+    def _serve_connection(self, connection):
+        with connection, connection.makefile("rwb") as fh:
+            try:
+                request = _receive_message(fh)
+            except (DaemonError, ValueError):
+                return
+            try:
+                response = self._handle(request)
+            except (DaemonError, PathspecError, CalledProcessError,
+                    ValueError, TypeError, OSError) as exc:
+                response = dict(error="{}: {}".format(
+                    type(exc).__name__, exc))
+            try:
+                _send_message(fh, response)
+            except OSError:
+                # the client went away
+                pass
+
+    def _bind(self):
+        import socket
+        _make_private_dir(os.path.dirname(self._socket_path))
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(self._socket_path)
+        except OSError as exc:
+            if exc.errno != errno.EADDRINUSE:
+                listener.close()
+                raise
+            try:
+                # is another daemon listening?
+                DaemonClient(self._socket_path).request("hello")
+            except (OSError, DaemonError):
+                # no: the socket was left behind
+                os.unlink(self._socket_path)
+                listener.bind(self._socket_path)
+            else:
+                listener.close()
+                return None
+        listener.listen()
+        return listener
+
+    def serve(self):
+        """Serve requests until idle or asked to shut down.
+
+        Returns at once if another daemon is already serving the socket.
+        """
+        import socket
+        listener = self._bind()
+        if listener is None:
+            return
+        self._running = True
+        try:
+            listener.settimeout(self._idle_timeout)
+            while self._running:
+                try:
+                    connection, _ = listener.accept()
+                except socket.timeout:
+                    self._drop_orphaned_sessions()
+                    if not self._sessions:
+                        break
+                    continue
+                connection.settimeout(None)
+                self._serve_connection(connection)
+        finally:
+            listener.close()
+            os.unlink(self._socket_path)
+            self._workers.close()
+            if self._watcher is not None:
+                self._watcher.close()
+
+
+class DaemonClient:
+
+    """Sends requests to a Daemon."""
+
+    def __init__(self, socket_path):
+        self._socket_path = socket_path
+
+    def request(self, op, **args):
+        """Send a request, returning the response.
+
+        Raises OSError if no daemon is listening, and DaemonError if the
+        request failed.
+        """
+        import socket
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self._socket_path)
+            with sock.makefile("rwb") as fh:
+                _send_message(fh, dict(args, op=op))
+                response = _receive_message(fh)
+        if "error" in response:
+            raise DaemonError(response["error"])
+        return response
+
+    def _is_current(self):
+        try:
+            hello = self.request("hello")
+        except OSError:
+            return False
+        if hello.get("version") == DAEMON_PROTOCOL_VERSION:
+            return True
+        # started by a different version of git-meld-index
+        self.request("shutdown")
+        return False
+
+    def ensure_started(self, idle_timeout=DAEMON_IDLE_TIMEOUT, dir_=None):
+        """Start a daemon in dir_ (or here), unless one is running."""
+        if self._is_current():
+            return
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--serve-daemon",
+             "--daemon-idle-timeout", str(idle_timeout)],
+            cwd=dir_, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, start_new_session=True)
+        deadline = time.monotonic() + DAEMON_START_TIMEOUT
+        while not self._is_current():
+            if time.monotonic() > deadline:
+                raise DaemonError("daemon did not start")
+            time.sleep(0.02)
+
+
+def meld_with_daemon(env, work_dir, session_args, tool=None, extcmd=None,
+                     watch=False, idle_timeout=DAEMON_IDLE_TIMEOUT):
+    """Run a session whose views are written and applied by a Daemon.
+
+    The daemon for the repository holding the current directory is started
+    (at the top of the working tree) if it is not running.  session_args are
+    passed to Daemon.prepare().
+    """
+    top, prefix = daemon_repo_dir(os.getcwd())
+    client = DaemonClient(daemon_socket_path(top))
+    client.ensure_started(idle_timeout, top)
+    response = client.request(
+        "prepare", work_dir=work_dir, prefix=prefix, client_pid=os.getpid(),
+        **session_args)
+    for warning in response["warnings"]:
+        print(warning, file=sys.stderr)
+    work_area = WorkArea(env, work_dir, watch=watch)
+    applied = False
+    try:
+        paths = work_area.run_tool(
+            response["left_dir"], response["right_dir"], tool, extcmd)
+        client.request("apply", session=response["session"],
+                       paths=None if paths is None else sorted(paths))
+        applied = True
+    finally:
+        if not applied:
+            # e.g. interrupted, or the tool failed: let the daemon forget
+            # the session, so that it can exit once idle
+            with contextlib.suppress(OSError, DaemonError):
+                client.request("abort", session=response["session"])
+
+
 def add_basic_env_arguments(add_argument):
     add_argument("-v", "--verbose", action="store_true",
                  help="Print commands")
@@ -529,8 +4010,11 @@ def add_basic_env_arguments(add_argument):
                  help="Don't actually run commands")
 
 
-def get_env_from_arguments(arguments):
-    env = BasicEnv.make_readable()
+def get_env_from_arguments(arguments, profile=None, env=None):
+    if env is None:
+        env = BasicEnv.make_readable()
+    if profile is not None:
+        env = TimingWrapper.make_readable(env, profile)
     if arguments.pretend:
         env = NullWrapper.make_readable(env)
     if arguments.verbose:
@@ -539,17 +4023,30 @@ def get_env_from_arguments(arguments):
 
 
 def repo_dir_cmd():
-    return ["git", "rev-parse", "--show-toplevel"]
+    return ["git", "rev-parse", "--show-toplevel", "--show-prefix",
+            "--git-path", "index"]
+
+
+def split_pathspec_args(args):
+    """Split command line arguments at "--" into (options, pathspecs)."""
+    if "--" in args:
+        index = args.index("--")
+        return args[:index], args[index + 1:]
+    return args, []
 
 
 def chmod_and_rmtree(env, dirpath):
+    import shutil
     env.cmd(["chmod", "-R", "u+w", dirpath])
     shutil.rmtree(dirpath)
 
 
 def _main(prog, args):
+    import argparse
     parser = argparse.ArgumentParser(
-        prog=os.path.basename(prog), description=__doc__)
+        prog=os.path.basename(prog), description=__doc__,
+        epilog="Arguments after -- are pathspecs: only matching paths are "
+        "shown in the diff tool and staged.")
     add_basic_env_arguments(parser.add_argument)
     # Note there's also a manpage, which is what git meld-index --help shows
     parser.add_argument(
@@ -573,35 +4070,138 @@ def _main(prog, args):
         "--work-dir",
         help="Directory to use instead of temporary directory.  "
         "This won't be removed on exit.")
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=None,
+        help="Number of threads to use to write and apply files.  "
+        "Defaults to the number of CPUs.")
+    parser.add_argument(
+        "--persistent", default=False, action="store_true",
+        help="Reuse files left in --work-dir by an earlier run, updating "
+        "only what has changed since.  Requires --work-dir.")
+    parser.add_argument(
+        "--watch", default=False, action="store_true",
+        help="Record which files are saved while the diff tool runs "
+        "(using inotify, on Linux), and afterwards stage only those, rather "
+        "than checking every file")
+    parser.add_argument(
+        "--live", default=False, action="store_true",
+        help="As --watch, but also stage each file shortly after it is "
+        "saved, while the diff tool is still running")
+    parser.add_argument(
+        "--daemon", default=False, action="store_true",
+        help="Have a background daemon for this repository (started if need "
+        "be) write and apply the files, keeping git processes, "
+        "configuration and repository state warm between runs")
+    parser.add_argument(
+        "--daemon-idle-timeout", metavar="SECONDS", type=float,
+        default=DAEMON_IDLE_TIMEOUT,
+        help="With --daemon, a daemon started exits after SECONDS without "
+        "a request (default {})".format(DAEMON_IDLE_TIMEOUT))
+    parser.add_argument(
+        "--stop-daemon", default=False, action="store_true",
+        help="Stop the daemon for this repository, if running")
+    parser.add_argument(
+        "--serve-daemon", default=False, action="store_true",
+        help="Run the daemon for this repository in the foreground")
+    parser.add_argument(
+        "--untracked-cache", default=False, action="store_true",
+        help="Enable git's untracked cache (and built-in file system "
+        "monitor, where available) to speed up finding untracked files, and "
+        "let git save it in the index for later runs")
+    parser.add_argument(
+        "--max-untracked-files", metavar="N", type=parse_count, default=None,
+        help="Show at most N untracked files, leaving out the largest "
+        "directories of untracked files first (0 for no limit).  "
+        "Defaults to meldIndex.maxUntrackedFiles, or no limit.")
+    parser.add_argument(
+        "--max-file-size", metavar="SIZE", type=parse_size, default=None,
+        help="Leave out untracked files larger than SIZE bytes (suffixes k, "
+        "m and g are allowed; 0 for no limit).  Defaults to "
+        "meldIndex.maxFileSize, or no limit.")
+    parser.add_argument(
+        "--placeholders", default=None, action="store_true",
+        help="Write small placeholder files, which are never staged, in "
+        "place of Git LFS files, files marked binary (or -diff) and files "
+        "larger than --placeholder-size.  Defaults to "
+        "meldIndex.placeholders.")
+    parser.add_argument(
+        "--no-placeholders", dest="placeholders", action="store_false",
+        help="Copy all files, even if meldIndex.placeholders is set")
+    parser.add_argument(
+        "--placeholder-size", metavar="SIZE", type=parse_size, default=None,
+        help="With --placeholders, files larger than SIZE bytes get "
+        "placeholders (suffixes k, m and g are allowed; 0 for no limit).  "
+        "Defaults to meldIndex.placeholderSize, or {}m.".format(
+            DEFAULT_PLACEHOLDER_SIZE // 1024 ** 2))
     parser.add_argument(
         "--no-cleanup", dest="cleanup",
         default=True, action="store_false",
         help="Don't remove temporary files passed to difftool")
+    parser.add_argument(
+        "--profile", metavar="FILE",
+        help="Write a JSON report of where time was spent to FILE")
+    parser.add_argument(
+        "--cprofile", metavar="FILE",
+        help="With --profile, also write Python profiler (cProfile) "
+        "statistics for the main thread to FILE")
     parser.add_argument(
         "left", nargs="?", default=None,
         help="Not really useful as yet hence undocumented")
     parser.add_argument(
         "right", nargs="?", default=None,
         help="Not really useful as yet hence undocumented")
+    args, pathspec_args = split_pathspec_args(args)
     arguments = parser.parse_args(args)
+    if arguments.persistent and arguments.work_dir is None:
+        parser.error("--persistent requires --work-dir")
+    if arguments.cprofile is not None and arguments.profile is None:
+        parser.error("--cprofile requires --profile")
+    if arguments.daemon and (arguments.pretend or arguments.live or
+                             arguments.verbose or arguments.profile):
+        # the daemon runs the commands, so these would have no effect
+        parser.error("--daemon can't be used with --pretend, --live, "
+                     "--verbose or --profile")
     work_dir = arguments.work_dir
+    if work_dir is not None:
+        # views write some files in-process, and some by running commands in
+        # the repository, so don't leave this relative to either
+        work_dir = os.path.abspath(work_dir)
     if arguments.cleanup:
         cleanups = Cleanups()
     else:
         cleanups = NullCleanups()
     atexit.register(cleanups.clean_up)
-    env = get_env_from_arguments(arguments)
+    profile = None
+    if arguments.profile is not None:
+        profile = Profile(arguments.cprofile)
+        profile.start()
+    env = get_env_from_arguments(arguments, profile)
     if arguments.tool_help:
         print(env.cmd(["git", "mergetool", "--tool-help"]).stdout_output.decode())
         return 0
 
-    repo_dir = env.read_cmd(repo_dir_cmd()).stdout_output.decode().removesuffix("\n")
-    left = arguments.left
-    if left is None:
-        left = "working:" + repo_dir
-    right = arguments.right
-    if right is None:
-        right = "index:" + repo_dir
+    if arguments.serve_daemon:
+        # sessions may write both views and run several git processes at
+        # once, so the daemon, which may serve a long time, keeps to --jobs
+        # processes at a time
+        sync_env = SyncEnv(AsyncBasicEnv(arguments.jobs))
+        try:
+            daemon_env = get_env_from_arguments(
+                arguments, profile, ReadableEnv(sync_env, sync_env))
+            Daemon(daemon_env, daemon_socket_path(os.getcwd()),
+                   arguments.daemon_idle_timeout).serve()
+        finally:
+            sync_env.close()
+        return 0
+    if arguments.stop_daemon:
+        try:
+            DaemonClient(daemon_socket_path(os.getcwd())).request(
+                "shutdown")
+        except OSError:
+            # not running
+            pass
+        return 0
+
     tool = arguments.tool
     if arguments.gui:
         try:
@@ -609,18 +4209,82 @@ def _main(prog, args):
                     .stdout_output.removesuffix(b"\0").decode())
         except CalledProcessError:
             pass
-    with cleanups:
-        make_temp_dir = TempMaker(
-            functools.partial(chmod_and_rmtree, env), cleanups.add_cleanup).make_temp_dir
-        if work_dir is None:
-            work_dir = make_temp_dir()
-        work_area = WorkArea(env, work_dir)
+
+    if arguments.daemon:
+        session_args = dict(
+            pathspecs=pathspec_args, left=arguments.left,
+            right=arguments.right, persistent=arguments.persistent,
+            untracked_cache=arguments.untracked_cache,
+            max_untracked_files=arguments.max_untracked_files,
+            max_file_size=arguments.max_file_size,
+            placeholders=arguments.placeholders,
+            placeholder_size=arguments.placeholder_size, jobs=arguments.jobs)
+
+        def meld(work_dir):
+            meld_with_daemon(
+                env, work_dir, session_args, tool, arguments.extcmd,
+                arguments.watch, arguments.daemon_idle_timeout)
+    else:
+        repo_dir, prefix, index_path = env.read_cmd(
+            repo_dir_cmd()).stdout_output.decode().split("\n")[:3]
+        config = read_config(env)
         try:
-            left_view = make_view(left)
-            right_view = make_view(right)
+            limits = UntrackedLimits.from_config(
+                config, arguments.max_untracked_files, arguments.max_file_size)
+            placeholders = PlaceholderPolicy.from_config(
+                config, arguments.placeholders, arguments.placeholder_size)
+        except ValueError as exc:
+            parser.error(str(exc))
+        status_options = status_git_options(
+            env, os.path.abspath(index_path), arguments.untracked_cache,
+            config)
+        try:
+            pathspecs = Pathspecs.parse(pathspec_args, prefix)
+        except PathspecError as exc:
+            parser.error(str(exc))
+        left = arguments.left
+        if left is None:
+            left = "working:" + repo_dir
+        right = arguments.right
+        right_index_path = None
+        if right is None:
+            right = "index:" + repo_dir
+            right_index_path = os.path.abspath(index_path)
+        try:
+            snapshots = RepoSnapshots(
+                pathspecs, status_options,
+                None if profile is None else profile.note)
+            left_view = make_view(
+                left, snapshots, arguments.jobs, limits, placeholders)
+            right_view = make_view(
+                right, snapshots, arguments.jobs, limits, placeholders,
+                index_path=right_index_path)
         except UnknownURISchemeError as exc:
             parser.error(str(exc))
-        work_area.meld(left_view, right_view, tool, arguments.extcmd)
+
+        def meld(work_dir):
+            work_area = WorkArea(
+                env, work_dir, arguments.jobs, persistent=arguments.persistent,
+                watch=arguments.watch, live=arguments.live)
+            work_area.meld(left_view, right_view, tool, arguments.extcmd)
+
+    def clean_up_temp_dir(path):
+        with phase("cleanup"):
+            chmod_and_rmtree(env, path)
+
+    try:
+        with cleanups:
+            make_temp_dir = TempMaker(
+                clean_up_temp_dir, cleanups.add_cleanup).make_temp_dir
+            if work_dir is None:
+                work_dir = make_temp_dir()
+            meld(work_dir)
+    except DaemonError as exc:
+        print("git-meld-index: daemon: {}".format(exc), file=sys.stderr)
+        return 1
+    finally:
+        if profile is not None:
+            profile.write(arguments.profile)
     return 0
 
 
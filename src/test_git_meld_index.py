@@ -1,10 +1,19 @@
+import asyncio
+import dataclasses
 import errno
 import functools
+import io
+import json
 import os
 import subprocess
 import sys
+import threading
+import time
+import tracemalloc
 import unittest
+from unittest import mock
 
+import benchmark_git_meld_index
 import git_meld_index
 import list_tree
 
@@ -250,6 +259,30 @@ exec "$@"
     return ["sh", "-c", set_path_script, "inline_script"]
 
 
+class RecordingWrapper:
+
+    """Env wrapper that records the commands run (for use with .wrap())."""
+
+    def __init__(self, env, commands):
+        self._env = env
+        self._commands = commands
+
+    def cmd(self, args, input=None, tty=False):
+        self._commands.append((args, input))
+        return self._env.cmd(args, input, tty)
+
+    def popen(self, args):
+        self._commands.append((args, None))
+        return self._env.popen(args)
+
+    def call(self, args, func, *func_args):
+        return self._env.call(args, func, *func_args)
+
+
+def strip_in_dir(args):
+    return git_meld_index.as_command(args).argv
+
+
 class WriteViewMixin:
 
     def assert_write_golden(
@@ -321,6 +354,1047 @@ class TestStageableWorkingTreeSubsetView(TestCase, WriteViewMixin):
             env, self.make_view,
             "test_write_stageable_working_tree_subset_symlink")
 
+    def test_write_read_only(self):
+        env = self.make_env()
+        make_standard_repo(env, "sub/dir/")
+        path = env.cmd(["readlink", "-e", "."]).stdout_output.decode().removesuffix("\n")
+        out = self.make_temp_dir()
+        self.make_view(path).write(env, out)
+        for name in [".", "sub", "sub/dir", "sub/dir/untracked",
+                     "sub/dir/modified"]:
+            self.assertEqual(
+                os.stat(os.path.join(out, name)).st_mode & 0o222, 0, name)
+        self.assertEqual(
+            read_file(os.path.join(out, "sub/dir/modified")),
+            "modified (initial)\nmodified (modified)\n")
+
+    def test_write_pretend(self):
+        env = self.make_env()
+        make_standard_repo(env)
+        path = env.cmd(["readlink", "-e", "."]).stdout_output.decode().removesuffix("\n")
+        out = self.make_temp_dir()
+        self.make_view(path).write(
+            git_meld_index.NullWrapper.make_readable(env), out)
+        self.assertEqual(os.listdir(out), [])
+        self.assertNotEqual(os.stat(out).st_mode & 0o200, 0)
+
+    def test_write_untracked_limits(self):
+        env = self.make_env()
+        make_standard_repo(env)
+        path = env.cmd(["readlink", "-e", "."]).stdout_output.decode().removesuffix("\n")
+        os.mkdir(os.path.join(path, "build"))
+        for index in range(5):
+            write_file(os.path.join(path, "build", "out{}".format(index)), "")
+        write_file(os.path.join(path, "big"), "x" * 100)
+        out = self.make_temp_dir()
+        limits = git_meld_index.UntrackedLimits(max_files=3, max_file_size=50)
+        view = self.make_view(path, limits=limits)
+        stderr = io.StringIO()
+        with mock.patch.object(sys, "stderr", stderr):
+            view.write(env, out)
+        listing = os.listdir(out)
+        self.assertIn("untracked", listing)
+        self.assertNotIn("big", listing)
+        self.assertNotIn("build", listing)
+        self.assertEqual(view.skipped, [
+            git_meld_index.SkippedUntracked("big", 1, "size", 100),
+            git_meld_index.SkippedUntracked(
+                "build/", 4, "count", truncated=True)])
+        self.assertEqual(stderr.getvalue(), """\
+git-meld-index: not showing at least 5 untracked files:
+  big (100 bytes, over --max-file-size)
+  build/ (at least 4 files, over --max-untracked-files)
+""")
+
+
+class TestUntrackedLimits(TestCase):
+
+    def test_parse_size(self):
+        self.assertEqual(git_meld_index.parse_size("0"), 0)
+        self.assertEqual(git_meld_index.parse_size("12"), 12)
+        self.assertEqual(git_meld_index.parse_size("3k"), 3 * 1024)
+        self.assertEqual(git_meld_index.parse_size("2M"), 2 * 1024 ** 2)
+        self.assertEqual(git_meld_index.parse_size("1g"), 1024 ** 3)
+        for value in ["", "k", "-1", "1.5m", "1t"]:
+            self.assertRaises(ValueError, git_meld_index.parse_size, value)
+
+    def test_from_config(self):
+        from_config = git_meld_index.UntrackedLimits.from_config
+        self.assertEqual(from_config({}), git_meld_index.UntrackedLimits())
+        # there are no limits unless configured
+        self.assertEqual(from_config({}), git_meld_index.UntrackedLimits(0, 0))
+        config = {"meldindex.maxuntrackedfiles": "0",
+                  "meldindex.maxfilesize": "1k"}
+        self.assertEqual(from_config(config),
+                         git_meld_index.UntrackedLimits(0, 1024))
+        self.assertEqual(from_config(config, 5, 6),
+                         git_meld_index.UntrackedLimits(5, 6))
+        with self.assertRaisesRegex(ValueError, "meldIndex.maxFileSize"):
+            from_config({"meldindex.maxfilesize": "big"})
+        # a count, not a size
+        with self.assertRaisesRegex(
+                ValueError, "meldIndex.maxUntrackedFiles"):
+            from_config({"meldindex.maxuntrackedfiles": "10k"})
+
+    def test_no_limits(self):
+        env = self.make_env()
+        paths = ["a/{}".format(index) for index in range(10)]
+        limits = git_meld_index.UntrackedLimits(0, 0)
+        # no file or git access is needed
+        self.assertEqual(
+            git_meld_index.limit_untracked(env, "/nonexistent", paths, limits),
+            (paths, []))
+
+    def test_directories_collapsed(self):
+        env = self.make_env()
+        env.cmd(["git", "init", "-q"])
+        env.cmd(["mkdir", "-p", "tracked", "b/c", "d"])
+        env.cmd(["touch", "tracked/file"])
+        env.cmd(["git", "add", "tracked/file"])
+        paths = ["tracked/new", "top", "b/1", "b/2", "b/c/1", "b/c/2",
+                 "b/c/3", "d/1", "d/2"]
+        env.cmd(["touch"] + paths)
+        path = env.cmd(["readlink", "-e", "."]).stdout_output.decode().removesuffix("\n")
+        entries = git_meld_index.RepoSnapshot.from_repo(env).untracked
+        # b/ and its subdirectory are collapsed into one
+        self.assertEqual(list(entries), ["b/", "d/", "top", "tracked/new"])
+        limit = functools.partial(
+            git_meld_index.limit_untracked, env, path, entries)
+        kept, skipped = limit(git_meld_index.UntrackedLimits(4, 0))
+        self.assertEqual(kept, ["d/1", "d/2", "top", "tracked/new"])
+        self.assertEqual(skipped, [git_meld_index.SkippedUntracked(
+            "b/", 5, "count", truncated=True)])
+        # files outside those directories go last
+        kept, skipped = limit(git_meld_index.UntrackedLimits(1, 0))
+        self.assertEqual(kept, ["tracked/new"])
+        self.assertEqual([item.path for item in skipped], ["b/", "d/", "top"])
+
+    def test_huge_directory_not_listed(self):
+        env = self.make_env()
+        env.cmd(["git", "init", "-q"])
+        env.cmd(["mkdir", "a", "big", "small"])
+        env.cmd(["touch"] + ["big/{}".format(index) for index in range(10)] +
+                ["a/1", "small/1", "small/2"])
+        path = env.cmd(["readlink", "-e", "."]).stdout_output.decode().removesuffix("\n")
+        entries = git_meld_index.RepoSnapshot.from_repo(env).untracked
+        commands = []
+        kept, skipped = git_meld_index.limit_untracked(
+            env.wrap(functools.partial(RecordingWrapper, commands=commands)),
+            path, entries, git_meld_index.UntrackedLimits(3, 0))
+        self.assertEqual(kept, ["a/1", "small/1", "small/2"])
+        self.assertEqual(skipped, [git_meld_index.SkippedUntracked(
+            "big/", 4, "count", truncated=True)])
+        # listing stopped after the fourth file in big/, then started again
+        # for small/ only, since a/ was already listed in full
+        self.assertEqual(
+            [args[args.index("--") + 1:] for args, _ in commands],
+            [["a/", "big/", "small/"], ["small/"]])
+
+    def test_deleted_since_status(self):
+        env = self.make_env()
+        path = self.make_temp_dir()
+        write_file(os.path.join(path, "kept"), "")
+        limits = git_meld_index.UntrackedLimits(0, 10)
+        self.assertEqual(
+            git_meld_index.limit_untracked(
+                env, path, ["gone", "kept"], limits),
+            (["kept"], []))
+
+    def test_format_skipped(self):
+        skipped = [git_meld_index.SkippedUntracked("f{}".format(index), 1,
+                                                   "size", 10)
+                   for index in range(4)]
+        self.assertEqual(git_meld_index.format_skipped(skipped, 2), """\
+git-meld-index: not showing 4 untracked files:
+  f0 (10 bytes, over --max-file-size)
+  f1 (10 bytes, over --max-file-size)
+  ... and 2 more""")
+
+
+LFS_POINTER = """\
+version https://git-lfs.github.com/spec/v1
+oid sha256:4d7a214614ab2935c943f9e0ff69d22eadbb8f32b1258daaa5e2ca24d17e2393
+size 12345
+"""
+
+
+class TestPlaceholders(TestCase):
+
+    policy = git_meld_index.PlaceholderPolicy(max_size=100)
+
+    def make_repo(self, env):
+        repo = Repo(env)
+        repo.add_unmodified(
+            ".gitattributes", "*.bin binary\n*.lfs filter=lfs -text\n")
+        repo.add_modified_staged("image.bin", "image\n", "changed\n")
+        repo.add_new_staged("asset.lfs", LFS_POINTER)
+        repo.add_modified("big", "x" * 200 + "\n", "more\n")
+        repo.add_modified("small", "small\n", "more\n")
+        repo.add_untracked("new.bin", "new\n")
+        return env.cmd(["readlink", "-e", "."]).stdout_output.decode().removesuffix("\n")
+
+    def test_from_config(self):
+        from_config = git_meld_index.PlaceholderPolicy.from_config
+        self.assertIsNone(from_config({}))
+        self.assertIsNone(from_config({"meldindex.placeholders": "true"},
+                                      enabled=False))
+        self.assertEqual(from_config({}, enabled=True),
+                         git_meld_index.PlaceholderPolicy())
+        config = {"meldindex.placeholders": "yes",
+                  "meldindex.placeholdersize": "2k"}
+        self.assertEqual(from_config(config),
+                         git_meld_index.PlaceholderPolicy(2048))
+        self.assertEqual(from_config(config, max_size=0),
+                         git_meld_index.PlaceholderPolicy(0))
+
+    def test_index_or_head_view(self):
+        env = self.make_env()
+        path = self.make_repo(env)
+        out = self.make_temp_dir()
+        view = git_meld_index.IndexOrHeadView(path, placeholders=self.policy)
+        view.write(env, out)
+        for name in ["image.bin", "asset.lfs", "big"]:
+            self.assertTrue(
+                git_meld_index.is_placeholder(os.path.join(out, name)), name)
+        self.assertEqual(read_file(os.path.join(out, "small")), "small\n")
+        hash_ = env.cmd(["git", "rev-parse", "HEAD:big"]).stdout_output.decode()
+        big = read_file(os.path.join(out, "big"))
+        self.assertIn("\npath: big\nsize: 201\noid: {}".format(hash_), big)
+        self.assertIn("larger than --placeholder-size", big)
+        asset = read_file(os.path.join(out, "asset.lfs"))
+        self.assertIn("\nlfs-oid: sha256:4d7a2146", asset)
+        self.assertIn("\nlfs-size: 12345\n", asset)
+        self.assertIn("diff attribute is unset",
+                      read_file(os.path.join(out, "image.bin")))
+
+        # placeholders are never staged, even if edited or copied from the
+        # other side, but those are warned about
+        def index():
+            return env.cmd(["git", "ls-files", "-s"]).stdout_output
+
+        def apply():
+            stderr = io.StringIO()
+            with mock.patch.object(sys, "stderr", stderr):
+                view.apply(env, out)
+            return stderr.getvalue()
+        before = index()
+        self.assertEqual(apply(), "")
+        self.assertEqual(index(), before)
+        with open(os.path.join(out, "big"), "a") as fh:
+            fh.write("edited\n")
+        left = self.make_temp_dir()
+        git_meld_index.StageableWorkingTreeSubsetView(
+            path, placeholders=self.policy).write(env, left)
+        write_file(os.path.join(out, "new.bin"),
+                   read_file(os.path.join(left, "new.bin")))
+        self.assertEqual(
+            apply(), "git-meld-index: not staging placeholders that were "
+            "edited or copied: big new.bin\n")
+        self.assertEqual(index(), before)
+        with open(os.path.join(out, "small"), "a") as fh:
+            fh.write("edited\n")
+        view.apply(env, out)
+        self.assertEqual(
+            env.cmd(["git", "show", ":small"]).stdout_output,
+            b"small\nedited\n")
+
+    def test_stageable_working_tree_subset_view(self):
+        env = self.make_env()
+        path = self.make_repo(env)
+        out = self.make_temp_dir()
+        git_meld_index.StageableWorkingTreeSubsetView(
+            path, placeholders=self.policy).write(env, out)
+        self.assertEqual(
+            sorted(os.listdir(out)),
+            ["asset.lfs", "big", "image.bin", "new.bin", "small"])
+        for name in ["asset.lfs", "big", "image.bin", "new.bin"]:
+            placeholder = os.path.join(out, name)
+            self.assertTrue(git_meld_index.is_placeholder(placeholder), name)
+            self.assertEqual(os.stat(placeholder).st_mode & 0o222, 0)
+        self.assertIn("\npath: big\nsize: 206\n",
+                      read_file(os.path.join(out, "big")))
+        # without git-lfs, the working tree file is the pointer
+        self.assertIn("\nlfs-size: 12345\n",
+                      read_file(os.path.join(out, "asset.lfs")))
+        self.assertEqual(
+            read_file(os.path.join(out, "small")), "small\nmore\n")
+
+    def test_persistent_write_without_placeholders(self):
+        env = self.make_env()
+        path = self.make_repo(env)
+        work_dir = self.make_temp_dir()
+        out = os.path.join(work_dir, "view")
+        os.mkdir(out)
+        state_path = os.path.join(work_dir, "view.state.json")
+        git_meld_index.IndexOrHeadView(path, placeholders=self.policy).write(
+            env, out, state_path=state_path)
+        # placeholders from the earlier session are replaced by the files
+        git_meld_index.IndexOrHeadView(path).write(
+            env, out, state_path=state_path)
+        self.assertEqual(read_file(os.path.join(out, "big")), "x" * 200 + "\n")
+
+
+class TestPersistentWrite(TestCase):
+
+    def write_twice(self, env, make_view, change_repo):
+        path = env.cmd(["readlink", "-e", "."]).stdout_output.decode().removesuffix("\n")
+        work_dir = self.make_temp_dir()
+        out = os.path.join(work_dir, "view")
+        os.mkdir(out)
+        state_path = os.path.join(work_dir, "view.state.json")
+        time_ns = time.time_ns
+        # avoid files being "racily clean", which would be rewritten
+        with mock.patch.object(git_meld_index.time, "time_ns",
+                               lambda: time_ns() + 2 * 10**9):
+            make_view(path).write(env, out, state_path=state_path)
+        inodes = {name: os.lstat(os.path.join(out, name)).st_ino
+                  for name in os.listdir(out)}
+        change_repo()
+        make_view(path).write(env, out, state_path=state_path)
+        return out, inodes
+
+    def test_index_or_head_view(self):
+        env = self.make_env()
+        make_standard_repo(env)
+
+        def change_repo():
+            env.cmd(["git", "add", "partially_staged"])
+            env.cmd(["git", "reset", "-q", "--", "new_staged"])
+        out, inodes = self.write_twice(
+            env, git_meld_index.IndexOrHeadView, change_repo)
+        self.assertEqual(
+            sorted(os.listdir(out)),
+            ["changed_type", "changed_type_staged", "modified",
+             "modified_staged", "partially_staged", "rename_after"])
+        self.assertEqual(os.lstat(os.path.join(out, "modified")).st_ino,
+                         inodes["modified"])
+        self.assertEqual(read_file(os.path.join(out, "partially_staged")),
+                         "partially staged\nmore\n")
+
+    def test_stageable_working_tree_subset_view(self):
+        env = self.make_env()
+        make_standard_repo(env, "sub/")
+
+        def change_repo():
+            env.cmd(append_file_cmd("sub/modified", "more\n"))
+            env.cmd(["rm", "sub/untracked"])
+        out, inodes = self.write_twice(
+            env, git_meld_index.StageableWorkingTreeSubsetView, change_repo)
+        sub = os.path.join(out, "sub")
+        self.assertNotIn("untracked", os.listdir(sub))
+        self.assertEqual(
+            read_file(os.path.join(sub, "modified")),
+            "modified (initial)\nmodified (modified)\nmore\n")
+        listing = list_tree.ls_tree(out)
+        self.assertIn("new_staged", listing)
+        for name in ["", "sub", "sub/modified", "sub/new_staged"]:
+            self.assertEqual(
+                os.stat(os.path.join(out, name)).st_mode & 0o222, 0, name)
+
+
+class TestProfile(TestCase):
+
+    def test_profile_report(self):
+        env = self.make_env()
+        make_standard_repo(env)
+        repo_path = env.cmd(["readlink", "-e", "."]).stdout_output.decode().removesuffix("\n")
+        report_path = os.path.join(self.make_temp_dir(), "profile.json")
+        cprofile_path = os.path.join(self.make_temp_dir(), "cprofile")
+        subprocess.check_call(
+            [sys.executable, os.path.join(self.this_dir, "git_meld_index.py"),
+             "--extcmd", "true", "--profile", report_path,
+             "--cprofile", cprofile_path],
+            cwd=repo_path)
+        with open(report_path) as fh:
+            report = json.load(fh)
+        self.assertTrue(os.path.exists(cprofile_path))
+        self.assertLessEqual(
+            {"snapshot", "write-left", "write-right", "tool", "apply",
+             "cleanup"},
+            set(report["phases"]))
+        self.assertEqual(report["phases"]["snapshot"]["processes"], 1)
+        # the status process is streamed, but its output is still counted
+        self.assertGreater(report["phases"]["snapshot"]["stdout_bytes"], 0)
+        self.assertEqual(report["phases"]["tool"]["commands"], 1)
+        self.assertEqual(
+            report["processes"],
+            sum(totals["processes"] for totals in report["phases"].values()))
+        seconds = [record["seconds"] for record in report["slowest_commands"]]
+        self.assertEqual(seconds, sorted(seconds, reverse=True))
+        self.assertGreater(report["peak_rss_bytes"], 0)
+        self.assertEqual(
+            report["notes"], dict(untracked_cache=False, fsmonitor=False))
+
+    def test_cprofile_requires_profile(self):
+        cprofile_path = os.path.join(self.make_temp_dir(), "cprofile")
+        process = subprocess.run(
+            [sys.executable, os.path.join(self.this_dir, "git_meld_index.py"),
+             "--cprofile", cprofile_path],
+            cwd=self.make_temp_dir(), stderr=subprocess.PIPE)
+        self.assertEqual(process.returncode, 2)
+        self.assertIn(b"--cprofile requires --profile", process.stderr)
+        self.assertFalse(os.path.exists(cprofile_path))
+
+    def test_popen_recorded_once_finished(self):
+        profile = git_meld_index.Profile()
+        env = git_meld_index.TimingWrapper(
+            git_meld_index.BasicEnv(), profile)
+        process = env.popen(["sh", "-c", "cat; printf err >&2; exit 3"])
+        [record] = profile.records
+        self.assertIsNone(record.exit_status)
+        process.stdin.write(b"abcd")
+        process.stdin.flush()
+        output, stderr_output = process.communicate()
+        self.assertEqual((output, stderr_output), (b"abcd", b"err"))
+        self.assertEqual(
+            (record.exit_status, record.stdin_bytes, record.stdout_bytes,
+             record.stderr_bytes),
+            (3, 4, 4, 3))
+
+    def test_untracked_cache_reported(self):
+        env = self.make_env()
+        make_standard_repo(env)
+        repo_path = env.cmd(["pwd"]).stdout_output.decode().removesuffix("\n")
+        report_path = os.path.join(self.make_temp_dir(), "profile.json")
+
+        def run(*args):
+            subprocess.check_call(
+                [sys.executable, os.path.join(self.this_dir, "git_meld_index.py"),
+                 "--extcmd", "true", "--profile", report_path] + list(args),
+                cwd=repo_path)
+            with open(report_path) as fh:
+                return json.load(fh)["notes"]["untracked_cache"]
+
+        self.assertFalse(run())
+        self.assertTrue(run("--untracked-cache"))
+        # the cache is now in the index, so it is used (and kept up to date)
+        # without the option
+        self.assertTrue(run())
+        # but git doesn't use it to look for untracked files in part of the
+        # tree
+        self.assertFalse(run("--", "."))
+
+    def test_fsmonitor_reported(self):
+        env = self.make_env()
+        make_standard_repo(env)
+        repo_path = env.cmd(["pwd"]).stdout_output.decode().removesuffix("\n")
+        hook_path = os.path.join(self.make_temp_dir(), "fsmonitor")
+        # a hook that says everything may have changed
+        with open(hook_path, "w") as fh:
+            fh.write("#!/bin/sh\nprintf 'token\\0/\\0'\n")
+        os.chmod(hook_path, 0o755)
+        env.cmd(["git", "config", "core.fsmonitor", hook_path])
+        report_path = os.path.join(self.make_temp_dir(), "profile.json")
+        subprocess.check_call(
+            [sys.executable, os.path.join(self.this_dir, "git_meld_index.py"),
+             "--extcmd", "true", "--profile", report_path],
+            cwd=repo_path)
+        with open(report_path) as fh:
+            self.assertTrue(json.load(fh)["notes"]["fsmonitor"])
+
+
+class TestStatusGitOptions(TestCase):
+
+    def options(self, env, enable_caches=False):
+        index_path = os.path.join(
+            env.cmd(["pwd"]).stdout_output.decode().removesuffix("\n"),
+            ".git", "index")
+        return git_meld_index.status_git_options(
+            env, index_path, enable_caches)
+
+    def index_path(self, env):
+        return os.path.join(
+            env.cmd(["pwd"]).stdout_output.decode().removesuffix("\n"),
+            ".git", "index")
+
+    def test_default(self):
+        env = self.make_env()
+        make_standard_repo(env)
+        self.assertEqual(self.options(env), ["--no-optional-locks"])
+        env.cmd(["git", "-c", "index.recordEndOfIndexEntries=true",
+                 "update-index", "--force-write-index"])
+        self.assertEqual(self.options(env), ["--no-optional-locks"])
+
+    def test_configured(self):
+        env = self.make_env()
+        make_standard_repo(env)
+        env.cmd(["git", "config", "core.untrackedCache", "yes"])
+        options = self.options(env)
+        self.assertEqual(options, ["-c", "index.recordEndOfIndexEntries=true"])
+        # git status may now save the cache in the index, and uses it
+        snapshot = git_meld_index.RepoSnapshot.from_repo(
+            env, git_options=options, trace_caches=True)
+        self.assertTrue(snapshot.cache_use["untracked_cache"])
+        self.assertIn(
+            "UNTR", git_meld_index.read_index_extensions(self.index_path(env)))
+
+    def test_configured_without_value(self):
+        env = self.make_env()
+        make_standard_repo(env)
+        # git takes this as true
+        env.cmd(append_file_cmd(".git/config", "[core]\n\tuntrackedCache\n"))
+        self.assertEqual(git_meld_index.read_config(env)["core.untrackedcache"],
+                         None)
+        options = self.options(env)
+        self.assertNotIn("--no-optional-locks", options)
+
+    def test_in_use(self):
+        env = self.make_env()
+        make_standard_repo(env)
+        env.cmd(["git", "-c", "core.untrackedCache=true",
+                 "-c", "index.recordEndOfIndexEntries=true", "status"])
+        options = self.options(env)
+        self.assertEqual(options, ["-c", "index.recordEndOfIndexEntries=true"])
+
+    def test_enable(self):
+        env = self.make_env()
+        make_standard_repo(env)
+        options = self.options(env, enable_caches=True)
+        self.assertEqual(options[:2], ["-c", "core.untrackedCache=true"])
+        self.assertNotIn("--no-optional-locks", options)
+
+
+class TestProcessBudgets(TestCase):
+
+    # Catches changes that start processes per file.  Timings are not
+    # checked here: run benchmark_git_meld_index.py for those.
+
+    def run_stages(self, shape):
+        temp_dir = self.make_temp_dir()
+        repo_path = os.path.join(temp_dir, "repo")
+        benchmark_git_meld_index.build_repo(repo_path, shape)
+        return benchmark_git_meld_index.run_stages(
+            repo_path, os.path.join(temp_dir, "work"), shape)
+
+    def test_processes_independent_of_repo_size(self):
+        small = benchmark_git_meld_index.RepoShape(
+            tracked=20, modified=4, staged=2, untracked=2, symlinks=2,
+            executables=2, large_files=1, large_file_size=100000, edited=2)
+        large = benchmark_git_meld_index.RepoShape(
+            tracked=400, modified=80, staged=40, untracked=40, symlinks=20,
+            executables=20, large_files=2, large_file_size=100000,
+            edited=40)
+        counts = []
+        for shape in [small, large]:
+            results = self.run_stages(shape)
+            processes = {name: processes
+                         for name, (seconds, processes) in results.items()}
+            for name, budget in benchmark_git_meld_index.PROCESS_BUDGETS.items():
+                self.assertLessEqual(processes[name], budget, name)
+            counts.append(processes)
+        self.assertEqual(counts[0], counts[1])
+
+    def test_many_edited_files_within_budget(self):
+        shape = benchmark_git_meld_index.RepoShape(
+            tracked=400, modified=150, staged=40, untracked=2, symlinks=2,
+            executables=2, large_files=1, large_file_size=100000,
+            edited=git_meld_index.PACK_OBJECTS_THRESHOLD + 20)
+        results = self.run_stages(shape)
+        processes = {name: processes
+                     for name, (seconds, processes) in results.items()}
+        for name, budget in benchmark_git_meld_index.PROCESS_BUDGETS.items():
+            self.assertLessEqual(processes[name], budget, name)
+        # the objects were written to a pack: apply ran rev-parse and
+        # pack-objects as well as hash-object and update-index
+        self.assertEqual(processes["apply"], 4)
+
+
+class TestStartupTime(unittest.TestCase):
+
+    def test_import_time(self):
+        microseconds, modules = benchmark_git_meld_index.import_time()
+        self.assertEqual(
+            [name for name in benchmark_git_meld_index.LAZY_MODULES
+             if name in modules], [])
+        # generous, since timings vary between machines: the benchmark
+        # checks IMPORT_TIME_BUDGET_US itself
+        self.assertLess(
+            microseconds,
+            benchmark_git_meld_index.IMPORT_TIME_BUDGET_US *
+            benchmark_git_meld_index.IMPORT_TIME_TEST_FACTOR)
+
+
+class TestParallelMap(unittest.TestCase):
+
+    def test_results_in_order(self):
+        self.assertEqual(
+            git_meld_index.parallel_map(lambda x: x * 2, range(10), 4),
+            [x * 2 for x in range(10)])
+        self.assertEqual(git_meld_index.parallel_map(str, [], 4), [])
+
+    def test_earliest_error_raised_after_all_finish(self):
+        finished = []
+        first_failed = threading.Event()
+
+        def func(item):
+            if item == 0:
+                # fail only after item 1 has already failed
+                first_failed.wait()
+                raise ValueError(item)
+            if item == 1:
+                first_failed.set()
+                raise KeyError(item)
+            finished.append(item)
+
+        with self.assertRaises(ValueError):
+            git_meld_index.parallel_map(func, range(6), 3)
+        self.assertEqual(sorted(finished), [2, 3, 4, 5])
+
+
+class TestCommand(TestCase):
+
+    def test_prefixes_compose(self):
+        dir_ = self.make_temp_dir()
+        os.mkdir(os.path.join(dir_, "sub"))
+        env = git_meld_index.PrefixCmdEnv.make_readable(
+            git_meld_index.in_dir(dir_), git_meld_index.BasicEnv.make_readable())
+        env = git_meld_index.PrefixCmdEnv.make_readable(
+            git_meld_index.with_env(A="outer", B="outer"), env)
+        env = git_meld_index.PrefixCmdEnv.make_readable(
+            git_meld_index.in_dir("sub"), env)
+        command = git_meld_index.Command(
+            ["sh", "-c", 'echo "$(pwd) $A $B"'], env=dict(B="inner"))
+        self.assertEqual(
+            env.cmd(command).stdout_output.decode(),
+            "{} outer inner\n".format(os.path.join(dir_, "sub")))
+
+    def test_redirections(self):
+        dir_ = self.make_temp_dir()
+        write_file(os.path.join(dir_, "in"), "data\n")
+        env = git_meld_index.PrefixCmdEnv(
+            git_meld_index.in_dir(dir_), git_meld_index.BasicEnv())
+        process = env.cmd(
+            git_meld_index.Command(["tr", "a-z", "A-Z"], stdin="in",
+                                   stdout="out"))
+        self.assertIsNone(process.stdout_output)
+        self.assertEqual(read_file(os.path.join(dir_, "out")), "DATA\n")
+
+    def test_str(self):
+        command = git_meld_index.Command(["a b"]).prefixed(
+            git_meld_index.Command(["env"], cwd="/d", env=dict(X="1"),
+                                   stdout="o"))
+        self.assertEqual(str(command), "cd /d && X=1 env 'a b' > o")
+
+
+class TestAsyncBasicEnv(TestCase):
+
+    def test_wrappers_compose(self):
+        dir_ = self.make_temp_dir()
+        output = []
+        profile = git_meld_index.Profile()
+
+        async def run():
+            env = git_meld_index.AsyncBasicEnv.make_readable()
+            env = git_meld_index.TimingWrapper.make_readable(env, profile)
+            env = git_meld_index.PrefixCmdEnv.make_readable(
+                git_meld_index.in_dir(dir_), env)
+            await env.cmd(write_file_cmd("written", "data"))
+            process = await env.read_cmd(["cat", "written"])
+            output.append(process.stdout_output)
+            pretend_env = git_meld_index.NullWrapper.make_readable(env)
+            await pretend_env.cmd(write_file_cmd("not_written", "data"))
+            self.assertIsNone(
+                await pretend_env.call(["touch", "x"], self.fail))
+            with self.assertRaises(git_meld_index.CalledProcessError):
+                await env.cmd(["false"])
+
+        asyncio.run(run())
+        self.assertEqual(output, [b"data"])
+        self.assertEqual(os.listdir(dir_), ["written"])
+        self.assertEqual([record.exit_status for record in profile.records],
+                         [0, 0, 0, 0, 1])
+
+    def test_max_processes(self):
+        dir_ = self.make_temp_dir()
+        running_dir = os.path.join(dir_, "running")
+        os.mkdir(running_dir)
+        # each command records how many commands are running, including itself
+        script = 'mkdir "$1/$$" && ls "$1" | wc -l && sleep 0.1 && rmdir "$1/$$"'
+        cmd = ["sh", "-c", script, "inline_script", running_dir]
+
+        async def run():
+            env = git_meld_index.AsyncBasicEnv(max_processes=2)
+            processes = await asyncio.gather(*[env.cmd(cmd) for _ in range(6)])
+            return [int(process.stdout_output) for process in processes]
+
+        counts = asyncio.run(run())
+        self.assertEqual(len(counts), 6)
+        self.assertLessEqual(max(counts), 2)
+
+        # the synchronous facade keeps to the limit across threads
+        env = git_meld_index.SyncEnv(
+            git_meld_index.AsyncBasicEnv(max_processes=2))
+        self.addCleanup(env.close)
+        processes = git_meld_index.parallel_map(
+            lambda _: env.cmd(cmd), range(6), 6)
+        self.assertLessEqual(
+            max(int(process.stdout_output) for process in processes), 2)
+        with self.assertRaises(git_meld_index.CalledProcessError):
+            env.cmd(["false"])
+
+
+class TestRepoSnapshot(TestCase):
+
+    def assert_snapshot_matches_git(self, env):
+        snapshot = git_meld_index.RepoSnapshot.from_repo(env)
+
+        def undeleted_paths(cmd):
+            return sorted(
+                record.path for record in
+                git_meld_index.iter_diff_records_undeleted(env, cmd))
+
+        self.assertEqual(
+            sorted(record.path for record in snapshot.index_changes()),
+            undeleted_paths(["git", "diff-index", "-z", "--cached", "HEAD"]))
+        self.assertEqual(
+            sorted(record.path for record in snapshot.worktree_changes()),
+            undeleted_paths(["git", "diff-index", "-z", "HEAD"]))
+        def ls_files(args):
+            output = env.cmd(
+                ["git", "ls-files", "-z", "--others", "--exclude-standard"] +
+                args).stdout_output
+            return sorted(os.fsdecode(path) for path in output.split(b"\0")[:-1])
+
+        # directories of untracked files are listed as a whole
+        self.assertEqual(
+            sorted(snapshot.untracked),
+            ls_files(["--directory", "--no-empty-directory"]))
+        expanded = git_meld_index.expand_untracked(env, snapshot.untracked)
+        self.assertEqual(
+            sorted(path for paths in expanded.values() for path in paths),
+            ls_files([]))
+
+    def test_standard_repo(self):
+        env = self.make_env()
+        make_standard_repo(env, "sub/dir/")
+        self.assert_snapshot_matches_git(env)
+
+    def test_untracked_dirs(self):
+        env = self.make_env()
+        repo = Repo(env)
+        repo.add_unmodified("tracked/file", "content\n")
+        repo.add_unmodified(".gitignore", "*.o\n")
+        for path in ["tracked/new", "new/a", "new/sub/b", "new/c.o",
+                     "new/[glob]/c", "ignored.o"]:
+            repo.add_untracked(path, "untracked\n")
+        env.cmd(["git", "init", "-q", "nested"])
+        self.assert_snapshot_matches_git(env)
+        snapshot = git_meld_index.RepoSnapshot.from_repo(env)
+        self.assertEqual(
+            sorted(snapshot.untracked), ["nested/", "new/", "tracked/new"])
+        self.assertEqual(
+            git_meld_index.expand_untracked(env, snapshot.untracked),
+            {"nested/": ["nested/"],
+             "new/": ["new/[glob]/c", "new/a", "new/sub/b"],
+             "tracked/new": ["tracked/new"]})
+        # pathspecs apply to the files in untracked directories
+        pathspecs = git_meld_index.Pathspecs.parse(["new/sub", "tracked"])
+        snapshot = git_meld_index.RepoSnapshot.from_repo(env, pathspecs)
+        self.assertEqual(
+            git_meld_index.expand_untracked(
+                env, snapshot.untracked, pathspecs),
+            {"new/sub/": ["new/sub/b"], "tracked/new": ["tracked/new"]})
+
+    def test_unmerged(self):
+        env = self.make_env()
+        repo = Repo(env)
+        repo.add_unmodified("file", "content\n")
+        env.cmd(["git", "checkout", "-b", "feature"])
+        env.cmd(append_file_cmd("file", "feature branch work\n"))
+        env.cmd(["git", "commit", "-m", "Made changes", "file"])
+        env.cmd(["git", "checkout", "master"])
+        env.cmd(append_file_cmd("file", "conflicting work\n"))
+        env.cmd(["git", "commit", "-m", "Conflicting changes", "file"])
+        self.assertFalse(git_meld_index.try_cmd(env, ["git", "merge", "feature"]))
+        self.assert_snapshot_matches_git(env)
+        snapshot = git_meld_index.RepoSnapshot.from_repo(env)
+        self.assertEqual(
+            [(record.path, record.index_status)
+             for record in snapshot.index_changes()],
+            [("file", "U")])
+
+    def test_non_utf8_paths(self):
+        env = self.make_env()
+        repo = Repo(env)
+        repo.add_unmodified("file", "content\n")
+        path = env.cmd(["pwd"]).stdout_output.rstrip(b"\n")
+        for name in [b"caf\xe9 staged", b"caf\xe9 untracked"]:
+            with open(os.path.join(path, name), "wb") as fh:
+                fh.write(b"data\n")
+        env.cmd(["git", "add", os.fsdecode(b"caf\xe9 staged")])
+        self.assert_snapshot_matches_git(env)
+        snapshot = git_meld_index.RepoSnapshot.from_repo(env)
+        self.assertEqual(
+            [os.fsencode(record.path) for record in snapshot.index_changes()],
+            [b"caf\xe9 staged"])
+        self.assertEqual(
+            [os.fsencode(path) for path in snapshot.untracked],
+            [b"caf\xe9 untracked"])
+
+
+class TestChangeSet(unittest.TestCase):
+
+    def make_fields(self, index):
+        path = "dir{}/sub/file{}".format(index % 100, index)
+        return ("M", ".", "100644", "100755", "100755",
+                "{:040x}".format(index), "{:040x}".format(index + 1), path)
+
+    def test_round_trip(self):
+        records = [git_meld_index.StatusRecord(*self.make_fields(index))
+                   for index in range(10)]
+        records.append(git_meld_index.StatusRecord(
+            "U", "U", "100644", None, "100644", "ab" * 20, None,
+            os.fsdecode(b"caf\xe9")))
+        change_set = git_meld_index.ChangeSet()
+        for record in records:
+            change_set.append(*dataclasses.astuple(record))
+        self.assertEqual(list(change_set), records)
+        self.assertEqual(change_set.statuses(10), ("U", "U"))
+        self.assertEqual(
+            list(change_set.iter_where(lambda index, worktree: index == "U")),
+            records[10:])
+
+    def test_path_column(self):
+        paths = ["a", "a/b", "a-b", "a/b/c", "", os.fsdecode(b"\xff/x")]
+        column = git_meld_index.PathColumn(paths)
+        self.assertEqual(list(column), paths)
+        for row, path in enumerate(paths):
+            self.assertEqual(column.find(path), row)
+        self.assertNotIn("b", column)
+        column.append(b"b")
+        self.assertIn("b", column)
+
+    def test_memory_footprint(self):
+        count = 20000
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            change_set = git_meld_index.ChangeSet()
+            for index in range(count):
+                change_set.append(*self.make_fields(index))
+            self.assertIn("dir7/sub/file7", change_set.paths)
+            used = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+        # A list of StatusRecords takes over 500 bytes per record; most of
+        # this is the two binary hashes (40 bytes)
+        self.assertLess(used / count, 100)
+
+
+class TestGitIndex(TestCase):
+
+    def make_repo(self):
+        env = self.make_env()
+        make_standard_repo(env, "sub/dir/")
+        repo = Repo(env)
+        repo.add_untracked("intent", "intent to add\n")
+        env.cmd(["git", "add", "--intent-to-add", "intent"])
+        env.cmd(["git", "update-index", "--skip-worktree", "sub/dir/unmodified"])
+        return env
+
+    def index_path(self, env):
+        return os.path.join(
+            env.cmd(["pwd"]).stdout_output.decode().removesuffix("\n"),
+            ".git", "index")
+
+    def assert_matches_git(self, index, env):
+        from_git = git_meld_index.GitIndex.from_git(env)
+        self.assertEqual(
+            [dataclasses.replace(entry, stat=None, intent_to_add=None)
+             for entry in index],
+            list(from_git))
+
+    def test_versions(self):
+        env = self.make_env()
+        make_standard_repo(env, "sub/dir/")
+        # git writes version 3 only when extended flags are used: see below
+        for version in [2, 4]:
+            env.cmd(["git", "update-index", "--index-version", str(version)])
+            index = git_meld_index.GitIndex.read(self.index_path(env))
+            self.assertEqual(index.version, version)
+            self.assert_matches_git(index, env)
+            entry = index.get("sub/dir/modified_staged")
+            self.assertEqual(
+                entry.stat[-1], len("modified staged (initial)\n"
+                                    "modified staged (modified)\n"))
+            self.assertIsNone(index.get("sub/dir/untracked"))
+
+    def test_extended_flags(self):
+        env = self.make_repo()
+        for version in [3, 4]:
+            env.cmd(["git", "update-index", "--index-version", str(version)])
+            index = git_meld_index.GitIndex.read(self.index_path(env))
+            self.assertEqual(index.version, version)
+            self.assert_matches_git(index, env)
+            self.assertTrue(index.get("intent").intent_to_add)
+            self.assertTrue(index.get("sub/dir/unmodified").skip_worktree)
+            self.assertFalse(index.get("sub/dir/modified").skip_worktree)
+            self.assertIs(index.get("sub/dir/modified").intent_to_add, False)
+
+    def test_unmerged(self):
+        env = self.make_env()
+        repo = Repo(env)
+        repo.add_unmodified("file", "content\n")
+        env.cmd(["git", "checkout", "-b", "feature"])
+        env.cmd(append_file_cmd("file", "feature branch work\n"))
+        env.cmd(["git", "commit", "-m", "Made changes", "file"])
+        env.cmd(["git", "checkout", "master"])
+        env.cmd(append_file_cmd("file", "conflicting work\n"))
+        env.cmd(["git", "commit", "-m", "Conflicting changes", "file"])
+        self.assertFalse(git_meld_index.try_cmd(env, ["git", "merge", "feature"]))
+        index = git_meld_index.GitIndex.read(self.index_path(env))
+        self.assertEqual([entry.stage for entry in index], [1, 2, 3])
+        self.assertIsNone(index.get("file"))
+        self.assertEqual(index.get("file", 2).hash, env.cmd(
+            ["git", "rev-parse", "HEAD:file"]).stdout_output.decode().strip())
+
+    def test_falls_back_to_git(self):
+        env = self.make_repo()
+        env.cmd(["git", "update-index", "--split-index"])
+        with self.assertRaises(git_meld_index.IndexFormatError):
+            git_meld_index.GitIndex.read(self.index_path(env))
+        index = git_meld_index.load_index(env, self.index_path(env))
+        self.assertIsNone(index.version)
+        self.assertIsNone(index.get("intent").intent_to_add)
+        self.assert_matches_git(index, env)
+
+
+class TestReadIndexExtensions(TestCase):
+
+    def test_read_extensions(self):
+        env = self.make_env()
+        make_standard_repo(env, "sub/dir/")
+        index_path = os.path.join(
+            env.cmd(["pwd"]).stdout_output.decode().removesuffix("\n"),
+            ".git", "index")
+        # no EOIE extension
+        self.assertIsNone(git_meld_index.read_index_extensions(index_path))
+        env.cmd(["git", "-c", "core.untrackedCache=true",
+                 "-c", "index.recordEndOfIndexEntries=true", "status"])
+        self.assertEqual(git_meld_index.read_index_extensions(index_path),
+                         ["TREE", "UNTR", "EOIE"])
+        # the entries aren't read: spoiling them makes no difference
+        with open(index_path, "r+b") as fh:
+            fh.seek(12)
+            fh.write(b"\xff" * 200)
+        self.assertEqual(git_meld_index.read_index_extensions(index_path),
+                         ["TREE", "UNTR", "EOIE"])
+        with open(index_path, "wb") as fh:
+            fh.write(b"not an index")
+        with self.assertRaises(git_meld_index.IndexFormatError):
+            git_meld_index.read_index_extensions(index_path)
+
+
+class TestIterNulFields(TestCase):
+
+    def test_fields_split_across_chunks(self):
+        stream = io.BytesIO(b"a\0bcdefg\0\0hij\0")
+        self.assertEqual(
+            list(git_meld_index.iter_nul_fields(stream, chunk_size=3)),
+            [b"a", b"bcdefg", b"", b"hij"])
+
+    def test_unterminated(self):
+        with self.assertRaises(ValueError):
+            list(git_meld_index.iter_nul_fields(io.BytesIO(b"a\0b")))
+
+    def test_cmd_fields_stream(self):
+        env = self.make_env()
+        fields = git_meld_index.iter_cmd_fields(
+            env, ["sh", "-c", r'printf "a\0"; sleep 10'])
+        # the first field arrives before the command exits; closing the
+        # generator early does not wait for the command to finish
+        start = time.monotonic()
+        self.assertEqual(next(fields), b"a")
+        fields.close()
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_cmd_fields_error(self):
+        env = self.make_env()
+        with self.assertRaises(git_meld_index.CalledProcessError) as cm:
+            list(git_meld_index.iter_cmd_fields(
+                env, ["sh", "-c", r'printf "a\0"; printf oops >&2; exit 1']))
+        self.assertEqual(cm.exception.stderr_output, b"oops")
+
+    def test_cmd_fields_no_input(self):
+        env = self.make_env()
+        # a command reading stdin sees end of file, rather than waiting for
+        # input that never comes
+        fields = []
+        reader = threading.Thread(target=lambda: fields.extend(
+            git_meld_index.iter_cmd_fields(
+                env, ["sh", "-c", r'cat; printf "a\0"'])),
+            daemon=True)
+        reader.start()
+        reader.join(timeout=30)
+        self.assertFalse(reader.is_alive())
+        self.assertEqual(fields, [b"a"])
+
+    def test_cmd_fields_much_stderr(self):
+        env = self.make_env()
+        # more than fits in a pipe, written before any output
+        script = r'head -c 1000000 /dev/zero >&2; printf "a\0"'
+        fields = []
+        reader = threading.Thread(target=lambda: fields.extend(
+            git_meld_index.iter_cmd_fields(env, ["sh", "-c", script])),
+            daemon=True)
+        reader.start()
+        reader.join(timeout=30)
+        self.assertFalse(reader.is_alive())
+        self.assertEqual(fields, [b"a"])
+
+
+class TestPathspecs(TestCase):
+
+    def test_parse(self):
+        parse = git_meld_index.parse_pathspec
+        Pathspec = git_meld_index.Pathspec
+        self.assertEqual(parse("a/b", "sub/"), Pathspec("sub/a/b"))
+        self.assertEqual(parse("../a", "sub/"), Pathspec("a"))
+        self.assertEqual(parse(".", "sub/"), Pathspec("sub"))
+        self.assertEqual(parse(".", ""), Pathspec(""))
+        self.assertEqual(parse(":/a", "sub/"), Pathspec("a"))
+        self.assertEqual(parse(":!a", "sub/"), Pathspec("sub/a", exclude=True))
+        self.assertEqual(parse(":^/a", "sub/"), Pathspec("a", exclude=True))
+        self.assertEqual(
+            parse(":(top,exclude)a", "sub/"), Pathspec("a", exclude=True))
+        self.assertRaises(
+            git_meld_index.PathspecError, parse, ":(icase)a", "")
+        self.assertRaises(git_meld_index.PathspecError, parse, "../a", "")
+
+    def test_matches(self):
+        pathspecs = git_meld_index.Pathspecs.parse(
+            ["services", "*.py", ":!services/foo/gen"])
+        self.assertTrue(pathspecs.matches("services/foo/a"))
+        self.assertTrue(pathspecs.matches("lib/x.py"))
+        self.assertFalse(pathspecs.matches("servicesx"))
+        self.assertFalse(pathspecs.matches("services/foo/gen/a"))
+        self.assertTrue(git_meld_index.Pathspecs().matches("a"))
+        self.assertFalse(
+            git_meld_index.Pathspecs.parse([":!a"]).matches("a/b"))
+
+    def test_limited_views(self):
+        env = self.make_env()
+        repo = make_standard_repo(env, "in/")
+        do_standard_repo_changes(repo, "out/")
+        path = env.cmd(["readlink", "-e", "."]).stdout_output.decode().removesuffix("\n")
+        snapshots = git_meld_index.RepoSnapshots(
+            git_meld_index.Pathspecs.parse(["in"]))
+        left = self.make_temp_dir()
+        git_meld_index.StageableWorkingTreeSubsetView(path, snapshots).write(
+            env, left)
+        self.assertEqual(os.listdir(left), ["in"])
+        right = self.make_temp_dir()
+        view = git_meld_index.IndexOrHeadView(path, snapshots)
+        view.write(env, right)
+        self.assertEqual(os.listdir(right), ["in"])
+        os.mkdir(os.path.join(right, "out"))
+        for name in ["in/untracked", "out/untracked"]:
+            write_file(os.path.join(right, name), "edited\n")
+        view.apply(env, right)
+        staged = env.cmd(["git", "diff", "--cached", "--name-only"])
+        self.assertIn(b"in/untracked\n", staged.stdout_output)
+        self.assertNotIn(b"out/untracked\n", staged.stdout_output)
+
 
 class TestIndexOrHeadView(TestCase, WriteViewMixin):
 
@@ -341,6 +1415,70 @@ class TestIndexOrHeadView(TestCase, WriteViewMixin):
         self.assert_write_golden(
             env, self.make_view, "test_write_index_or_head")
 
+    def test_apply_paths(self):
+        env = self.make_env()
+        repo = Repo(env)
+        repo.add_modified("a", "a\n", "more\n")
+        repo.add_modified("b", "b\n", "more\n")
+        path = env.cmd(["pwd"]).stdout_output.decode().removesuffix("\n")
+        out = self.make_temp_dir()
+        view = self.make_view(path)
+        view.write(env, out)
+        for name in ["a", "b"]:
+            with open(os.path.join(out, name), "a") as fh:
+                fh.write("edited\n")
+        # only the given paths are applied; missing ones are ignored
+        view.apply(env, out, {"a", "removed"})
+        self.assertEqual(env.cmd(["git", "diff", "--cached", "--name-only"])
+                         .stdout_output, b"a\n")
+
+    def test_apply_leaves_out_staged(self):
+        env = self.make_env()
+        repo = Repo(env)
+        repo.add_modified("a", "a\n", "more\n")
+        repo.add_modified("b", "b\n", "more\n")
+        repo.add_untracked("new", "")
+        env.cmd(["git", "add", "--intent-to-add", "new"])
+        path = env.cmd(["pwd"]).stdout_output.decode().removesuffix("\n")
+        out = self.make_temp_dir()
+        view = self.make_view(
+            path, index_path=os.path.join(path, ".git", "index"))
+        view.write(env, out)
+        # edited, but then changed back
+        write_file(os.path.join(out, "a"), "a\n")
+        write_file(os.path.join(out, "b"), "b\nedited\n")
+        # the same content as the intent-to-add entry, but not yet staged
+        write_file(os.path.join(out, "new"), "")
+        commands = []
+        recording_env = env.wrap(
+            functools.partial(RecordingWrapper, commands=commands))
+
+        def update_index_input():
+            view.apply(recording_env, out)
+            inputs = [input for args, input in commands
+                      if "update-index" in strip_in_dir(args)]
+            del commands[:]
+            return inputs
+        [input] = update_index_input()
+        self.assertEqual(
+            sorted(field.split(b"\t")[1] for field in input.split(b"\0")[:-1]),
+            [b"b", b"new"])
+        self.assertEqual(env.cmd(["git", "diff", "--cached", "--name-only"])
+                         .stdout_output, b"b\nnew\n")
+        # nothing differs from the index now, so it isn't updated at all
+        self.assertEqual(update_index_input(), [])
+
+    def test_write_intent_to_add(self):
+        env = self.make_env()
+        repo = Repo(env)
+        repo.add_unmodified("file", "content\n")
+        repo.add_untracked("new", "new\n")
+        env.cmd(["git", "add", "--intent-to-add", "new"])
+        path = env.cmd(["pwd"]).stdout_output.decode().removesuffix("\n")
+        out = self.make_temp_dir()
+        self.make_view(path).write(env, out)
+        self.assertEqual(os.listdir(out), [])
+
     def test_roundtrip_symlink(self):
         env = self.make_env()
         repo = Repo(env,
@@ -446,6 +1584,138 @@ class TestIndexOrHeadView(TestCase, WriteViewMixin):
             "test_write_index_or_head_submodule_with_changes",
             extra_invariant_funcs=(submodule_status, submodule_git_status))
 
+    def test_apply_stages_all_files_in_one_update(self):
+        env = self.make_env()
+        repo = Repo(env)
+        repo.add_unmodified("file", "content\n")
+        path = env.cmd(["readlink", "-e", "."]).stdout_output.decode().removesuffix("\n")
+        view = self.make_view(path)
+        out = self.make_temp_dir()
+        view.write(env, out)
+        for name in ["a", "tab\tname", "new\nline"]:
+            write_file(os.path.join(out, name), name + "\n")
+        view.apply(env, out)
+        staged = env.cmd(["git", "ls-files", "-z"]).stdout_output.decode()
+        self.assertEqual(
+            sorted(staged.split("\0")[:-1]),
+            ["a", "file", "new\nline", "tab\tname"])
+
+    def test_apply_stages_only_changed_files(self):
+        env = self.make_env()
+        make_standard_repo(env)
+        path = env.cmd(["readlink", "-e", "."]).stdout_output.decode().removesuffix("\n")
+        view = self.make_view(path)
+        out = self.make_temp_dir()
+        view.write(env, out)
+        write_file(os.path.join(out, "modified"), "edited\n")
+        # same size and contents, but touched
+        os.utime(os.path.join(out, "new_staged"), ns=(0, 0))
+        commands = []
+        view.apply(
+            env.wrap(functools.partial(RecordingWrapper, commands=commands)),
+            out)
+        [(args, input)] = [
+            (strip_in_dir(args), input) for args, input in commands
+            if "hash-object" in strip_in_dir(args)]
+        self.assertEqual(input, os.path.join(out, "modified").encode() + b"\n")
+        self.assertEqual(
+            env.cmd(["git", "show", ":modified"]).stdout_output, b"edited\n")
+
+    def test_hash_objects(self):
+        env = self.make_env()
+        Repo(env)
+        names = ["plain", "quote\"d", "back\\slash", "new\nline"]
+        for name in names:
+            env.cmd(write_file_cmd(name, name))
+        expected = [
+            env.cmd(["git", "hash-object", "--", name])
+            .stdout_output.decode().removesuffix("\n")
+            for name in names]
+        self.assertEqual(git_meld_index.hash_objects(env, names), expected)
+        self.assertEqual(git_meld_index.hash_objects(env, []), [])
+
+    def test_hash_objects_pack(self):
+        env = self.make_env()
+        repo = Repo(env)
+        repo.add_unmodified("existing", "existing\n")
+        repo.add_unmodified(".gitattributes", "*.txt text\n")
+        objects_dir = os.path.join(
+            env.cmd(["pwd"]).stdout_output.decode().removesuffix("\n"),
+            ".git", "objects")
+        def count_loose():
+            return env.cmd(["git", "count-objects"]).stdout_output
+        loose_before = count_loose()
+        before = set(os.listdir(objects_dir))
+        env.cmd(write_file_cmd("a.txt", "crlf\r\n"))
+        env.cmd(write_file_cmd("b", "b\n"))
+        env.cmd(write_file_cmd("existing_copy", "existing\n"))
+        names = ["a.txt", "b", "existing_copy"]
+        expected = [
+            env.cmd(["git", "hash-object", "--", name])
+            .stdout_output.decode().removesuffix("\n")
+            for name in names]
+        self.assertEqual(
+            git_meld_index.hash_objects(env, names, pack_threshold=3),
+            expected)
+        # no new loose objects, and no temporary object directory left over
+        self.assertEqual(count_loose(), loose_before)
+        self.assertEqual(set(os.listdir(objects_dir)), before)
+        packed = env.cmd(["git", "verify-pack", "-v"] + [
+            os.path.join(objects_dir, "pack", name)
+            for name in os.listdir(os.path.join(objects_dir, "pack"))
+            if name.endswith(".idx")]).stdout_output.decode()
+        self.assertIn(expected[0], packed)
+        self.assertIn(expected[1], packed)
+        # already in the repository, so not packed again
+        self.assertNotIn(expected[2], packed)
+        # filters were applied
+        self.assertEqual(
+            env.cmd(["git", "cat-file", "blob", expected[0]]).stdout_output,
+            b"crlf\n")
+
+    def test_hash_objects_pack_pretend(self):
+        env = self.make_env()
+        Repo(env)
+        names = ["a", "b"]
+        for name in names:
+            env.cmd(write_file_cmd(name, name))
+        pretend_env = git_meld_index.NullWrapper.make_readable(env)
+        # no temporary object directory is made, even briefly
+        with mock.patch("tempfile.mkdtemp", side_effect=AssertionError):
+            git_meld_index.hash_objects(pretend_env, names, pack_threshold=2)
+        self.assertEqual(
+            env.cmd(["git", "count-objects"]).stdout_output,
+            b"0 objects, 0 kilobytes\n")
+
+    def test_cat_file_batch(self):
+        env = self.make_env()
+        repo = Repo(env)
+        content = "".join("line {}\n".format(i) for i in range(1000))
+        repo.add_unmodified("big", content)
+        repo.add_unmodified("small", "small\n")
+        hashes = [
+            env.cmd(["git", "rev-parse", "HEAD:" + name])
+            .stdout_output.decode().removesuffix("\n")
+            for name in ["big", "small"]]
+        out = self.make_temp_dir()
+        with git_meld_index.CatFileBatch(env) as cat_file:
+            cat_file.chunk_size = 7
+            cat_file.write_blob(
+                env, hashes[0], os.path.join(out, "big"), executable=True)
+            self.assertEqual(cat_file.read_blob(hashes[1]), b"small\n")
+            self.assertRaises(KeyError, cat_file.read_blob, "0" * 40)
+        self.assertEqual(read_file(os.path.join(out, "big")), content)
+        self.assertTrue(os.access(os.path.join(out, "big"), os.X_OK))
+
+    def test_write_pretend(self):
+        env = self.make_env()
+        make_standard_repo(env)
+        path = env.cmd(["readlink", "-e", "."]).stdout_output.decode().removesuffix("\n")
+        out = self.make_temp_dir()
+        self.make_view(path).write(
+            git_meld_index.NullWrapper.make_readable(env), out)
+        self.assertEqual(os.listdir(out), [])
+
     # I can't be bothered to fix this case at the moment
     # def test_roundtrip_empty_repo(self):
     #     env = self.make_env()
@@ -497,7 +1767,7 @@ rsync -a {new_content}/ "$right"
                  diff_output)])
         return diff_output
 
-    def check(self, golden_dir, env, prefix=""):
+    def check(self, golden_dir, env, prefix="", **work_area_kwargs):
         repo_path = (env.read_cmd(["readlink", "-e", "."])
                      .stdout_output.decode().removesuffix("\n"))
 
@@ -532,9 +1802,11 @@ rsync -a {new_content}/ "$right"
         meld_env, get_recorded_listings = self.write_fake_meld(env, edited)
 
         work_dir = self.make_temp_dir()
-        work_area = git_meld_index.WorkArea(meld_env, work_dir)
-        left_view = git_meld_index.make_view("working:" + repo_path)
-        right_view = git_meld_index.make_view("index:" + repo_path)
+        work_area = git_meld_index.WorkArea(
+            meld_env, work_dir, **work_area_kwargs)
+        snapshots = git_meld_index.RepoSnapshots()
+        left_view = git_meld_index.make_view("working:" + repo_path, snapshots)
+        right_view = git_meld_index.make_view("index:" + repo_path, snapshots)
         work_area.meld(left_view, right_view, tool="meld")
 
         left, right = get_recorded_listings()
@@ -554,6 +1826,296 @@ rsync -a {new_content}/ "$right"
         make_standard_repo(env, prefix)
         self.check("test_dirs", env, prefix=prefix)
 
+    @unittest.skipUnless(sys.platform.startswith("linux"), "needs inotify")
+    def test_watch(self):
+        env = self.make_env()
+        make_standard_repo(env)
+        self.check("test", env, watch=True)
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "needs inotify")
+    def test_live(self):
+        env = self.make_env()
+        prefix = "sub/dir/"
+        make_standard_repo(env, prefix)
+        self.check("test_dirs", env, prefix=prefix, live=True)
+
+
+class TestDaemon(TestCase):
+
+    def use_runtime_dir(self):
+        runtime_dir = self.make_temp_dir()
+        patcher = mock.patch.dict(os.environ, XDG_RUNTIME_DIR=runtime_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return runtime_dir
+
+    def start_daemon(self, env, commands, idle_timeout=60):
+        self.use_runtime_dir()
+        path = env.cmd(["readlink", "-e", "."]).stdout_output.decode().removesuffix("\n")
+        socket_path = git_meld_index.daemon_socket_path(path)
+        daemon = git_meld_index.Daemon(
+            env.wrap(functools.partial(RecordingWrapper, commands=commands)),
+            socket_path, idle_timeout=idle_timeout)
+        thread = threading.Thread(target=daemon.serve)
+        thread.start()
+        client = git_meld_index.DaemonClient(socket_path)
+
+        def stop():
+            if thread.is_alive():
+                client.request("shutdown")
+            thread.join()
+            self.assertFalse(os.path.exists(socket_path))
+        stop.thread = thread
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                hello = client.request("hello")
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+            else:
+                break
+        self.assertEqual(
+            hello["version"], git_meld_index.DAEMON_PROTOCOL_VERSION)
+        return path, client, stop
+
+    def count(self, commands, name):
+        # git commands run with subcommand name
+        return sum(1 for args, input in commands
+                   if [arg for arg in strip_in_dir(args)[1:]
+                       if not arg.startswith("-")][:1] == [name])
+
+    def test_sessions(self):
+        env = self.make_env()
+        make_standard_repo(env)
+        commands = []
+        path, client, stop = self.start_daemon(env, commands)
+        try:
+            for name in ["modified", "partially_staged"]:
+                response = client.request(
+                    "prepare", work_dir=self.make_temp_dir())
+                write_file(os.path.join(response["right_dir"], name),
+                           "edited\n")
+                client.request(
+                    "apply", session=response["session"], paths=[name])
+                self.assertEqual(
+                    env.cmd(["git", "show", ":" + name]).stdout_output,
+                    b"edited\n")
+            with self.assertRaisesRegex(
+                    git_meld_index.DaemonError, "no such session"):
+                client.request("apply", session=response["session"])
+            with self.assertRaisesRegex(
+                    git_meld_index.DaemonError, "PathspecError"):
+                client.request("prepare", work_dir=self.make_temp_dir(),
+                               pathspecs=[":(glob)*"])
+            # pathspecs are relative to the client's directory
+            response = client.request(
+                "prepare", work_dir=self.make_temp_dir(), pathspecs=["."],
+                prefix="elsewhere/")
+            self.assertEqual(os.listdir(response["right_dir"]), [])
+        finally:
+            stop()
+        # git processes were reused between sessions
+        self.assertEqual(self.count(commands, "hash-object"), 1)
+        # (rev-parse runs twice, both at startup)
+        self.assertEqual(self.count(commands, "rev-parse"), 2)
+        self.assertEqual(self.count(commands, "config"), 1)
+
+    def test_unapplied_sessions(self):
+        env = self.make_env()
+        make_standard_repo(env)
+        path, client, stop = self.start_daemon(env, [], idle_timeout=0.5)
+        try:
+            session = client.request(
+                "prepare", work_dir=self.make_temp_dir())["session"]
+            client.request("abort", session=session)
+            with self.assertRaisesRegex(
+                    git_meld_index.DaemonError, "no such session"):
+                client.request("apply", session=session)
+            # a client that was killed before applying its session doesn't
+            # keep the daemon running
+            process = subprocess.Popen(["true"])
+            process.wait()
+            client.request("prepare", work_dir=self.make_temp_dir(),
+                           client_pid=process.pid)
+            stop.thread.join(10)
+            self.assertFalse(stop.thread.is_alive())
+        finally:
+            stop()
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "needs inotify")
+    def test_snapshot_reused_until_changed(self):
+        env = self.make_env()
+        make_standard_repo(env)
+        commands = []
+        path, client, stop = self.start_daemon(env, commands)
+        try:
+            def prepare():
+                client.request("prepare", work_dir=self.make_temp_dir())
+                return self.count(commands, "status")
+            self.assertEqual(prepare(), 1)
+            self.assertEqual(prepare(), 1)
+            with open(os.path.join(path, "modified"), "a") as fh:
+                fh.write("more\n")
+            self.assertEqual(prepare(), 2)
+            self.assertEqual(prepare(), 2)
+            env.cmd(["git", "add", "modified"])
+            self.assertEqual(prepare(), 3)
+            # neither is in the working tree the TreeWatcher watches
+            with open(os.path.join(path, ".git", "info", "exclude"),
+                      "a") as fh:
+                fh.write("untracked\n")
+            self.assertEqual(prepare(), 4)
+            env.cmd(["git", "config", "meldIndex.unused", "x"])
+            self.assertEqual(prepare(), 5)
+        finally:
+            stop()
+
+    def test_one_daemon_per_repository(self):
+        env = self.make_env()
+        env.cmd(["git", "init", "-q"])
+        env.cmd(["mkdir", "-p", "sub/dir"])
+        path = env.cmd(["readlink", "-e", "."]).stdout_output.decode().removesuffix("\n")
+        sub = os.path.join(path, "sub", "dir")
+        self.assertEqual(git_meld_index.daemon_repo_dir(sub),
+                         (path, "sub/dir/"))
+        self.assertEqual(git_meld_index.daemon_repo_dir(path), (path, ""))
+        self.assertEqual(git_meld_index.daemon_socket_path(sub),
+                         git_meld_index.daemon_socket_path(path))
+        # symlinks are resolved
+        link = os.path.join(self.make_temp_dir(), "link")
+        os.symlink(sub, link)
+        self.assertEqual(git_meld_index.daemon_repo_dir(link),
+                         (path, "sub/dir/"))
+
+    def test_options_rejected(self):
+        for option in ["--verbose", "--pretend", "--live"]:
+            process = subprocess.run(
+                [sys.executable, git_meld_index.__file__, "--daemon", option],
+                cwd=self.make_temp_dir(), stderr=subprocess.PIPE)
+            self.assertEqual(process.returncode, 2)
+            self.assertIn(b"--daemon can't be used with", process.stderr)
+
+    def test_command_line(self):
+        env = self.make_env()
+        make_standard_repo(env)
+        self.use_runtime_dir()
+        edit = os.path.join(self.make_temp_dir(), "edit")
+        write_file(edit, '#!/bin/sh\necho edited >> "$2/modified"\n')
+        os.chmod(edit, 0o755)
+        command = [sys.executable, git_meld_index.__file__]
+        try:
+            env.cmd(command + ["--daemon", "--extcmd", edit])
+            env.cmd(command + ["--daemon", "--extcmd", edit])
+        finally:
+            env.cmd(command + ["--stop-daemon"])
+        self.assertEqual(
+            env.cmd(["git", "show", ":modified"]).stdout_output,
+            b"modified (initial)\nedited\nedited\n")
+
+    def test_interrupted_client(self):
+        env = self.make_env()
+        make_standard_repo(env)
+        self.use_runtime_dir()
+        path = env.cmd(["readlink", "-e", "."]).stdout_output.decode().removesuffix("\n")
+        interrupt = os.path.join(self.make_temp_dir(), "interrupt")
+        write_file(interrupt, '#!/bin/sh\nkill -INT "$PPID"\n')
+        os.chmod(interrupt, 0o755)
+        process = subprocess.run(
+            [sys.executable, git_meld_index.__file__, "--daemon",
+             "--daemon-idle-timeout", "0.5", "--extcmd", interrupt],
+            cwd=path)
+        self.assertEqual(process.returncode, 1)
+        # the session was aborted, so the daemon exits once idle
+        socket_path = git_meld_index.daemon_socket_path(path)
+        deadline = time.monotonic() + 10
+        while os.path.exists(socket_path) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(os.path.exists(socket_path))
+
+
+@unittest.skipUnless(sys.platform.startswith("linux"), "needs inotify")
+class TestInotifyWatcher(TestCase):
+
+    def test_take(self):
+        dir_ = self.make_temp_dir()
+        os.mkdir(os.path.join(dir_, "sub"))
+        write_file(os.path.join(dir_, "unchanged"), "")
+        watcher = git_meld_index.InotifyWatcher(dir_)
+        self.addCleanup(watcher.close)
+        self.assertFalse(watcher.poll(0))
+        write_file(os.path.join(dir_, "sub", "written"), "")
+        os.chmod(os.path.join(dir_, "unchanged"), 0o755)
+        # as editors save files
+        write_file(os.path.join(dir_, "temp"), "")
+        os.rename(os.path.join(dir_, "temp"), os.path.join(dir_, "renamed"))
+        # written to before the new directory could be watched
+        os.makedirs(os.path.join(dir_, "new", "deeper"))
+        write_file(os.path.join(dir_, "new", "deeper", "file"), "")
+        self.assertTrue(watcher.poll(0))
+        self.assertEqual(
+            watcher.take(),
+            {"sub/written", "unchanged", "temp", "renamed", "new/deeper/file"})
+        self.assertEqual(watcher.take(), set())
+        # the new directory is watched now
+        write_file(os.path.join(dir_, "new", "deeper", "later"), "")
+        watcher.poll(0)
+        self.assertEqual(watcher.take(), {"new/deeper/later"})
+
+    def test_live_stager(self):
+        env = self.make_env()
+        repo = Repo(env)
+        repo.add_modified("a", "a\n", "more\n")
+        repo.add_modified("b", "b\n", "more\n")
+        path = env.cmd(["pwd"]).stdout_output.decode().removesuffix("\n")
+        out = self.make_temp_dir()
+        view = git_meld_index.IndexOrHeadView(path)
+        view.write(env, out)
+        watcher = git_meld_index.InotifyWatcher(out)
+        self.addCleanup(watcher.close)
+        stager = git_meld_index.LiveStager(env, view, out, watcher)
+        stager.start()
+        try:
+            with open(os.path.join(out, "a"), "a") as fh:
+                fh.write("edited\n")
+
+            def staged():
+                return env.cmd(["git", "diff", "--cached", "--name-only"]
+                               ).stdout_output
+            deadline = time.monotonic() + 10
+            while staged() != b"a\n" and time.monotonic() < deadline:
+                time.sleep(0.05)
+            # staged while still running
+            self.assertEqual(staged(), b"a\n")
+            with open(os.path.join(out, "b"), "a") as fh:
+                fh.write("edited\n")
+        finally:
+            remaining = stager.stop()
+        # a was staged already; b may or may not have been
+        self.assertIn(remaining, [{"b"}, set()])
+
+    def test_live_stager_retries(self):
+        watcher = mock.Mock()
+        watcher.take.side_effect = [{"a"}, {"b"}, set()]
+        applied = []
+
+        def apply(env, dir_, paths):
+            applied.append(set(paths))
+            if len(applied) == 1:
+                # e.g. removed by the diff tool while being read
+                raise FileNotFoundError(errno.ENOENT, "No such file", "a")
+        view = mock.Mock()
+        view.apply.side_effect = apply
+        stager = git_meld_index.LiveStager(None, view, "out", watcher)
+        stderr = io.StringIO()
+        with mock.patch.object(sys, "stderr", stderr):
+            for _ in range(3):
+                stager._stage()
+        self.assertIn("staging failed, will retry", stderr.getvalue())
+        # the failed path is tried again along with the next one
+        self.assertEqual(applied, [{"a"}, {"a", "b"}])
+
 
 def create_standard_repo(path, prefix=""):
     basic_env = git_meld_index.BasicEnv()